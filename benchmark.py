@@ -0,0 +1,334 @@
+""" Benchmark of the extraction pipeline on a synthetic corpus.
+
+Generates one PDF per layout with PyMuPDF (single column, two column, mixed
+layout, table heavy, dense, many titles and image-only scanned pages), extracts
+them one after the other in this process and times every pipeline stage on its
+own. The results, with pages per second and peak memory, are written as JSON
+so the runs before and after a change can be compared.
+
+    python benchmark.py --pages 10 --repeat 3 --output before.json
+    PDF_PARSER_BLOCK_DETECTOR=geometry python benchmark.py --kinds dense two_column
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+import fitz
+
+from utils import doc_session, get_pdf_extraction, page_process, pc_relation, pdf_parse, text_extract
+from utils.config import block_detector
+
+WORDS = ("the of and to in a is that for it as was with be by on not he this are or his from at which but have an "
+         "they you were her she there been one all we their has would when if so no will more can other into its "
+         "report market revenue growth policy system analysis result section figure table data value period total "
+         "increase change rate level process control measure review annual quarter budget forecast risk").split()
+
+# (stage, owner, attribute) of every timed call. A stage called from another
+# stage only counts for the inner one.
+STAGES = [
+    ("prescan", pdf_parse, "prescan_document"),
+    ("stripped_page_render", text_extract.TextExtractor, "get_stripped_page"),
+    ("char_mask", text_extract.TextExtractor, "get_char_mask"),
+    # What is left of block detection once the page render and OCR are taken out
+    ("morphology_contours", text_extract.TextExtractor, "get_blocks_bbox_by_cv"),
+    ("merge_overlapping_bbox", text_extract.TextExtractor, "merge_overlapping_bbox"),
+    ("add_pagebreak", page_process.PageProcessor, "add_pagebreak"),
+    ("merge_normalized_rect", page_process.PageProcessor, "merge_normalized_rect"),
+    ("ocr", doc_session, "get_scanned_page_as_df"),
+    # Open sentences are flagged in prepare_page_data and merged across pages after it
+    ("cross_page_merge", pdf_parse, "prepare_page_data"),
+    ("cross_page_merge", pdf_parse, "split_open_paragraph"),
+    ("cross_page_merge", pdf_parse, "merge_continued_paragraphs"),
+    ("generate_relationship", pc_relation.PCRelationGen, "add_blocks"),
+]
+STAGE_NAMES = list(dict.fromkeys(stage for stage, _, _ in STAGES))
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def paragraph(rng, sentences=4):
+    return " ".join(sentence(rng, rng.randint(8, 16)) for _ in range(sentences))
+
+
+def add_column(page, rng, rect, fontsize=10, title_every=2, title_size=13):
+    """ Fills rect with bold headings and paragraphs, top to bottom """
+    y, count = rect.y0, 0
+    while y < rect.y1 - 4 * fontsize:
+        if title_every and count % title_every == 0:
+            page.insertText((rect.x0, y + title_size), sentence(rng, 3)[:-1], fontsize=title_size, fontname="hebo")
+            y += title_size + 8
+        box = fitz.Rect(rect.x0, y, rect.x1, min(y + 9 * fontsize, rect.y1))
+        page.insertTextbox(box, paragraph(rng), fontsize=fontsize)
+        y = box.y1 + fontsize
+        count += 1
+
+
+def make_single_column(doc, rng):
+    page = doc.newPage()
+    add_column(page, rng, fitz.Rect(72, 72, 523, 770))
+
+
+def make_two_column(doc, rng):
+    page = doc.newPage()
+    page.insertText((72, 86), sentence(rng, 4)[:-1].upper(), fontsize=16, fontname="hebo")
+    for x in (72, 310):
+        add_column(page, rng, fitz.Rect(x, 110, x + 213, 770), fontsize=9)
+
+
+def make_mixed_layout(doc, rng):
+    page = doc.newPage()
+    add_column(page, rng, fitz.Rect(72, 72, 523, 400))
+    for x in (72, 310):
+        add_column(page, rng, fitz.Rect(x, 420, x + 213, 770), fontsize=9, title_every=3)
+
+
+def make_table_heavy(doc, rng):
+    page = doc.newPage()
+    page.insertText((72, 86), sentence(rng, 3)[:-1], fontsize=13, fontname="hebo")
+    y = 110
+    while y < 640:
+        rows, cols = rng.randint(4, 8), rng.randint(3, 5)
+        width, height = 451 / cols, 18
+        for row in range(rows + 1):
+            page.drawLine((72, y + row * height), (523, y + row * height))
+        for col in range(cols + 1):
+            page.drawLine((72 + col * width, y), (72 + col * width, y + rows * height))
+        for row in range(rows):
+            for col in range(cols):
+                text = sentence(rng, 2)[:-1] if row == 0 or col == 0 else f"{rng.uniform(0, 10000):,.2f}"
+                page.insertText((76 + col * width, y + row * height + 13), text, fontsize=8,
+                                fontname="hebo" if row == 0 else "helv")
+        y += rows * height + 20
+        page.insertTextbox(fitz.Rect(72, y, 523, y + 60), paragraph(rng, 2), fontsize=9)
+        y += 80
+
+
+def make_dense(doc, rng):
+    page = doc.newPage()
+    page.insertTextbox(fitz.Rect(36, 36, 559, 806), "\n\n".join(paragraph(rng, 5) for _ in range(12)), fontsize=6)
+
+
+def make_many_titles(doc, rng):
+    page = doc.newPage()
+    y = 72
+    while y < 740:
+        level = rng.randint(0, 2)
+        page.insertText((72, y + 14 - 2 * level), sentence(rng, rng.randint(2, 5))[:-1], fontsize=14 - 2 * level,
+                        fontname="hebo")
+        y += 22
+        page.insertTextbox(fitz.Rect(72, y, 523, y + 30), sentence(rng, rng.randint(8, 20)), fontsize=10)
+        y += 38
+
+
+def make_scanned(doc, rng):
+    """ Image-only page holding a 300 DPI rendering of a text page """
+    source = fitz.open()
+    make_single_column(source, rng)
+    pixmap = source[0].getPixmap(matrix=fitz.Matrix(300 / 72, 300 / 72), colorspace=fitz.csGRAY)
+    page = doc.newPage()
+    page.insertImage(page.rect, pixmap=pixmap)
+    source.close()
+
+
+CORPUS = {
+    "single_column": make_single_column,
+    "two_column": make_two_column,
+    "mixed_layout": make_mixed_layout,
+    "table_heavy": make_table_heavy,
+    "dense": make_dense,
+    "many_titles": make_many_titles,
+    "scanned": make_scanned,
+}
+
+
+def generate_corpus(folder, kinds, pages, seed):
+    """ Writes one pdf of the given page count per kind
+    Returns:
+        dict: kind -> pdf path
+    """
+    paths = {}
+    for kind in kinds:
+        rng = random.Random(f"{seed}-{kind}")
+        doc = fitz.open()
+        for _ in range(pages):
+            CORPUS[kind](doc, rng)
+        paths[kind] = os.path.join(folder, f"{kind}.pdf")
+        doc.save(paths[kind], garbage=3, deflate=True)
+        doc.close()
+    return paths
+
+
+class StageTimer:
+    """ Self time and call count of the stages in STAGES, collected while
+        instrument() is active.
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        # Time spent in the stages called from each running stage
+        self.__nested = []
+
+    def reset(self):
+        self.seconds.clear()
+        self.calls.clear()
+
+    def __wrap(self, stage, fn):
+        @wraps(fn)
+        def timed(*args, **kwargs):
+            self.__nested.append(0.0)
+            started_at = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started_at
+                self.seconds[stage] += elapsed - self.__nested.pop()
+                self.calls[stage] += 1
+                if self.__nested:
+                    self.__nested[-1] += elapsed
+        return timed
+
+    @contextmanager
+    def instrument(self):
+        originals = [(owner, attribute, getattr(owner, attribute)) for _, owner, attribute in STAGES]
+        try:
+            for (stage, owner, attribute), (_, _, fn) in zip(STAGES, originals):
+                setattr(owner, attribute, self.__wrap(stage, fn))
+            yield self
+        finally:
+            for owner, attribute, fn in originals:
+                setattr(owner, attribute, fn)
+
+
+def max_rss_bytes():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def benchmark_document(kind, pdf_fpath, repeat, timer, measure_memory=True):
+    """ Extracts one pdf repeat times, keeping the stage times of the fastest run
+    Returns:
+        dict: Result of the document
+    """
+    with fitz.open(pdf_fpath) as doc:
+        page_count = doc.pageCount
+    best = None
+    for _ in range(repeat):
+        timer.reset()
+        with timer.instrument():
+            started_at = time.perf_counter()
+            df = get_pdf_extraction(pdf_fpath, kind, workers=1)
+            seconds = time.perf_counter() - started_at
+        if best is None or seconds < best["seconds"]:
+            stages = {stage: {"seconds": round(timer.seconds[stage], 6), "calls": timer.calls[stage]}
+                      for stage in STAGE_NAMES}
+            other = seconds - sum(timer.seconds.values())
+            stages["other"] = {"seconds": round(other, 6), "calls": None}
+            best = {"seconds": seconds, "blocks": len(df), "stages": stages}
+
+    result = {
+        "pages": page_count,
+        "blocks": best["blocks"],
+        "seconds": round(best["seconds"], 6),
+        "pages_per_second": round(page_count / best["seconds"], 3),
+        "stages": best["stages"],
+        "peak_traced_bytes": None,
+    }
+    if measure_memory:
+        # Separate run, tracing allocations slows down the timed ones
+        tracemalloc.start()
+        try:
+            get_pdf_extraction(pdf_fpath, kind, workers=1)
+            result["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def run(kinds, pages, repeat, seed, corpus_dir=None, measure_memory=True):
+    """ Generates the corpus and benchmarks every document of it
+    Returns:
+        dict: Benchmark report
+    """
+    with tempfile.TemporaryDirectory(prefix="pdf-parser-benchmark-") as temp_dir:
+        folder = corpus_dir or temp_dir
+        os.makedirs(folder, exist_ok=True)
+        paths = generate_corpus(folder, kinds, pages, seed)
+        timer = StageTimer()
+        documents = {}
+        for kind, pdf_fpath in paths.items():
+            logging.info(f"Benchmarking {kind}")
+            documents[kind] = benchmark_document(kind, pdf_fpath, repeat, timer, measure_memory)
+
+    total_pages = sum(document["pages"] for document in documents.values())
+    total_seconds = sum(document["seconds"] for document in documents.values())
+    stages = {stage: round(sum(document["stages"][stage]["seconds"] for document in documents.values()), 6)
+              for stage in STAGE_NAMES + ["other"]}
+    peaks = [document["peak_traced_bytes"] for document in documents.values()
+             if document["peak_traced_bytes"] is not None]
+    return {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "pymupdf": fitz.VersionBind,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "block_detector": block_detector,
+        },
+        "settings": {"kinds": kinds, "pages": pages, "repeat": repeat, "seed": seed},
+        "documents": documents,
+        "stages": stages,
+        "total": {
+            "pages": total_pages,
+            "seconds": round(total_seconds, 6),
+            "pages_per_second": round(total_pages / total_seconds, 3) if total_seconds else None,
+            "peak_traced_bytes": max(peaks, default=None),
+            "max_rss_bytes": max_rss_bytes(),
+        },
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the extraction stages on generated PDFs.")
+    parser.add_argument("--kinds", nargs="+", choices=list(CORPUS), default=list(CORPUS),
+                        help="Layouts to generate, one document each")
+    parser.add_argument("--pages", type=int, default=5, help="Pages per document")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per document, the fastest is kept")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated text")
+    parser.add_argument("--corpus-dir", help="Keep the generated PDFs in this folder")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the traced run measuring peak memory")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--log-level", default="CRITICAL", help="Logging level of the pipeline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(message)s")
+    report = run(args.kinds, max(args.pages, 1), max(args.repeat, 1), args.seed, args.corpus_dir,
+                 not args.no_memory)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
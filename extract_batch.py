@@ -0,0 +1,269 @@
+""" Command line batch extractor for backfills.
+
+Runs get_pdf_extraction over a directory tree or a manifest of PDF paths in a
+process pool, one document per task, and writes the blocks into part files
+under the output directory. Every finished file is appended to a checkpoint
+manifest (checkpoint.jsonl) with its status, timing, page selection and part, so
+a rerun with the same output directory and selection skips the files already
+done. Files done under another selection are extracted again, and the part named
+by the latest checkpoint entry of a file holds its current blocks.
+
+    python extract_batch.py archive/ out/ --workers 8
+    python extract_batch.py paths.txt out/ --format parquet
+    python extract_batch.py archive/ out/ --first-pages 5
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import pandas as pd
+
+from utils import PageSelectionError, get_pdf_extraction, parse_page_ranges
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+CHECKPOINT_NAME = "checkpoint.jsonl"
+
+
+def list_sources(source):
+    """ Absolute PDF paths of a directory tree, or of the paths listed one per
+        line in a manifest file, relative ones resolved against its folder
+    """
+    source = Path(source)
+    if source.is_dir():
+        return sorted(str(path.resolve()) for path in source.rglob("*") if path.suffix.lower() == ".pdf")
+    sources = []
+    with open(source) as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                path = Path(line)
+                sources.append(str((path if path.is_absolute() else source.parent / path).resolve()))
+    return sources
+
+
+def read_checkpoint(out_dir):
+    """ Latest checkpoint entry of every source, in file order """
+    entries = {}
+    checkpoint_path = os.path.join(out_dir, CHECKPOINT_NAME)
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted run
+                    continue
+                entries[entry["source"]] = entry
+    return entries
+
+
+def page_selection(pages=None, first_pages=None):
+    """ Page selection as recorded in the checkpoint entries """
+    return {"pages": pages, "first_pages": first_pages}
+
+
+def remove_orphan_parts(out_dir, entries):
+    """ Drops part files no latest checkpoint entry points to: parts written by
+        an interrupted run before their entries reached the checkpoint, as their
+        files will be extracted again, and parts whose files were all extracted
+        again under another page selection.
+    """
+    parts = {entry["part"] for entry in entries.values() if entry.get("part")}
+    for fname in os.listdir(out_dir):
+        if (fname.startswith("part-") and fname not in parts) or fname.startswith(".part-"):
+            os.remove(os.path.join(out_dir, fname))
+
+
+def extract_file(pdf_fpath, pages=None, first_pages=None):
+    """ Worker entry point, never raises. A page selection that does not fit
+        the pdf fails the file like any other error.
+    Returns:
+        pd.DataFrame: Blocks of the pdf, None on failure
+        str: Error message, None on success
+        float: Seconds spent
+    """
+    started_at = time.perf_counter()
+    pdf_fname = os.path.splitext(os.path.basename(pdf_fpath))[0]
+    try:
+        df = get_pdf_extraction(pdf_fpath, pdf_fname, workers=1, pages=pages, first_pages=first_pages)
+        return df, None, time.perf_counter() - started_at
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}", time.perf_counter() - started_at
+
+
+class PartWriter:
+    """ Buffers the blocks of finished files and writes them as numbered part
+        files. A part is renamed into place before the checkpoint entries of its
+        files are appended, so the checkpoint never points to a partial part.
+    """
+
+    def __init__(self, out_dir, file_format, files_per_part):
+        self.out_dir = out_dir
+        self.file_format = file_format
+        self.files_per_part = files_per_part
+        existing = [int(fname[5:10]) for fname in os.listdir(out_dir)
+                    if fname.startswith("part-") and fname[5:10].isdigit()]
+        self.next_part = max(existing, default=-1) + 1
+        self.frames, self.entries = [], []
+        self.checkpoint = open(os.path.join(out_dir, CHECKPOINT_NAME), "a+b")
+        # A line cut short by an interrupted run is ended, or the next entry would join it
+        if self.checkpoint.tell():
+            self.checkpoint.seek(-1, os.SEEK_END)
+            if self.checkpoint.read(1) != b"\n":
+                self.checkpoint.write(b"\n")
+
+    def add(self, entry, df=None):
+        if df is not None and len(df):
+            df = df.copy()
+            df.insert(0, "source", entry["source"])
+            self.frames.append(df)
+        self.entries.append(entry)
+        if len(self.entries) >= self.files_per_part:
+            self.flush()
+
+    def flush(self):
+        if not self.entries:
+            return
+        part = None
+        if self.frames:
+            part = f"part-{self.next_part:05d}.{'parquet' if self.file_format == 'parquet' else 'jsonl'}"
+            self.next_part += 1
+            data = pd.concat(self.frames, ignore_index=True)
+            temp_path = os.path.join(self.out_dir, f".{part}.tmp")
+            if self.file_format == "parquet":
+                data.to_parquet(temp_path, index=False)
+            else:
+                data.to_json(temp_path, orient="records", lines=True, force_ascii=False)
+            os.replace(temp_path, os.path.join(self.out_dir, part))
+        for entry in self.entries:
+            if entry["status"] == "done":
+                entry["part"] = part
+            self.checkpoint.write((json.dumps(entry) + "\n").encode("utf-8"))
+        self.checkpoint.flush()
+        os.fsync(self.checkpoint.fileno())
+        self.frames, self.entries = [], []
+
+    def close(self):
+        self.flush()
+        self.checkpoint.close()
+
+
+def run(sources, out_dir, workers, file_format, files_per_part, retry_failed=False, pages=None,
+        first_pages=None):
+    """ Extracts the sources not yet in the checkpoint of out_dir with the same
+        page selection
+    Args:
+        pages (str): Pages to extract of every file, see select_pages
+        first_pages (int): Only pages among the first first_pages
+    Returns:
+        dict: Run summary with counts and timings
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    entries = read_checkpoint(out_dir)
+    remove_orphan_parts(out_dir, entries)
+    finished = {"done", "failed"} if not retry_failed else {"done"}
+    selection = page_selection(pages, first_pages)
+    todo = []
+    reselected = 0
+    for source in dict.fromkeys(sources):
+        entry = entries.get(source)
+        if entry is not None and entry["status"] in finished:
+            # Entries written before the selection was recorded extracted every page
+            if all(entry.get(key) == value for key, value in selection.items()):
+                continue
+            reselected += 1
+        todo.append(source)
+    if reselected:
+        logging.warning(f"> {reselected} files in the checkpoint were extracted with another page selection, "
+                        f"extracting them again")
+    summary = {"files": len(sources), "skipped": len(sources) - len(todo), "done": 0, "failed": 0,
+               "blocks": 0, "extract_seconds": 0.0}
+    logging.info(f"{len(todo)} files to extract, {summary['skipped']} already in the checkpoint")
+
+    writer = PartWriter(out_dir, file_format, files_per_part)
+    started_at = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            source_iter = iter(todo)
+            while True:
+                # Bounded submission keeps millions of sources out of the pool queue
+                for source in source_iter:
+                    pending[executor.submit(extract_file, source, pages, first_pages)] = source
+                    if len(pending) >= workers * 4:
+                        break
+                if not pending:
+                    break
+                completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    source = pending.pop(future)
+                    df, error, seconds = future.result()
+                    entry = {"source": source, **selection, "status": "failed" if error else "done",
+                             "seconds": round(seconds, 3), "finished_at": time.time()}
+                    summary["extract_seconds"] += seconds
+                    if error:
+                        logging.error(f"> error in extracting {source}: {error}")
+                        entry["error"] = error
+                        summary["failed"] += 1
+                    else:
+                        entry["blocks"] = len(df)
+                        summary["done"] += 1
+                        summary["blocks"] += len(df)
+                    writer.add(entry, df)
+    finally:
+        # Whatever finished before an interruption is kept
+        writer.close()
+    summary["wall_seconds"] = round(time.perf_counter() - started_at, 3)
+    summary["extract_seconds"] = round(summary["extract_seconds"], 3)
+    extracted = summary["done"] + summary["failed"]
+    summary["files_per_second"] = round(extracted / summary["wall_seconds"], 3) if summary["wall_seconds"] else None
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Extract PDFs in bulk into partitioned JSONL or Parquet files.")
+    parser.add_argument("source", help="Directory searched recursively for PDFs, or a file listing one path per line")
+    parser.add_argument("out_dir", help="Output directory for part files and the checkpoint")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument("--format", choices=["auto", "jsonl", "parquet"], default="auto",
+                        help="Part file format, auto picks parquet when pyarrow is installed")
+    parser.add_argument("--files-per-part", type=int, default=500, help="Files written to each part file")
+    parser.add_argument("--pages", help='Pages to extract of every file, e.g. "1-3,7,10-"')
+    parser.add_argument("--first-pages", type=int, help="Only extract the first N pages of every file")
+    parser.add_argument("--retry-failed", action="store_true", help="Extract files that failed before again")
+    parser.add_argument("--log-level", default="WARNING", help="Logging level, INFO logs every page")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(message)s")
+    file_format = args.format
+    if file_format == "auto":
+        file_format = "parquet" if pyarrow is not None else "jsonl"
+    elif file_format == "parquet" and pyarrow is None:
+        logging.error("> Parquet output needs pyarrow, pip install pyarrow or use --format jsonl")
+        return 2
+    try:
+        if args.pages is not None:
+            parse_page_ranges(args.pages)
+    except PageSelectionError as e:
+        logging.error(f"> {e}")
+        return 2
+    summary = run(list_sources(args.source), args.out_dir, max(args.workers, 1), file_format,
+                  max(args.files_per_part, 1), args.retry_failed, args.pages, args.first_pages)
+    print(json.dumps(summary))
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,98 @@
-from fastapi import FastAPI, UploadFile
-from typing import Union
+from fastapi import FastAPI, File, HTTPException, Request, UploadFile
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from typing import List, Union
 import uvicorn
-from utils import get_pdf_extraction, temp_folder
+from utils import (DispatcherBusy, ExtractionDispatcher, JobRunner, JobStore, PageSelectionError, ResultCache,
+                   UploadTooLarge, cache_key, create_scratch_dir, get_pdf_extraction, hash_upload,
+                   iter_batch_extraction, iter_pdf_extraction, job_folder, job_workers, parse_page_ranges,
+                   remove_scratch_dir, result_cache_folder, result_cache_max_bytes, save_batch_uploads, save_upload,
+                   select_pdf_pages)
 from datetime import datetime
+import gzip
 from uuid import uuid4
 import logging
+import json
 import os
 
 app = FastAPI()
+dispatcher = ExtractionDispatcher()
+os.makedirs(job_folder, exist_ok=True)
+job_runner = JobRunner(JobStore(job_folder / "jobs.sqlite3"), workers=job_workers)
+result_cache = ResultCache(result_cache_folder, result_cache_max_bytes)
+
+
+def busy_response(error):
+    logging.error(f"> {error}")
+    return JSONResponse(status_code=503, headers={"Retry-After": str(error.retry_after)},
+                        content={"message": str(error)})
+
+
+def upload_too_large_response(error):
+    logging.error(f"> {error}")
+    return JSONResponse(status_code=413, content={"message": str(error)})
+
+
+def gzipped_json_response(request, compressed):
+    """ Sends a gzipped JSON body as is when the client accepts gzip """
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return Response(compressed, media_type="application/json", headers={"Content-Encoding": "gzip"})
+    return Response(gzip.decompress(compressed), media_type="application/json")
+
+
+def check_upload(pdf):
+    """ Name of the uploaded pdf without its extension, or the message to
+        answer with when the upload is missing or not a pdf
+    """
+    if not pdf:
+        logging.error("> error in pdf file upload")
+        return None, {"message": "No PDF file uploaded"}
+
+    pdf_fname = pdf.filename
+
+    if not pdf_fname.endswith(".pdf"):
+        logging.error("> error in pdf file upload")
+        return None, {"message": "Incorrect file uploaded"}
+    return pdf_fname[:-4], None
+
+
+def page_selection_response(error):
+    logging.error(f"> error in page selection: {error}")
+    return JSONResponse(status_code=422, content={"message": str(error)})
+
+
+def check_page_selection(pages, first_pages):
+    """ 422 response when the page selection is malformed, else None """
+    try:
+        if pages is not None:
+            parse_page_ranges(pages)
+        if first_pages is not None and first_pages < 1:
+            raise PageSelectionError("first_pages has to be at least 1")
+    except PageSelectionError as e:
+        return page_selection_response(e)
+    return None
+
+
+def page_selection(pages, first_pages):
+    """ Cache key settings of a page selection, none for whole documents """
+    return {name: value for name, value in (("pages", pages), ("first_pages", first_pages)) if value is not None}
+
+
+def check_pdf_pages(pdf_fpath, pages, first_pages):
+    """ 422 response when the page selection does not fit the saved pdf, e.g.
+        pages past its end, else None. A pdf that cannot be opened is left to
+        the extraction to report.
+    """
+    if pages is None and first_pages is None:
+        return None
+    try:
+        select_pdf_pages(pdf_fpath, pages, first_pages)
+    except PageSelectionError as e:
+        return page_selection_response(e)
+    except Exception:
+        return None
+    return None
 
 
 @app.get("/")
@@ -23,40 +108,304 @@ def check_health() -> dict:
     return {"status": "OK"}
 
 
+@app.get("/stats")
+def get_stats() -> dict:
+    """
+    Extraction queue depth, in-flight counts and result cache usage
+    """
+    return {"dispatcher": dispatcher.stats(), "result_cache": result_cache.stats()}
+
+
 @app.post("/extract_pdf")
-async def extract_pdf(pdf: Union[UploadFile, None] = None) -> dict:
+async def extract_pdf(request: Request, pdf: Union[UploadFile, None] = None, pages: Union[str, None] = None,
+                      first_pages: Union[int, None] = None):
     """
-    Extracts pdf to parent-child relationships
+    Extracts pdf to parent-child relationships. pages ("1-3,7,10-") or
+    first_pages limit the extraction, and the hierarchy, to those pages.
     """
     logging.basicConfig(filename="parser_app.log", level=logging.DEBUG)
     logging.info(f"Started at {str(datetime.now())}")
 
-    if not pdf:
-        logging.error("> error in pdf file upload")
-        return {"message": "No PDF file uploaded"}
+    pdf_fname, error = check_upload(pdf)
+    if error is None:
+        error = check_page_selection(pages, first_pages)
+    if error is not None:
+        return error
 
-    pdf_fname = pdf.filename
+    # A cached result is sent without opening the pdf or taking a dispatcher place
+    try:
+        pdf_hash, pdf_size = await run_in_threadpool(hash_upload, pdf.file)
+    except UploadTooLarge as e:
+        return upload_too_large_response(e)
+    key = cache_key(pdf_hash, **page_selection(pages, first_pages))
+    compressed = await run_in_threadpool(result_cache.get, key, pdf_size)
+    if compressed is not None:
+        logging.info(f"Served {pdf_fname} from the result cache")
+        return gzipped_json_response(request, compressed)
 
-    if not pdf_fname.endswith(".pdf"):
-        logging.error("> error in pdf file upload")
-        return {"message": "Incorrect file uploaded"}
-    else:
-        pdf_fname = pdf_fname[:-4]
+    try:
+        admission = dispatcher.admit()
+    except DispatcherBusy as e:
+        return busy_response(e)
 
-    temp_pdf_file = os.path.join(temp_folder, f"{uuid4()}.pdf")
+    scratch_dir = create_scratch_dir()
+    try:
+        pdf_fpath = os.path.join(scratch_dir, "upload.pdf")
+        await run_in_threadpool(save_upload, pdf.file, pdf_fpath)
+        error = await run_in_threadpool(check_pdf_pages, pdf_fpath, pages, first_pages)
+        if error is not None:
+            return error
+        df_result = await dispatcher.run(get_pdf_extraction, pdf_fpath, pdf_fname, None, pages, first_pages,
+                                         admission=admission)
+    finally:
+        # Releases the place if the upload failed before the extraction ran
+        admission.release(failed=True)
+        remove_scratch_dir(scratch_dir)
+    body = JSONResponse(df_result.to_dict(orient="records")).body
+    compressed = await run_in_threadpool(result_cache.put, key, body)
 
-    with open(temp_pdf_file, "wb") as file:
-        file.write(pdf.file.read())
+    logging.info(f"Ended at {str(datetime.now())}")
 
-    df_result = get_pdf_extraction(temp_pdf_file, pdf_fname)
-    dict_result = df_result.to_dict(orient="records")
+    return gzipped_json_response(request, compressed)
 
-    for f in os.listdir(temp_folder):
-        os.remove(os.path.join(temp_folder, f))
 
-    logging.info(f"Ended at {str(datetime.now())}")
+def stream_extraction(pdf_fpath, pdf_fname, pages=None, first_pages=None):
+    """ NDJSON lines of the extraction. The blocks of every page are sent as
+        soon as they are final, followed by a progress line for the page. With
+        a page selection, page_no and page_count count the selected pages.
+    """
+    block_count = 0
+    try:
+        for page_no, page_count, blocks in iter_pdf_extraction(pdf_fpath, pdf_fname, None, pages, first_pages):
+            for block in blocks.to_dict(orient="records"):
+                yield json.dumps({"event": "block", **block}) + "\n"
+            block_count += len(blocks)
+            yield json.dumps({"event": "progress", "page_no": page_no, "page_count": page_count,
+                              "block_count": block_count}) + "\n"
+        yield json.dumps({"event": "done", "block_count": block_count}) + "\n"
+    except Exception as e:
+        logging.error(f"> error in streaming extraction of {pdf_fname}: {e}")
+        yield json.dumps({"event": "error", "message": str(e)}) + "\n"
+    finally:
+        logging.info(f"Ended at {str(datetime.now())}")
+
+
+@app.post("/extract_pdf_stream")
+async def extract_pdf_stream(pdf: Union[UploadFile, None] = None, pages: Union[str, None] = None,
+                             first_pages: Union[int, None] = None):
+    """
+    Streams pdf extraction as NDJSON, page by page
+    """
+    logging.basicConfig(filename="parser_app.log", level=logging.DEBUG)
+    logging.info(f"Started at {str(datetime.now())}")
+
+    pdf_fname, error = check_upload(pdf)
+    if error is None:
+        error = check_page_selection(pages, first_pages)
+    if error is not None:
+        return error
+
+    try:
+        admission = dispatcher.admit()
+    except DispatcherBusy as e:
+        return busy_response(e)
+
+    scratch_dir = create_scratch_dir()
+    try:
+        pdf_fpath = os.path.join(scratch_dir, "upload.pdf")
+        await run_in_threadpool(save_upload, pdf.file, pdf_fpath)
+        error = await run_in_threadpool(check_pdf_pages, pdf_fpath, pages, first_pages)
+    except UploadTooLarge as e:
+        error = upload_too_large_response(e)
+    except Exception:
+        admission.release(failed=True)
+        remove_scratch_dir(scratch_dir)
+        raise
+    if error is not None:
+        admission.release(failed=True)
+        remove_scratch_dir(scratch_dir)
+        return error
+
+    return dispatched_stream(admission, scratch_dir, stream_extraction, pdf_fpath, pdf_fname, pages, first_pages)
+
+
+def dispatched_stream(admission, scratch_dir, gen_fn, *args):
+    """ NDJSON response over gen_fn(*args), run in a dispatcher slot. The
+        place and the scratch directory are released when the stream ends.
+    """
+    def cleanup():
+        # The stream releases its place itself, unless it never ran to the end
+        admission.release(failed=True)
+        remove_scratch_dir(scratch_dir)
+
+    def stream_body():
+        try:
+            yield from dispatcher.stream(admission, gen_fn, *args)
+        finally:
+            cleanup()
+
+    # The background task covers a stream that was never iterated
+    return StreamingResponse(stream_body(), media_type="application/x-ndjson",
+                             background=BackgroundTask(cleanup))
+
+
+def document_line(index, pdf_fname, body):
+    """ NDJSON line of one batch document. body is the JSON block list as
+        /extract_pdf sends it, embedded without parsing it again.
+    """
+    head = json.dumps({"event": "document", "index": index, "pdf_name": pdf_fname})
+    return head[:-1] + ', "blocks": ' + body.decode("utf-8") + "}\n"
+
+
+def stream_batch_extraction(documents, pages=None, first_pages=None):
+    """ NDJSON lines of a batch, one per document as soon as it is done, with
+        cached documents first. Documents that fail, or that the page selection
+        does not fit, get an error line.
+    """
+    def error_line(index, pdf_fname, message):
+        return json.dumps({"event": "error", "index": index, "pdf_name": pdf_fname, "message": message}) + "\n"
+
+    failed = 0
+    pending, keys = [], []
+    try:
+        for index, (pdf_fname, pdf_fpath, error) in enumerate(documents):
+            if error is not None:
+                failed += 1
+                yield error_line(index, pdf_fname, error)
+                continue
+            with open(pdf_fpath, "rb") as file:
+                pdf_hash, pdf_size = hash_upload(file)
+            key = cache_key(pdf_hash, **page_selection(pages, first_pages))
+            compressed = result_cache.get(key, pdf_size)
+            if compressed is not None:
+                yield document_line(index, pdf_fname, gzip.decompress(compressed))
+                continue
+            pending.append((index, pdf_fpath, pdf_fname))
+            keys.append(key)
+
+        pdf_files = [(pdf_fpath, pdf_fname) for _, pdf_fpath, pdf_fname in pending]
+        for position, blocks, error in iter_batch_extraction(pdf_files, None, pages, first_pages):
+            index, _, pdf_fname = pending[position]
+            if error is not None:
+                failed += 1
+                yield error_line(index, pdf_fname, error)
+                continue
+            body = JSONResponse(blocks.to_dict(orient="records")).body
+            result_cache.put(keys[position], body)
+            yield document_line(index, pdf_fname, body)
+        yield json.dumps({"event": "done", "documents": len(documents), "failed": failed}) + "\n"
+    except Exception as e:
+        logging.error(f"> error in batch extraction: {e}")
+        yield json.dumps({"event": "error", "index": None, "message": str(e)}) + "\n"
+    finally:
+        logging.info(f"Ended at {str(datetime.now())}")
+
+
+@app.post("/extract_pdf_batch")
+async def extract_pdf_batch(pdfs: List[UploadFile] = File(...), pages: Union[str, None] = None,
+                            first_pages: Union[int, None] = None):
+    """
+    Extracts several pdfs, or the pdfs of zip archives, in one request. Pages of
+    all documents share the worker pool, results stream back as NDJSON per document.
+    pages and first_pages select the same pages of every document.
+    """
+    logging.basicConfig(filename="parser_app.log", level=logging.DEBUG)
+    logging.info(f"Started at {str(datetime.now())}")
+
+    error = check_page_selection(pages, first_pages)
+    if error is not None:
+        return error
+
+    try:
+        admission = dispatcher.admit()
+    except DispatcherBusy as e:
+        return busy_response(e)
+
+    scratch_dir = create_scratch_dir()
+    try:
+        documents = await run_in_threadpool(save_batch_uploads, [(pdf.filename, pdf.file) for pdf in pdfs],
+                                            scratch_dir)
+    except Exception:
+        admission.release(failed=True)
+        remove_scratch_dir(scratch_dir)
+        raise
+
+    return dispatched_stream(admission, scratch_dir, stream_batch_extraction, documents, pages, first_pages)
+
+
+@app.post("/jobs")
+async def create_job(pdf: Union[UploadFile, None] = None, pages: Union[str, None] = None,
+                     first_pages: Union[int, None] = None) -> dict:
+    """
+    Queues a pdf for extraction in the background and returns its job id
+    """
+    pdf_fname, error = check_upload(pdf)
+    if error is None:
+        error = check_page_selection(pages, first_pages)
+    if error is not None:
+        return error
+
+    job_pdf_file = os.path.join(job_folder, f"{uuid4()}.pdf")
+    try:
+        await run_in_threadpool(save_upload, pdf.file, job_pdf_file)
+    except UploadTooLarge as e:
+        return upload_too_large_response(e)
+    error = await run_in_threadpool(check_pdf_pages, job_pdf_file, pages, first_pages)
+    if error is not None:
+        os.remove(job_pdf_file)
+        return error
+
+    job_id = job_runner.store.create_job(pdf_fname, job_pdf_file, pages, first_pages)
+    job_runner.submit(job_id)
+    return {"job_id": job_id, "status": "queued"}
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str) -> dict:
+    """
+    Status and page progress of a job
+    """
+    job = job_runner.store.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    del job["pdf_path"]
+    return job
+
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str, offset: int = 0, limit: int = 1000) -> dict:
+    """
+    Pages through the blocks of a job. Blocks of a running job are final as
+    soon as they are listed.
+    """
+    job = job_runner.store.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    offset, limit = max(offset, 0), min(max(limit, 1), 10000)
+    blocks = job_runner.store.get_blocks(job_id, offset, limit)
+    next_offset = offset + len(blocks)
+    has_more = next_offset < job["block_count"] or job["status"] in ("queued", "running")
+    return {
+        "job_id": job_id,
+        "status": job["status"],
+        "block_count": job["block_count"],
+        "offset": offset,
+        "next_offset": next_offset if has_more else None,
+        "blocks": blocks,
+    }
+
+
+@app.on_event("startup")
+def restart_jobs():
+    job_ids = job_runner.restart_unfinished()
+    if job_ids:
+        logging.info(f"Restarted jobs {job_ids}")
+
 
-    return dict_result
+@app.on_event("shutdown")
+def shutdown_dispatcher():
+    dispatcher.shutdown()
+    job_runner.shutdown()
 
 
 if __name__ == "__main__":
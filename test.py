@@ -1,4 +1,58 @@
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
 import unittest
+from unittest import mock
+
+import asyncio
+import functools
+import hashlib
+import io
+import zipfile
+import gzip
+import json
+from pathlib import Path
+
+import extract_batch
+import fitz
+import numpy as np
+import pandas as pd
+from bs4 import BeautifulSoup
+
+from utils.dispatcher import DispatcherBusy, ExtractionDispatcher
+from utils.doc_session import DocumentSession
+from utils.geometry import overlap_components
+from utils.ocr import OCREnginePool, parse_hocr
+from utils.job_store import DONE, RUNNING, JobRunner, JobStore, process_token
+from utils.page_process import PageProcessor
+from utils.pc_relation import RELATION_COLUMNS, HierarchyBuilder, PCRelationGen, clean_unicode, depthCalculator, style2int
+from utils.pdf_process import get_page_dpi
+from utils.text_extract import TextExtractor
+from utils.uploads import UploadTooLarge, hash_upload, save_batch_uploads, save_upload
+from utils.result_cache import ResultCache, cache_key
+from utils.pdf_parse import (PageSelectionError, get_pdf_extraction, iter_batch_extraction, iter_pdf_extraction,
+                             merge_continued_paragraphs, parse_page_ranges, select_pages)
+
+
+def make_text_pdf(fpath, page_count):
+    """ Pdf with a bold heading and a paragraph on every page """
+    doc = fitz.open()
+    for page_no in range(page_count):
+        page = doc.newPage()
+        page.insertText((72, 90), f"Section {page_no + 1}", fontsize=14, fontname="hebo")
+        page.insertTextbox(fitz.Rect(72, 110, 520, 200), f"Body text of page {page_no + 1}. " * 8, fontsize=10)
+    doc.save(fpath)
+    doc.close()
+
+
+def without_images(page_dict):
+    return [block for block in page_dict["blocks"] if "image" not in block]
 
 
 class MyTestCase(unittest.TestCase):
@@ -6,5 +60,1265 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(True, True)
 
 
+class DocumentSessionTestCase(unittest.TestCase):
+    FONT_FILE = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+    def test_views_match_direct_extraction(self):
+        with tempfile.TemporaryDirectory() as folder:
+            pdf_fpath = os.path.join(folder, "ligatures.pdf")
+            doc = fitz.open()
+            page = doc.newPage()
+            # Ligatures and no-break spaces are where the extraction flags matter
+            font = {"fontname": "dv", "fontfile": self.FONT_FILE} if os.path.exists(self.FONT_FILE) else {}
+            page.insertText((72, 90), "Ofﬁcial ﬁnance ﬂows\xa0and\ttabs", fontsize=12, **font)
+            page.insertTextbox(fitz.Rect(72, 110, 520, 300), "The ﬁrst ﬂoor ﬁgures. " * 10, fontsize=10, **font)
+            page.insertImage(fitz.Rect(400, 400, 500, 500), pixmap=fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 8, 8)))
+            doc.save(pdf_fpath)
+            doc.close()
+
+            session = DocumentSession(pdf_fpath)
+            try:
+                page = session.doc[0]
+                self.assertEqual(without_images(session.get_dict(page)), without_images(page.getText("dict")))
+                self.assertEqual(session.get_rawdict(page)["blocks"], page.getTextPage().extractRAWDICT()["blocks"])
+                self.assertEqual(session.get_text(page), page.getText())
+                session.release(page)
+                self.assertEqual(without_images(session.get_dict(page)), without_images(page.getText("dict")))
+            finally:
+                session.close()
+
+
+class DifferentialTestCase(unittest.TestCase):
+    """ Checks a rewrite against the implementation it replaced, which the test
+        case keeps, first on hand-written edge cases, then on seeded random inputs
+    """
+    SEEDS = range(30)
+
+    def assert_cases(self, check, cases, random_case):
+        """
+        Args:
+            check (function): Asserts that both implementations agree on one input
+            cases (dict): Hand-written inputs by name
+            random_case (function): Builds an input from a np.random.RandomState
+        """
+        for name, case in cases.items():
+            with self.subTest(case=name):
+                check(case)
+        for seed in self.SEEDS:
+            with self.subTest(seed=seed):
+                check(random_case(np.random.RandomState(seed)))
+
+
+def random_boxes(rs, count, max_x=500, max_y=700, max_width=200, max_height=40):
+    """ x1, y1, x2, y2 columns of count boxes on integer coordinates, some with no width or height """
+    x1, y1 = rs.randint(0, max_x, count).astype(float), rs.randint(0, max_y, count).astype(float)
+    return {"x1": x1, "y1": y1, "x2": x1 + rs.randint(0, max_width + 1, count),
+            "y2": y1 + rs.randint(0, max_height + 1, count)}
+
+
+def blocks_frame(rows, columns):
+    """ Hand-written blocks, rows of the given columns """
+    return pd.DataFrame(rows, columns=columns).astype({col: float for col in ("x1", "y1", "x2", "y2")
+                                                       if col in columns})
+
+
+class OverlapComponentsTestCase(DifferentialTestCase):
+    COLUMNS = ["x1", "y1", "x2", "y2", "block_num", "label"]
+    CASES = {
+        "empty": blocks_frame([], COLUMNS),
+        "single": blocks_frame([(0, 0, 10, 10, 0, "text")], COLUMNS),
+        "shared edge": blocks_frame([(0, 0, 10, 10, 0, "text"), (10, 0, 20, 10, 1, "text")], COLUMNS),
+        "chain": blocks_frame([(0, 0, 10, 10, 0, "text"), (30, 0, 40, 10, 1, "table_image"),
+                               (8, 0, 18, 10, 2, "text"), (16, 0, 32, 10, 3, "text")], COLUMNS),
+        "nested and degenerate": blocks_frame([(0, 0, 100, 100, 0, "text"), (10, 10, 20, 20, 1, "text"),
+                                               (50, 50, 50, 50, 2, "text")], COLUMNS),
+    }
+
+    @staticmethod
+    def pairwise_components(rects):
+        """ Clusters from fitz.Rect.intersects on every pair, numbered by their first rect """
+        components = [-1] * len(rects)
+        count = 0
+        for start in range(len(rects)):
+            if components[start] >= 0:
+                continue
+            components[start] = count
+            stack = [start]
+            while stack:
+                i = stack.pop()
+                for j, rect in enumerate(rects):
+                    if components[j] < 0 and rects[i].intersects(rect):
+                        components[j] = count
+                        stack.append(j)
+            count += 1
+        return components
+
+    @staticmethod
+    def random_blocks(rs):
+        count = rs.randint(1, 60)
+        return pd.DataFrame({**random_boxes(rs, count, max_width=80), "block_num": np.arange(count),
+                             "label": rs.choice(["text", "table_image"], count)})
+
+    @staticmethod
+    def rects(blocks):
+        return [fitz.Rect(box) for box in blocks[["x1", "y1", "x2", "y2"]].to_numpy()]
+
+    def test_matches_pairwise_intersects(self):
+        def check(blocks):
+            boxes = blocks[["x1", "y1", "x2", "y2"]].to_numpy(dtype=np.float64)
+            self.assertEqual(overlap_components(boxes).tolist(), self.pairwise_components(self.rects(blocks)))
+        self.assert_cases(check, self.CASES, self.random_blocks)
+
+    def test_merge_overlapping_bbox(self):
+        extractor = PageProcessor().txt_extractor
+
+        def check(blocks):
+            rects = self.rects(blocks)
+            components = self.pairwise_components(rects)
+            expected = []
+            for component in range(len(set(components))):
+                members = [i for i, other in enumerate(components) if other == component]
+                rect = fitz.Rect(rects[members[0]])
+                for i in members[1:]:
+                    rect.includeRect(rects[i])
+                expected.append(list(rect) + blocks.loc[members[0], ["block_num", "label"]].tolist())
+            merged = extractor.merge_overlapping_bbox(blocks.copy())
+            self.assertEqual(merged[self.COLUMNS].values.tolist(), expected)
+        self.assert_cases(check, self.CASES, self.random_blocks)
+
+
+class PageBreakTestCase(DifferentialTestCase):
+    COLUMNS = ["y1", "y2", "label", "intersection"]
+    CASES = {
+        "empty": blocks_frame([], COLUMNS),
+        "single": blocks_frame([(10, 20, "text", 0)], COLUMNS),
+        "tables only": blocks_frame([(10, 20, "table_image", 0), (15, 30, "table_html", 0)], COLUMNS),
+        "tied y1": blocks_frame([(10, 20, "text", 0), (10, 12, "title", 0), (10, 10, "table_image", 0),
+                                 (40, 50, "text", 0), (10, 20, "text", 0)], COLUMNS),
+        "columns below a heading": blocks_frame([(0, 5, "title", 0), (10, 50, "text", 0), (12, 48, "text", 0),
+                                                 (60, 70, "text", 0)], COLUMNS),
+    }
+
+    @staticmethod
+    def resorting_add_pagebreak(data_df):
+        """ add_pagebreak before the sweep, which sorted by y1 once per text block """
+        for index, row in data_df.iterrows():
+            if row["label"] == "table_image" or row["label"] == "table_html":
+                continue
+            y1 = row["y1"]
+            y2 = row["y2"]
+            newdf = data_df[data_df.apply(lambda x: (x["y1"] <= y2 and x["y2"] >= y1), axis=1)]
+            if len(newdf.index) > 1:
+                data_df.loc[index, "intersection"] = 1
+            cur = 0
+            segment = 0
+            data_df.sort_values(by=["y1"], ascending=[True], inplace=True)
+            for index1, row1 in data_df.iterrows():
+                if row1["label"] == "table_image" or row1["label"] == "table_html":
+                    data_df.loc[index1, "multicolumn"] = segment
+                    continue
+                if row1["intersection"] != cur:
+                    segment += 1
+                    cur = row1["intersection"]
+                data_df.loc[index1, "multicolumn"] = segment
+        return data_df
+
+    @staticmethod
+    def random_blocks(rs):
+        # Few distinct y values, so blocks tie and quicksort permutes them
+        count = rs.randint(2, 40)
+        boxes = random_boxes(rs, count, max_y=15, max_height=3)
+        return pd.DataFrame({"y1": boxes["y1"], "y2": boxes["y2"],
+                             "label": rs.choice(["text", "text", "title", "table_image"], count),
+                             "intersection": 0}, index=rs.permutation(count) + 100)
+
+    def test_repeated_sort_order(self):
+        repeated_sort_order = PageProcessor()._PageProcessor__repeated_sort_order
+        rs = np.random.RandomState(0)
+        for count in [1, 5, 17, 64, 300]:
+            values = rs.randint(0, 10, count).astype(float)
+            order = np.arange(count)
+            for times in range(1, 8):
+                order = order[np.argsort(values[order], kind="quicksort")]
+                np.testing.assert_array_equal(repeated_sort_order(values, times), order, err_msg=(count, times))
+
+    def test_matches_resorting_add_pagebreak(self):
+        page_proc = PageProcessor()
+
+        def check(blocks):
+            expected = self.resorting_add_pagebreak(blocks.copy())
+            if "multicolumn" in expected:
+                expected["multicolumn"] = expected["multicolumn"].astype(np.int64)
+            pd.testing.assert_frame_equal(page_proc.add_pagebreak(blocks.copy()), expected)
+        self.assert_cases(check, self.CASES, self.random_blocks)
+
+
+class BlockWidthTestCase(DifferentialTestCase):
+    COLUMNS = ["x1", "y1", "x2", "y2", "label"]
+    CASES = {
+        "single": blocks_frame([(50, 100, 250, 112, "text")], COLUMNS),
+        "figures only": blocks_frame([(50, 100, 250, 112, "figure"), (55, 200, 120, 212, "table"),
+                                      (400, 100, 500, 112, "text")], COLUMNS),
+        "tied x1": blocks_frame([(50, 300, 250, 312, "text"), (50, 100, 150, 112, "title"),
+                                 (50, 100, 90, 112, "text")], COLUMNS),
+        "gaps at the limits": blocks_frame([(0, 0, 10, 12, "text"), (50, 10, 70, 22, "text"),
+                                            (101, 21, 200, 33, "text")], COLUMNS),
+    }
+
+    class RowwisePageProcessor:
+        """ Column grouping and width normalization before they were vectorized """
+
+        def create_coord_groups(self, col, max_diff):
+            col = col.sort_values(ascending=True)
+            self.group_no = 0
+
+            def group(diff):
+                if diff > max_diff:
+                    self.group_no += 1
+                return self.group_no
+            return (col - col.shift(1)).apply(group)
+
+        def normalize_block_width(self, part_df):
+            part_df["col_no"] = self.create_coord_groups(part_df["x1"], 50)
+            part_df["quant_y"] = self.create_coord_groups(part_df["y1"], 10)
+            part_df["cv_rect_width"] = (part_df["x2"] - part_df["x1"]).abs()
+            part_df.sort_values(by="col_no", ascending=True, inplace=True)
+            norm_boxes = part_df[["x1", "y1", "x2", "y2"]].to_numpy(dtype=np.float64)
+            for pos, (index, x) in enumerate(part_df["col_no"].iteritems()):
+                max_width = part_df[(part_df["col_no"] == x) & (part_df["label"] != "figure")
+                                    & (part_df["label"] != "table")]["cv_rect_width"].mean()
+                if not np.isnan(max_width):
+                    norm_boxes[pos, 2] = part_df.at[index, "x1"] + max_width
+            for col, values in zip(["norm_x1", "norm_y1", "norm_x2", "norm_y2"], norm_boxes.T):
+                part_df[col] = values
+            return part_df
+
+    @staticmethod
+    def random_blocks(rs):
+        count = rs.randint(1, 40)
+        boxes = random_boxes(rs, count, max_height=12)
+        # Columns far apart, a few blocks of only figures and tables
+        x1 = rs.choice([50.0, 60.0, 300.0, 320.0, 600.0], count) + rs.rand(count) * 20
+        return pd.DataFrame({"x1": x1, "y1": boxes["y1"], "x2": x1 + boxes["x2"] - boxes["x1"], "y2": boxes["y2"],
+                             "label": rs.choice(["text", "title", "figure", "table"], count)},
+                            index=rs.permutation(count))
+
+    def test_matches_rowwise_normalization(self):
+        page_proc = PageProcessor()
+        rowwise = self.RowwisePageProcessor()
+
+        def check(part_df):
+            pd.testing.assert_frame_equal(page_proc.normalize_block_width(part_df.copy()),
+                                          rowwise.normalize_block_width(part_df.copy()))
+        self.assert_cases(check, self.CASES, self.random_blocks)
+
+
+class ContinuedParagraphTestCase(DifferentialTestCase):
+    COLUMNS = ["text", "label", "merge_next", "page_no", "x1", "y1", "x2", "y2"]
+    WORDS = ["The table", "continues here", "and ends.", "1990 figures", "", "Überblick", "über alles", "(see"]
+    CASES = {
+        "empty": blocks_frame([], COLUMNS),
+        "single": blocks_frame([("continues here", "text", True, 1, 0, 0, 10, 10)], COLUMNS),
+        "title in between": blocks_frame([("The table", "text", True, 1, 0, 0, 10, 10),
+                                          ("Results", "title", False, 1, 0, 20, 10, 30),
+                                          ("continues here", "text", True, 1, 0, 40, 10, 50)], COLUMNS),
+        "across pages": blocks_frame([("The table", "text", True, 1, 300, 600, 500, 700),
+                                      ("continues here", "text", True, 2, 50, 40, 250, 90),
+                                      ("über alles", "list", False, 2, 40, 100, 260, 120),
+                                      ("and ends.", "text", False, 2, 0, 130, 10, 140)], COLUMNS),
+        "empty text": blocks_frame([("The table", "text", True, 1, 0, 0, 10, 10),
+                                    ("", "text", True, 1, 0, 20, 10, 30),
+                                    ("continues here", "text", False, 1, 0, 40, 10, 50)], COLUMNS),
+    }
+
+    @staticmethod
+    def rowwise_merge(pdf_data):
+        """ Paragraph merging before the runs, one block at a time """
+        pdf_data["to_delete"] = False
+        prev_row = pd.Series(dtype=object)
+        prev_ind = -1
+        for ind, row in pdf_data.iterrows():
+            if row["label"] == "title":
+                prev_row = pd.Series(dtype=object)
+                prev_ind = -1
+                continue
+            if (not prev_row.empty and prev_row["merge_next"] == True and len(row["text"]) > 0
+                    and row["text"][0].islower() and row["text"][0].isalnum()):
+                pdf_data.at[ind, "to_delete"] = True
+                pdf_data.at[prev_ind, "text"] = pdf_data.loc[prev_ind]["text"] + " " + row["text"]
+                if prev_row["page_no"] == row["page_no"]:
+                    pdf_data.at[prev_ind, "x1"] = min(row["x1"], prev_row["x1"])
+                    pdf_data.at[prev_ind, "y1"] = min(row["y1"], prev_row["y1"])
+                    pdf_data.at[prev_ind, "x2"] = max(row["x2"], prev_row["x2"])
+                    pdf_data.at[prev_ind, "y2"] = max(row["y2"], prev_row["y2"])
+                if not row["merge_next"]:
+                    prev_row = row
+                    prev_ind = ind
+            else:
+                prev_row = row
+                prev_ind = ind
+        pdf_data = pdf_data[~pdf_data["to_delete"]].drop(columns="to_delete")
+        return pdf_data.reset_index(drop=True)
+
+    def random_blocks(self, rs):
+        count = rs.randint(1, 40)
+        label = rs.choice(["text", "text", "title", "list"], count)
+        pdf_data = pd.DataFrame({"text": rs.choice(self.WORDS, count), "label": label,
+                                 "merge_next": rs.rand(count) < 0.6, "page_no": np.sort(rs.randint(1, 4, count)),
+                                 **random_boxes(rs, count, max_x=300)})
+        # Titles never stay open
+        pdf_data.loc[pdf_data["label"] == "title", "merge_next"] = False
+        return pdf_data
+
+    def test_matches_rowwise_merge(self):
+        def check(pdf_data):
+            merged = merge_continued_paragraphs(pdf_data.copy())
+            expected = self.rowwise_merge(pdf_data.copy())
+            columns = ["text", "label", "merge_next", "page_no"]
+            pd.testing.assert_frame_equal(merged[columns], expected[columns])
+            # The head box grows over every continuation on its page, not only the last one
+            self.assertTrue((merged[["x1", "y1"]] <= expected[["x1", "y1"]]).all(axis=None))
+            self.assertTrue((merged[["x2", "y2"]] >= expected[["x2", "y2"]]).all(axis=None))
+        self.assert_cases(check, self.CASES, self.random_blocks)
+
+
+class HierarchyTestCase(DifferentialTestCase):
+    # Blocks as (labels, sizes, styles, texts), cut into pages at the given positions
+    CASES = {
+        "no blocks": ([], [], [], [], []),
+        "text before any title": (["text", "table", "table_image", "list"], [10.0] * 4, ["normal"] * 4,
+                                  ["body"] * 4, [2]),
+        "repeated title": (["title", "text", "title", "text"], [14.0, 10.0, 14.0, 10.0], ["bold"] * 4,
+                           ["Introduction", "body", "Introduction", "body"], [2]),
+        "upper case ranks apart": (["title", "title", "title", "text"], [14.0, 14.0, 14.0, 10.0], ["bold"] * 4,
+                                   ["INTRODUCTION", "Introduction", "INTRODUCTION", "body"], [1, 3]),
+        "smaller then bigger": (["title", "title", "text", "title", "text"], [12.0, 10.0, 10.0, 18.0, 10.0],
+                                ["bold", "italic", "normal", "bold", "normal"], ["Part", "Section", "body",
+                                                                                 "Chapter", "body"], []),
+        "missing sizes": (["title"] * 5 + ["text"], [np.nan, 14.0, np.nan, 14.0, 12.0, 10.0], ["bold"] * 6,
+                          ["Part", "Part", "Part", "Part", "Section", "body"], [3]),
+    }
+
+    class LinearDepthCalculator:
+        """ depthCalculator before the level index, scanning the open levels per title """
+
+        def __init__(self):
+            self.stack = []
+            self.parent_holder = {}
+            self.depth = 0
+
+        def add_title(self, style, size, is_upper, parent_id):
+            index = -1
+            for ind, item in enumerate(self.stack):
+                if item[1] < size:
+                    index = ind
+                    break
+                elif item == [style, size, is_upper]:
+                    index = ind
+                    break
+            if index != -1:
+                self.stack = self.stack[:index]
+            self.stack.append([style, size, is_upper])
+            self.depth = len(self.stack) - 1
+            self.parent_holder[self.depth] = parent_id
+            return -1 if self.depth == 0 else self.parent_holder[self.depth - 1], self.depth
+
+        def get_parent_and_depth(self):
+            if len(self.parent_holder) == 0:
+                return -1, 0
+            return self.parent_holder[self.depth], self.depth + 1
+
+    @staticmethod
+    def clean_each(texts):
+        """ Escape resolution before clean_unicode, one text at a time """
+        return [bytes(text.replace("\\N", "").encode("ascii", "backslashreplace").decode("ascii"),
+                      "ascii").decode("unicode-escape") for text in texts]
+
+    @staticmethod
+    def rowwise_hierarchy(labels, sizes, styles, texts):
+        """ Parents and depths as generate_relationship assigned them row by row """
+        dc = HierarchyTestCase.LinearDepthCalculator()
+        parent_id, depth = -1, -1
+        prev_table_parent_depth = [-1, -1]
+        parent_ids, depths = [], []
+        for block_id, (label, size, style, text) in enumerate(zip(labels, sizes, styles, texts)):
+            if label == "table_image":
+                parent_id, depth = prev_table_parent_depth
+            elif label == "text" or label == "table":
+                parent_id, depth = dc.get_parent_and_depth()
+                prev_table_parent_depth = [parent_id, depth]
+            elif label == "title":
+                parent_id, depth = dc.add_title(style2int[style], size, text.isupper(), block_id)
+            parent_ids.append(parent_id)
+            depths.append(depth)
+        return parent_ids, depths
+
+    @staticmethod
+    def random_blocks(rs):
+        count = rs.randint(1, 80)
+        return (rs.choice(["title", "title", "text", "table", "table_image", "list"], count),
+                rs.choice([10.0, 12.0, 14.0, 18.0, np.nan], count, p=[0.3, 0.3, 0.2, 0.15, 0.05]),
+                rs.choice(["normal", "bold", "italic", "bold-italic"], count),
+                rs.choice(["INTRODUCTION", "Introduction", "body"], count), rs.randint(0, count, 3))
+
+    def test_clean_unicode(self):
+        cases = [["plain", "café", "line\\nbreak", "tab\there"], ["naïve – “quoted”", "\\N removed\\N"],
+                 ["odd\\", "next"], ["nul\0inside", "x"], ["\\x41\\101", ""], ["bad \\x4"], []]
+        for texts in cases:
+            try:
+                expected = self.clean_each(texts)
+            except UnicodeDecodeError:
+                with self.assertRaises(UnicodeDecodeError, msg=texts):
+                    clean_unicode(texts)
+                continue
+            self.assertEqual(clean_unicode(texts), expected, msg=texts)
+
+    def test_matches_linear_levels(self):
+        def check(titles):
+            linear, indexed = self.LinearDepthCalculator(), depthCalculator()
+            # Sizes arrive as numpy scalars, so no two NaN sizes are the same object
+            for block_id, (style, size, is_upper) in enumerate(titles):
+                size = np.float64(size)
+                self.assertEqual(indexed.add_title(style, size, is_upper, block_id, ""),
+                                 linear.add_title(style, size, is_upper, block_id))
+                self.assertEqual(indexed.stack, linear.stack)
+                self.assertEqual(indexed.get_parent_and_depth(), linear.get_parent_and_depth())
+
+        def random_titles(rs):
+            count = rs.randint(1, 400)
+            # Many sizes, so deep stacks open and close
+            sizes = np.where(rs.rand(count) < 0.03, np.nan, rs.randint(6, 40, count) / 2)
+            return list(zip(rs.randint(0, 4, count), sizes, rs.rand(count) < 0.3))
+        cases = {"deepening": [(3, size, False) for size in range(30, 5, -1)],
+                 "same level again": [(3, 14.0, False), (0, 12.0, False), (2, 12.0, False), (0, 12.0, False),
+                                      (0, 12.0, True), (3, 14.0, False)],
+                 "missing sizes": [(0, np.nan, False), (0, 12.0, False), (0, np.nan, False), (0, np.nan, False),
+                                   (0, 12.0, False), (0, 20.0, False)]}
+        self.assert_cases(check, cases, random_titles)
+
+    def test_matches_rowwise_hierarchy(self):
+        def check(case):
+            labels, sizes, styles, texts, page_cuts = (np.array(values) for values in case)
+            expected = self.rowwise_hierarchy(labels, sizes, styles, texts)
+
+            # Blocks are added page by page
+            builder = HierarchyBuilder()
+            cuts = np.unique(np.concatenate(([0], page_cuts, [len(labels)]))).astype(np.int64)
+            parent_ids, depths = [], []
+            for start, end in zip(cuts[:-1], cuts[1:]):
+                istyles = np.array([style2int[style] for style in styles[start:end]])
+                block_ids, page_parents, page_depths = builder.add_blocks(labels[start:end], sizes[start:end],
+                                                                          istyles, texts[start:end])
+                self.assertEqual(block_ids.tolist(), list(range(start, end)))
+                parent_ids += page_parents.tolist()
+                depths += page_depths.tolist()
+            self.assertEqual((parent_ids, depths), expected)
+        self.assert_cases(check, self.CASES, self.random_blocks)
+
+
+class DuplicateTitleTestCase(DifferentialTestCase):
+    COLUMNS = ["text", "label", "x1", "y1"]
+    CASES = {
+        "empty": blocks_frame([], COLUMNS),
+        "offsets at the tolerance": blocks_frame([("Header", "title", 100, 50), ("Header", "title", 102, 52),
+                                                  ("Header", "title", 104.01, 50), ("Header", "title", 97.99, 50),
+                                                  ("Header", "title", 100, 54)], COLUMNS),
+        "cell boundaries": blocks_frame([("Header", "title", 1.99, 3.99), ("Header", "title", 3.99, 5.99),
+                                         ("Header", "title", -0.01, 2), ("Header", "title", 6.01, 2)], COLUMNS),
+        "missing positions": blocks_frame([("Header", "title", np.nan, 50), ("Header", "title", np.nan, 50),
+                                           ("Header", "title", 100, np.nan), ("Header", "title", 100, 50)], COLUMNS),
+        "continued and text": blocks_frame([("Results", "title", 10, 10), ("Results (continued)", "title", 11, 10),
+                                            (" Results ", "text", 10, 10), ("results", "title", 10, 10)], COLUMNS),
+    }
+
+    @staticmethod
+    def pairwise_remove_duplicates(data_df):
+        """ remove_duplicates before the index, comparing every pair of titles """
+        def clean(text):
+            return text.replace("(continued)", "").strip()
+
+        title_df = data_df[data_df["label"] == "title"].copy()
+        data_df["to_delete"] = False
+        for title_ind, title in title_df.iterrows():
+            for next_title_ind, next_title in title_df.iterrows():
+                if next_title_ind <= title_ind:
+                    continue
+                if (clean(next_title["text"]) == clean(title["text"]) and abs(next_title["x1"] - title["x1"]) <= 2
+                        and abs(next_title["y1"] - title["y1"]) <= 2):
+                    data_df.at[next_title_ind, "to_delete"] = True
+        data_df.drop(data_df[data_df["to_delete"] == True].index, inplace=True)
+        return data_df.reset_index(drop=True)
+
+    @staticmethod
+    def random_blocks(rs):
+        count = rs.randint(1, 60)
+        # Positions near a few anchors, offset across the tolerance and the cell edges
+        offsets = [0, 0.5, 1.99, 2, 2.01, 3.99, 4, -2, -2.01, -0.01, np.nan]
+        x1 = rs.choice([0.0, 100.0, 101.0], count) + rs.choice(offsets, count)
+        y1 = rs.choice([0.0, 50.0, 700.0], count) + rs.choice(offsets, count)
+        texts = rs.choice(["Header", "Header (continued)", " Header", "Footer", "footer"], count)
+        return pd.DataFrame({"text": texts, "label": rs.choice(["title", "title", "text"], count), "x1": x1, "y1": y1})
+
+    def test_matches_pairwise_loop(self):
+        def check(blocks):
+            expected = self.pairwise_remove_duplicates(blocks.copy())
+            pd.testing.assert_frame_equal(PCRelationGen().remove_duplicates(blocks.copy(), ""), expected)
+
+            # Titles repeated from earlier pages of the document are dropped too
+            relation_gen = PCRelationGen()
+            pages = [relation_gen.remove_duplicates(page.copy(), "") for page in np.array_split(blocks, 3)]
+            pd.testing.assert_frame_equal(pd.concat(pages, ignore_index=True), expected)
+        self.assert_cases(check, self.CASES, self.random_blocks)
+
+
+class HocrTestCase(DifferentialTestCase):
+    SEEDS = range(20)
+    XHTML_HEAD = (b'<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" '
+                  b'"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">\n'
+                  b'<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">\n<head><title></title></head>\n<body>\n')
+    PAGE = b'<div class="ocr_page" id="page_1" title="image; bbox 0 0 2480 3508; ppageno 0">%s</div>\n'
+    LINE = (b'<div class="ocr_carea" title="bbox 0 0 10 10"><p class="ocr_par" title="bbox 0 0 10 10">'
+            b'<span class="ocr_line" title="bbox 0 0 10 10">%s</span></p></div>')
+    CASES = {
+        "blank page": PAGE % b"",
+        "space words": PAGE % (LINE % (b'<span class="ocrx_word" title="bbox 1 2 3 4; x_wconf 90"> </span>'
+                                       b'<span class="ocrx_word" title="bbox 5 6 17 20; x_wconf 80">word</span>')),
+        "no confidence": PAGE % (LINE % b'<span class="ocrx_word" title="bbox 1 2 31 40">word</span>'),
+        "word outside a block": PAGE % (b'<span class="ocrx_word" title="bbox 1 2 3 4; x_wconf 90">lost</span>'
+                                        + LINE % b'<span class="ocrx_word" title="bbox 1 2 3 4">kept</span>'),
+        "markup and font size": PAGE % (LINE % (b'<span class="ocrx_word" title="bbox 1 2 3 4; x_wconf 5; '
+                                                b'x_font Arial; x_fsize 11"><strong><em>Bold</em></strong></span>')),
+    }
+
+    @staticmethod
+    def soup_words(hocr, scale):
+        """ Words as the BeautifulSoup walk before parse_hocr read them """
+        soup = BeautifulSoup(hocr, features="lxml")
+        data = []
+        for block_num, block in enumerate(soup.find_all("div", {"class": "ocr_carea"})):
+            for par in block.find_all("p", {"class": "ocr_par"}):
+                for line_num, line in enumerate(par.find_all("span", recursive=False)):
+                    for word_num, word in enumerate(line.find_all("span")):
+                        if word.string in [" "]:
+                            continue
+                        conf = np.nan
+                        for prop in word["title"].split(";"):
+                            prop = [d for d in prop.split(" ") if d]
+                            if prop[0] == "bbox":
+                                x1, y1 = int(prop[1]) / scale, int(prop[2]) / scale
+                                x2, y2 = int(prop[3]) / scale, int(prop[4]) / scale
+                                size = y2 - y1
+                            elif prop[0] == "x_wconf":
+                                conf = int(prop[1])
+                            elif prop[0] == "x_fsize":
+                                size = int(prop[1])
+                        data.append((x1, y1, x2, y2, conf, size, block_num, line_num, word_num, str(word.string)))
+        return data
+
+    def random_hocr(self, rs):
+        parts = []
+        for block_no in range(rs.randint(0, 4)):
+            parts.append(f'<div class="ocr_carea" id="block_1_{block_no}" title="bbox 0 0 10 10">'.encode())
+            for par_no in range(rs.randint(1, 3)):
+                parts.append(b'<p class="ocr_par" lang="eng" title="bbox 0 0 10 10">')
+                for line_no in range(rs.randint(1, 4)):
+                    parts.append(b'<span class="ocr_line" title="bbox 0 0 10 10; baseline 0 -8; x_size 40">')
+                    for word_no in range(rs.randint(1, 6)):
+                        x, y = rs.randint(0, 2000), rs.randint(0, 3000)
+                        title = f"bbox {x} {y} {x + rs.randint(5, 300)} {y + rs.randint(5, 60)}; x_wconf {rs.randint(0, 97)}"
+                        if rs.rand() < 0.3:
+                            title += f"; x_font Arial; x_fsize {rs.randint(6, 30)}"
+                        text = rs.choice(["word", " ", "<strong>Bold</strong>", "caf&#233;", "&amp;"])
+                        parts.append(f'<span class="ocrx_word" title="{title}">{text}</span> '.encode())
+                    parts.append(b"</span>\n")
+                parts.append(b"</p>\n")
+            parts.append(b"</div>\n")
+        return self.PAGE % b"".join(parts)
+
+    def test_matches_soup_walk(self):
+        columns = ["x1", "y1", "x2", "y2", "conf", "size", "block_num", "line_num", "span_num"]
+
+        def check(fragment):
+            for hocr in (fragment, self.XHTML_HEAD + fragment + b"</body>\n</html>\n"):
+                for scale in (1, 2):
+                    words = parse_hocr(hocr, scale)
+                    parsed = list(zip(*[words[col].tolist() for col in columns], words["text"]))
+                    np.testing.assert_equal(parsed, self.soup_words(hocr, scale))
+        self.assert_cases(check, self.CASES, self.random_hocr)
+
+
+class OCREnginePoolTestCase(unittest.TestCase):
+    class StubEngine:
+        """ PyTessBaseAPI stand-in whose first `failures` creations raise """
+        created = []
+        failures = 0
+
+        def __init__(self, lang, oem, psm):
+            cls = OCREnginePoolTestCase.StubEngine
+            if cls.failures > 0:
+                cls.failures -= 1
+                raise RuntimeError("Failed loading language 'eng'")
+            cls.created.append(self)
+            self.image, self.cleared = None, 0
+
+        def SetImageBytes(self, data, width, height, channels, bytes_per_line):
+            self.image = (width, height, channels)
+
+        def SetSourceResolution(self, dpi):
+            pass
+
+        def GetHOCRText(self, page_number):
+            time.sleep(0.01)
+            return f"{self.image}"
+
+        def Clear(self):
+            self.image = None
+            self.cleared += 1
+
+        def End(self):
+            pass
+
+    def setUp(self):
+        self.StubEngine.created, self.StubEngine.failures = [], 0
+        stub = types.SimpleNamespace(PyTessBaseAPI=self.StubEngine,
+                                     OEM=types.SimpleNamespace(LSTM_ONLY=1), PSM=types.SimpleNamespace(AUTO_OSD=1))
+        patcher = mock.patch("utils.ocr.tesserocr", stub)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_pages(self, pool, images):
+        """ OCRs every image in its own thread, failing the test if a page hangs """
+        results = [None] * len(images)
+
+        def ocr(i):
+            try:
+                results[i] = pool.image_to_hocr(images[i], 300)
+            except RuntimeError as e:
+                results[i] = e
+        threads = [threading.Thread(target=ocr, args=(i,), daemon=True) for i in range(len(images))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive(), "page still waiting for an engine")
+        return results
+
+    def test_reuses_engines(self):
+        pool = OCREnginePool(size=2)
+        images = [np.zeros((10 + i, 20, 3), dtype=np.uint8) for i in range(8)]
+        results = self.run_pages(pool, images)
+        self.assertEqual(results, [str((20, 10 + i, 3)).encode() for i in range(8)])
+        self.assertLessEqual(len(self.StubEngine.created), 2)
+        self.assertEqual(sum(engine.cleared for engine in self.StubEngine.created), 8)
+
+        self.run_pages(pool, [np.zeros((5, 5), dtype=np.uint8)])
+        self.assertLessEqual(len(self.StubEngine.created), 2)
+
+    def test_failed_creation_frees_slot(self):
+        pool = OCREnginePool(size=1)
+        image = np.zeros((10, 20), dtype=np.uint8)
+        self.StubEngine.failures = 2
+        results = self.run_pages(pool, [image, image])
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        self.assertEqual(self.StubEngine.created, [])
+
+        self.assertEqual(self.run_pages(pool, [image, image]), [str((20, 10, 1)).encode()] * 2)
+        self.assertEqual(len(self.StubEngine.created), 1)
+
+
+class BlockDetectorTestCase(unittest.TestCase):
+    @staticmethod
+    def make_layout_pdf(fpath):
+        """ Body text up to 12pt in one and two columns, with headings, lists,
+            drawings and an image around it
+        """
+        doc = fitz.open()
+        page = doc.newPage()
+        page.insertText((72, 72), "Annual Report", fontsize=12, fontname="hebo")
+        page.insertTextbox(fitz.Rect(72, 90, 290, 400), "Left column body text that wraps over lines. " * 8, fontsize=10)
+        page.insertTextbox(fitz.Rect(310, 90, 530, 400), "Right column with other words, also wrapping. " * 8,
+                           fontsize=10)
+        page.drawLine((72, 410), (530, 410))
+        page.drawRect(fitz.Rect(72, 420, 200, 500), color=(0, 0, 0), fill=(0.8, 0.8, 0.8))
+        page.insertTextbox(fitz.Rect(220, 430, 530, 520), "Italic caption of the shaded figure", fontsize=9,
+                           fontname="heit")
+        page.insertTextbox(fitz.Rect(72, 720, 530, 760), "1 Footnote in small print.", fontsize=8)
+        page = doc.newPage()
+        page.insertText((72, 72), "SECOND SECTION", fontsize=11, fontname="hebo")
+        page.insertTextbox(fitz.Rect(72, 90, 530, 300), "- first item of a list\n- second item\n- third item with "
+                                                         "more words\n\nA paragraph after the list. " * 3, fontsize=11)
+        page.insertImage(fitz.Rect(100, 400, 300, 500), pixmap=fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 16, 16)))
+        doc.save(fpath)
+        doc.close()
+
+    def test_geometry_matches_render(self):
+        with tempfile.TemporaryDirectory() as folder:
+            pdf_fpath = os.path.join(folder, "layout.pdf")
+            self.make_layout_pdf(pdf_fpath)
+            extractors = {detector: TextExtractor(False, DocumentSession(pdf_fpath), block_detector=detector)
+                          for detector in ("render", "geometry")}
+            try:
+                for page_no in range(2):
+                    blocks, boxes = {}, {}
+                    for detector, extractor in extractors.items():
+                        page = extractor.session.doc[page_no]
+                        extractor.read_pdf_to_df(pdf_fpath, page, False)
+                        blocks[detector] = extractor.data_df
+                        boxes[detector] = extractor.get_blocks_bbox_by_cv(page)
+                    self.assertGreater(len(blocks["render"]), 5)
+                    pd.testing.assert_frame_equal(boxes["geometry"], boxes["render"], obj=f"page {page_no} boxes")
+                    pd.testing.assert_frame_equal(blocks["geometry"], blocks["render"], obj=f"page {page_no} blocks")
+            finally:
+                for extractor in extractors.values():
+                    extractor.session.close()
+
+
+class PageDpiTestCase(unittest.TestCase):
+    @staticmethod
+    def decoded_page_dpi(doc, page):
+        """ DPI check before get_page_dpi, which decodes the first image """
+        img = page.getImageList()
+        if len(img) >= 1:
+            pix = fitz.Pixmap(doc, img[0][0])
+            if pix.colorspace.name == "DeviceCMYK":
+                pix = page.getPixmap(matrix=fitz.Matrix(2, 2))
+        else:
+            pix = page.getPixmap(matrix=fitz.Matrix(2, 2))
+        return int(72 * pix.irect[2] / page.rect[2])
+
+    def test_matches_decoded_colorspace(self):
+        doc = fitz.open()
+
+        def new_object(text, stream=None):
+            xref = doc.get_new_xref()
+            doc.updateObject(xref, text)
+            if stream is not None:
+                doc.updateStream(xref, stream, new=True)
+            return xref
+
+        def add_page(colorspace, pdf_colorspace=None, samples=None):
+            page = doc.newPage()
+            page.insertImage(fitz.Rect(0, 0, 100, 100), pixmap=fitz.Pixmap(colorspace, fitz.IRect(0, 0, 8, 8)))
+            xref = page.getImageList()[0][0]
+            if samples is not None:
+                doc.updateStream(xref, samples)
+            if pdf_colorspace is not None:
+                doc.xref_set_key(xref, "ColorSpace", pdf_colorspace)
+
+        icc_cmyk = new_object("<</N 4>>", bytes(16))
+        icc_rgb = new_object("<</N 3>>", bytes(16))
+        add_page(fitz.csCMYK)
+        add_page(fitz.csRGB)
+        add_page(fitz.csGRAY)
+        add_page(fitz.csCMYK, f"[/ICCBased {icc_cmyk} 0 R]")
+        add_page(fitz.csRGB, f"[/ICCBased {icc_rgb} 0 R]")
+        add_page(fitz.csGRAY, "[/Indexed /DeviceCMYK 1 <00000000FFFFFFFF>]", bytes(64))
+        add_page(fitz.csGRAY, f"[/Indexed [/ICCBased {icc_cmyk} 0 R] 1 <00000000FFFFFFFF>]", bytes(64))
+        add_page(fitz.csCMYK, f"{new_object(f'[/ICCBased {icc_cmyk} 0 R]')} 0 R")
+        doc.newPage()
+        doc = fitz.open("pdf", doc.write())
+        for page in doc:
+            self.assertEqual(get_page_dpi(page, page.getImageList()), self.decoded_page_dpi(doc, page),
+                             msg=page.number)
+
+
+class PageSelectionTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.pdf_fpath = os.path.join(cls.folder, "three.pdf")
+        make_text_pdf(cls.pdf_fpath, 3)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def test_parse_page_ranges(self):
+        self.assertEqual(parse_page_ranges("1-3, 7,10-,-2"), [(1, 3), (7, 7), (10, None), (1, 2)])
+        for spec in ["a", "3-1", "0", ",", "", "1-x"]:
+            with self.assertRaises(PageSelectionError, msg=spec):
+                parse_page_ranges(spec)
+
+    def test_select_pages(self):
+        self.assertEqual(select_pages(10), list(range(10)))
+        self.assertEqual(select_pages(10, "1-3,7,9-"), [0, 1, 2, 6, 8, 9])
+        self.assertEqual(select_pages(10, [3, 1, 3]), [0, 2])
+        self.assertEqual(select_pages(10, None, 3), [0, 1, 2])
+        self.assertEqual(select_pages(10, None, 30), list(range(10)))
+        self.assertEqual(select_pages(10, "2-", 4), [1, 2, 3])
+
+    def test_select_pages_outside_document(self):
+        for pages, first_pages in [("9", None), ([0, 2, 5], None), ("2-9", None), ("5-", None), ("5-", 3),
+                                   (None, 0), ("x", None)]:
+            with self.assertRaises(PageSelectionError, msg=(pages, first_pages)):
+                select_pages(3, pages, first_pages)
+
+    def test_extraction_window(self):
+        full = get_pdf_extraction(self.pdf_fpath, "three", workers=1)
+        window = get_pdf_extraction(self.pdf_fpath, "three", workers=1, pages="2-")
+        self.assertEqual(sorted(set(full["page_no"])), [1, 2, 3])
+        self.assertEqual(sorted(set(window["page_no"])), [2, 3])
+        self.assertEqual(window["text"].tolist(), full[full["page_no"] > 1]["text"].tolist())
+        first = get_pdf_extraction(self.pdf_fpath, "three", workers=1, first_pages=1)
+        self.assertEqual(set(first["page_no"]), {1})
+
+    def test_extraction_outside_document(self):
+        with self.assertRaises(PageSelectionError):
+            get_pdf_extraction(self.pdf_fpath, "three", workers=1, pages="9")
+        with self.assertRaises(PageSelectionError):
+            get_pdf_extraction(self.pdf_fpath, "three", workers=1, pages="3", first_pages=2)
+
+    def test_batch_reports_selection_per_document(self):
+        long_fpath = os.path.join(self.folder, "five.pdf")
+        make_text_pdf(long_fpath, 5)
+        results = {index: (df, error) for index, df, error in
+                   iter_batch_extraction([(self.pdf_fpath, "three"), (long_fpath, "five")], workers=1, pages="4")}
+        self.assertIsNone(results[0][0])
+        self.assertIn("outside", results[0][1])
+        self.assertIsNone(results[1][1])
+        self.assertEqual(set(results[1][0]["page_no"]), {4})
+
+
+@mock.patch("utils.pdf_parse.pages_per_task", 1)
+@mock.patch("utils.pdf_parse.tasks_per_worker", 1)
+class ParallelExtractionTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.pdf_fpath = os.path.join(cls.folder, "six.pdf")
+        make_text_pdf(cls.pdf_fpath, 6)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def test_page_workers_match_single_process(self):
+        single = get_pdf_extraction(self.pdf_fpath, "six", workers=1)
+        parallel = get_pdf_extraction(self.pdf_fpath, "six", workers=2)
+        self.assertTrue(single.equals(parallel))
+
+    def test_closed_stream_stops_early(self):
+        stream = iter_pdf_extraction(self.pdf_fpath, "six", workers=2)
+        page_no, page_count, _ = next(stream)
+        self.assertEqual((page_no, page_count), (1, 6))
+        stream.close()
+
+    def test_batch_workers_match_single_process(self):
+        pdf_files = [(self.pdf_fpath, "six"), (self.pdf_fpath, "six again")]
+        single = {index: df for index, df, _ in iter_batch_extraction(pdf_files, workers=1)}
+        parallel = {index: df for index, df, _ in iter_batch_extraction(pdf_files, workers=2)}
+        self.assertEqual(sorted(parallel), [0, 1])
+        for index in parallel:
+            self.assertTrue(single[index].equals(parallel[index]))
+
+
+class DispatcherTestCase(unittest.TestCase):
+    def dispatcher(self, **kwargs):
+        dispatcher = ExtractionDispatcher(**kwargs)
+        self.addCleanup(dispatcher.shutdown)
+        return dispatcher
+
+    def assert_counts(self, dispatcher, **counts):
+        stats = dispatcher.stats()
+        self.assertEqual({key: stats[key] for key in counts}, counts)
+
+    def test_busy_until_released(self):
+        dispatcher = self.dispatcher(workers=1, queue_size=1, retry_after=7)
+        admissions = [dispatcher.admit(), dispatcher.admit()]
+        with self.assertRaises(DispatcherBusy) as busy:
+            dispatcher.admit()
+        self.assertEqual(busy.exception.retry_after, 7)
+        self.assert_counts(dispatcher, queued=2, rejected=1)
+
+        admissions[0].release(failed=True)
+        admissions[0].release()
+        dispatcher.admit()
+        self.assert_counts(dispatcher, queued=2, failed=1, completed=0)
+
+    def test_failed_extraction_releases_slot(self):
+        for executor in ("thread", "process"):
+            dispatcher = self.dispatcher(workers=1, queue_size=0, executor=executor)
+            with self.assertRaises(ValueError):
+                asyncio.run(dispatcher.run(int, "not a page"))
+            self.assert_counts(dispatcher, queued=0, in_flight=0, failed=1)
+            self.assertEqual(asyncio.run(dispatcher.run(len, "pdf")), 3, msg=executor)
+            self.assert_counts(dispatcher, queued=0, in_flight=0, failed=1, completed=1)
+
+    def test_failed_stream_releases_slot(self):
+        def broken_pages():
+            yield 1
+            raise ValueError("broken page")
+
+        dispatcher = self.dispatcher(workers=1, queue_size=0)
+        stream = dispatcher.stream(dispatcher.admit(), broken_pages)
+        self.assertEqual(next(stream), 1)
+        self.assert_counts(dispatcher, in_flight=1)
+        with self.assertRaises(ValueError):
+            next(stream)
+        self.assert_counts(dispatcher, queued=0, in_flight=0, failed=1)
+        self.assertEqual(list(dispatcher.stream(dispatcher.admit(), range, 2)), [0, 1])
+
+
+class UploadsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.scratch_dir = os.path.join(self.folder, "request")
+        os.mkdir(self.scratch_dir)
+
+    @staticmethod
+    def zip_upload(members):
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for name, content in members:
+                archive.writestr(name, content)
+        return data
+
+    def test_save_and_hash_in_chunks(self):
+        data = os.urandom(10000)
+        fpath = os.path.join(self.folder, "upload.pdf")
+        upload = io.BytesIO(data)
+        upload.read(10)
+        self.assertEqual(save_upload(upload, fpath, chunk_size=7), len(data))
+        with open(fpath, "rb") as file:
+            self.assertEqual(file.read(), data)
+        self.assertEqual(hash_upload(upload, chunk_size=7), (hashlib.sha256(data).hexdigest(), len(data)))
+
+    def test_oversize_upload_refused(self):
+        fpath = os.path.join(self.folder, "upload.pdf")
+        self.assertEqual(save_upload(io.BytesIO(b"x" * 100), fpath, chunk_size=30, max_bytes=100), 100)
+        with self.assertRaises(UploadTooLarge):
+            save_upload(io.BytesIO(b"x" * 101), fpath, chunk_size=30, max_bytes=100)
+        self.assertFalse(os.path.exists(fpath))
+        with self.assertRaises(UploadTooLarge):
+            hash_upload(io.BytesIO(b"x" * 101), chunk_size=30, max_bytes=100)
+        self.assertEqual(save_upload(io.BytesIO(b"x" * 101), fpath, max_bytes=0), 101)
+
+    def test_batch_rejects_unsafe_zip_members(self):
+        archive = self.zip_upload([("a.pdf", b"%PDF a"), ("docs/b.PDF", b"%PDF b"), ("notes.txt", b"skipped"),
+                                   ("../evil.pdf", b"%PDF"), ("/abs/evil.pdf", b"%PDF"),
+                                   ("docs/../../evil.pdf", b"%PDF"), ("C:\\evil.pdf", b"%PDF"),
+                                   ("docs/big.pdf", b"%PDF" + b"x" * 2000)])
+        uploads = [("bundle.zip", archive), ("../../top.pdf", io.BytesIO(b"%PDF top")),
+                   ("broken.zip", io.BytesIO(b"not a zip")), ("notes.txt", io.BytesIO(b"text")),
+                   ("huge.pdf", io.BytesIO(b"%PDF" + b"x" * 2000))]
+        # The archive itself is within the limit, the pdf it packs is not
+        documents = save_batch_uploads(uploads, self.scratch_dir, max_bytes=1000)
+
+        saved = [(name, Path(fpath).read_bytes()) for name, fpath, error in documents if error is None]
+        self.assertEqual(saved, [("a", b"%PDF a"), ("b", b"%PDF b"), ("top", b"%PDF top")])
+        errors = {name: error for name, _, error in documents if error is not None}
+        for name in ("../evil.pdf", "/abs/evil.pdf", "docs/../../evil.pdf", "C:\\evil.pdf"):
+            self.assertEqual(errors[name], "Unsafe path in zip archive")
+        self.assertIn("larger than the limit", errors["big"])
+        self.assertIn("larger than the limit", errors["huge"])
+        self.assertIn("Cannot read zip archive", errors["broken.zip"])
+        self.assertEqual(errors["notes.txt"], "Incorrect file uploaded")
+        self.assertEqual(len(documents), 11)
+        # Nothing is written outside the scratch directory, and no archive is left in it
+        self.assertEqual(os.listdir(self.folder), ["request"])
+        self.assertEqual(sorted(os.listdir(self.scratch_dir)), sorted(os.path.basename(fpath)
+                                                                      for _, fpath, error in documents if error is None))
+
+
+class ExtractionApiTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from fastapi.testclient import TestClient
+
+        cls.folder = tempfile.mkdtemp()
+        # The job store and result cache of the app go to the temporary folder
+        with mock.patch("utils.job_folder", Path(cls.folder) / "jobs"), \
+                mock.patch("utils.result_cache_folder", Path(cls.folder) / "cache"):
+            import main
+        cls.main = main
+        cls.client = TestClient(main.app, raise_server_exceptions=False)
+        pdf_fpath = os.path.join(cls.folder, "two.pdf")
+        make_text_pdf(pdf_fpath, 2)
+        with open(pdf_fpath, "rb") as f:
+            cls.pdf = f.read()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def setUp(self):
+        self.dispatcher = ExtractionDispatcher(workers=1, queue_size=0, retry_after=7)
+        self.addCleanup(self.dispatcher.shutdown)
+        for patcher in (mock.patch.object(self.main, "dispatcher", self.dispatcher),
+                        mock.patch("logging.basicConfig")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post_pdf(self, path):
+        return self.client.post(path, files={"pdf": ("two.pdf", self.pdf, "application/pdf")})
+
+    def test_busy_dispatcher_answers_503(self):
+        admission = self.dispatcher.admit()
+        for path in ("/extract_pdf", "/extract_pdf_stream"):
+            response = self.post_pdf(path)
+            self.assertEqual(response.status_code, 503, msg=path)
+            self.assertEqual(response.headers["Retry-After"], "7")
+            self.assertIn("queue is full", response.json()["message"])
+        admission.release()
+        self.assertEqual(self.dispatcher.stats()["rejected"], 2)
+
+    def test_oversize_upload_refused(self):
+        limit = {"max_bytes": len(self.pdf) - 1}
+        job_folder = self.main.job_folder
+        with mock.patch.object(self.main, "hash_upload", functools.partial(hash_upload, **limit)), \
+                mock.patch.object(self.main, "save_upload", functools.partial(save_upload, **limit)):
+            for path in ("/extract_pdf", "/extract_pdf_stream", "/jobs"):
+                response = self.post_pdf(path)
+                self.assertEqual(response.status_code, 413, msg=path)
+                self.assertIn("larger than the limit", response.json()["message"])
+        stats = self.dispatcher.stats()
+        self.assertEqual((stats["queued"], stats["in_flight"]), (0, 0))
+        self.assertEqual([fname for fname in os.listdir(job_folder) if fname.endswith(".pdf")], [])
+
+    def test_failed_extraction_releases_place(self):
+        with mock.patch.object(self.main, "get_pdf_extraction", side_effect=ValueError("broken pdf")):
+            self.assertEqual(self.post_pdf("/extract_pdf").status_code, 500)
+        stats = self.dispatcher.stats()
+        self.assertEqual((stats["queued"], stats["in_flight"], stats["failed"]), (0, 0, 1))
+
+        response = self.post_pdf("/extract_pdf")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({block["page_no"] for block in response.json()}, {1, 2})
+
+
+class BatchCliTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.out_dir = os.path.join(self.folder, "out")
+        self.sources = []
+        for name, page_count in (("one", 2), ("two", 3)):
+            pdf_fpath = os.path.join(self.folder, f"{name}.pdf")
+            make_text_pdf(pdf_fpath, page_count)
+            self.sources.append(pdf_fpath)
+
+    def run_batch(self, **kwargs):
+        return extract_batch.run(self.sources, self.out_dir, workers=1, file_format="jsonl", files_per_part=1,
+                                 **kwargs)
+
+    def checkpoint(self):
+        with open(os.path.join(self.out_dir, extract_batch.CHECKPOINT_NAME)) as file:
+            return [json.loads(line) for line in file]
+
+    def part_blocks(self):
+        """ Blocks of every source in the part its latest checkpoint entry names """
+        blocks = {}
+        for source, entry in extract_batch.read_checkpoint(self.out_dir).items():
+            part = pd.read_json(os.path.join(self.out_dir, entry["part"]), lines=True)
+            blocks[source] = part[part["source"] == source].drop(columns="source").reset_index(drop=True)
+        return blocks
+
+    def test_resumes_interrupted_run(self):
+        summary = self.run_batch()
+        self.assertEqual((summary["done"], summary["skipped"]), (2, 0))
+        # Interrupted after writing the part of the second file, before its checkpoint entry
+        entries = self.checkpoint()
+        with open(os.path.join(self.out_dir, extract_batch.CHECKPOINT_NAME), "w") as file:
+            file.write(json.dumps(entries[0]) + "\n" + json.dumps(entries[1])[:20])
+        open(os.path.join(self.out_dir, ".part-00005.jsonl.tmp"), "w").close()
+
+        summary = self.run_batch()
+        self.assertEqual((summary["done"], summary["skipped"]), (1, 1))
+        parts = sorted(fname for fname in os.listdir(self.out_dir) if "part-" in fname)
+        self.assertEqual(parts, sorted(entry["part"] for entry in extract_batch.read_checkpoint(self.out_dir).values()))
+        blocks = self.part_blocks()
+        self.assertEqual(sorted(blocks), sorted(self.sources))
+        for source in self.sources:
+            expected = get_pdf_extraction(source, os.path.basename(source)[:-4])
+            self.assertEqual(blocks[source]["text"].tolist(), expected["text"].tolist())
+            self.assertEqual(blocks[source]["page_no"].tolist(), expected["page_no"].tolist())
+
+    def test_extracts_again_under_another_selection(self):
+        self.run_batch()
+        self.assertEqual(self.run_batch()["skipped"], 2)
+
+        with self.assertLogs(level="WARNING") as logs:
+            summary = self.run_batch(first_pages=1)
+        self.assertEqual((summary["done"], summary["skipped"]), (2, 0))
+        self.assertIn("2 files", logs.output[0])
+        self.assertEqual({(entry["pages"], entry["first_pages"]) for entry in self.checkpoint()[-2:]}, {(None, 1)})
+        self.assertEqual(self.run_batch(first_pages=1)["skipped"], 2)
+        for blocks in self.part_blocks().values():
+            self.assertEqual(set(blocks["page_no"]), {1})
+        # The parts of the first selection are no longer named by any entry
+        self.assertEqual(len([fname for fname in os.listdir(self.out_dir) if fname.startswith("part-")]), 2)
+
+        self.assertEqual(self.run_batch(pages="2-")["done"], 2)
+        self.assertEqual(self.run_batch(pages="2-", first_pages=1)["failed"], 2)
+
+    def test_entries_without_selection_cover_all_pages(self):
+        self.run_batch()
+        entries = self.checkpoint()
+        with open(os.path.join(self.out_dir, extract_batch.CHECKPOINT_NAME), "w") as file:
+            for entry in entries:
+                del entry["pages"], entry["first_pages"]
+                file.write(json.dumps(entry) + "\n")
+        self.assertEqual(self.run_batch()["skipped"], 2)
+        self.assertEqual(self.run_batch(pages="1")["done"], 2)
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+class JobStoreFixture:
+    """ Job store in a temporary folder, with a 3 page pdf and its blocks """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = JobStore(os.path.join(self.folder, "jobs.sqlite3"))
+        self.pdf_fpath = os.path.join(self.folder, "three.pdf")
+        make_text_pdf(self.pdf_fpath, 3)
+        self.blocks = get_pdf_extraction(self.pdf_fpath, "three", workers=1)[RELATION_COLUMNS]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def set_owner(self, job_id, pid, token):
+        with sqlite3.connect(self.store.db_path) as conn:
+            conn.execute("UPDATE jobs SET status = ?, owner_pid = ?, owner_token = ? WHERE job_id = ?",
+                         (RUNNING, pid, token, job_id))
+
+
+class JobStoreTestCase(JobStoreFixture, unittest.TestCase):
+    def test_claim_job(self):
+        job_id = self.store.create_job("three", self.pdf_fpath)
+        self.assertTrue(self.store.claim_job(job_id))
+        self.assertEqual(self.store.get_job(job_id)["status"], RUNNING)
+        self.assertTrue(self.store.finish_job(job_id))
+        self.assertFalse(self.store.claim_job(job_id))
+        self.assertFalse(self.store.claim_job("missing"))
+
+    def test_claim_keeps_live_owner(self):
+        job_id = self.store.create_job("three", self.pdf_fpath)
+        self.set_owner(job_id, os.getppid(), process_token(os.getppid()))
+        self.assertFalse(self.store.claim_job(job_id))
+        self.assertFalse(self.store.finish_job(job_id, owner_pid=os.getpid()))
+
+    def test_claim_takes_over_interrupted_job(self):
+        job_id = self.store.create_job("three", self.pdf_fpath)
+        self.store.claim_job(job_id)
+        self.store.add_page(job_id, 1, 3, self.blocks[self.blocks["page_no"] == 1])
+        self.set_owner(job_id, dead_pid(), None)
+        self.assertTrue(self.store.claim_job(job_id))
+        job = self.store.get_job(job_id)
+        self.assertEqual((job["pages_done"], job["block_count"]), (0, 0))
+        self.assertEqual(self.store.get_blocks(job_id), [])
+
+    @unittest.skipIf(process_token(os.getpid()) is None, "needs /proc")
+    def test_claim_takes_over_reused_pid(self):
+        job_id = self.store.create_job("three", self.pdf_fpath)
+        # A live process with the pid of the owner, started after it
+        self.set_owner(job_id, os.getppid(), "earlier boot:0")
+        self.assertTrue(self.store.claim_job(job_id))
+
+
+class JobRunnerTestCase(JobStoreFixture, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.runner = JobRunner(self.store)
+
+    def tearDown(self):
+        self.runner.shutdown()
+        super().tearDown()
+
+    def wait_for(self, job_id, timeout=60):
+        deadline = time.monotonic() + timeout
+        while self.store.get_job(job_id)["status"] != DONE and time.monotonic() < deadline:
+            time.sleep(0.1)
+        return self.store.get_job(job_id)
+
+    def assert_blocks(self, job_id):
+        expected = [tuple(row) for row in self.blocks.itertuples(index=False)]
+        blocks = [tuple(block[column] for column in RELATION_COLUMNS) for block in self.store.get_blocks(job_id)]
+        self.assertEqual(blocks, expected)
+
+    def test_job_matches_direct_extraction(self):
+        job_id = self.store.create_job("three", self.pdf_fpath)
+        self.runner.submit(job_id)
+        job = self.wait_for(job_id)
+        self.assertEqual((job["status"], job["pages_done"], job["page_count"]), (DONE, 3, 3))
+        self.assert_blocks(job_id)
+        self.assertFalse(os.path.exists(self.pdf_fpath))
+
+    def test_interrupted_job_starts_over(self):
+        job_id = self.store.create_job("three", self.pdf_fpath)
+        self.store.claim_job(job_id)
+        self.store.add_page(job_id, 1, 3, self.blocks[self.blocks["page_no"] == 1])
+        self.set_owner(job_id, dead_pid(), None)
+        self.assertEqual(self.runner.restart_unfinished(), [job_id])
+        self.assertEqual(self.wait_for(job_id)["status"], DONE)
+        self.assert_blocks(job_id)
+
+
+class ResultCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        # Random bodies do not compress, so every entry takes about the same size
+        rs = np.random.RandomState(0)
+        self.bodies = {name: rs.bytes(1000) for name in "abcd"}
+        self.entry_size = len(gzip.compress(self.bodies["a"], compresslevel=6))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def entries(self):
+        return sorted(fname.split(".")[0] for fname in os.listdir(self.folder))
+
+    def test_get_and_put(self):
+        cache = ResultCache(self.folder, 10 * self.entry_size)
+        self.assertIsNone(cache.get("a", pdf_size=100))
+        compressed = cache.put("a", self.bodies["a"])
+        self.assertEqual(gzip.decompress(compressed), self.bodies["a"])
+        self.assertEqual(cache.get("a", pdf_size=100), compressed)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["bytes_saved"], stats["entries"]), (1, 1, 100, 1))
+
+    def test_evicts_least_recently_used(self):
+        cache = ResultCache(self.folder, 2 * self.entry_size + 10)
+        cache.put("a", self.bodies["a"])
+        cache.put("b", self.bodies["b"])
+        cache.get("a")
+        cache.put("c", self.bodies["c"])
+        self.assertEqual(self.entries(), ["a", "c"])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats()["total_bytes"], sum(os.path.getsize(os.path.join(self.folder, fname))
+                                                           for fname in os.listdir(self.folder)))
+
+    def test_restores_use_order(self):
+        cache = ResultCache(self.folder, 10 * self.entry_size)
+        for age, name in enumerate("dcba"):
+            cache.put(name, self.bodies[name])
+            # Last used `age` hours ago
+            os.utime(os.path.join(self.folder, f"{name}.json.gz"), (time.time() - 3600 * age,) * 2)
+        cache = ResultCache(self.folder, 3 * self.entry_size + 10)
+        self.assertEqual(self.entries(), ["b", "c", "d"])
+        self.assertEqual(cache.stats()["entries"], 3)
+        cache.get("b")
+        cache.put("e", self.bodies["a"])
+        self.assertEqual(self.entries(), ["b", "d", "e"])
+
+    def test_disabled(self):
+        folder = os.path.join(self.folder, "disabled")
+        cache = ResultCache(folder, 0)
+        self.assertEqual(gzip.decompress(cache.put("a", self.bodies["a"])), self.bodies["a"])
+        self.assertIsNone(cache.get("a"))
+        self.assertFalse(os.path.exists(folder))
+
+    def test_cache_key(self):
+        self.assertEqual(cache_key("abc"), cache_key("abc"))
+        self.assertNotEqual(cache_key("abc"), cache_key("abd"))
+        self.assertNotEqual(cache_key("abc"), cache_key("abc", pages="1-3"))
+        self.assertEqual(cache_key("abc", pages="1", first_pages=2), cache_key("abc", first_pages=2, pages="1"))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,2 +1,9 @@
-from .pdf_parse import get_pdf_extraction
-from .config import temp_folder
\ No newline at end of file
+from .pdf_parse import (PageSelectionError, get_pdf_extraction, iter_batch_extraction, iter_pdf_extraction,
+                        parse_page_ranges, select_pdf_pages)
+from .dispatcher import DispatcherBusy, ExtractionDispatcher
+from .job_store import JobRunner, JobStore
+from .result_cache import ResultCache, cache_key
+from .uploads import (UploadTooLarge, create_scratch_dir, hash_upload, remove_scratch_dir, save_batch_uploads,
+                      save_upload)
+from .config import (job_folder, job_workers, result_cache_folder, result_cache_max_bytes,
+                     temp_folder)
\ No newline at end of file
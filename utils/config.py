@@ -1,3 +1,57 @@
+import os
 from pathlib import Path
 
 temp_folder = Path("tmp/")
+# Uploads are copied to disk in chunks of this many bytes
+upload_chunk_size = int(os.environ.get("PDF_PARSER_UPLOAD_CHUNK_SIZE", 1 << 20))
+# Uploads, and pdfs inside uploaded zip archives, larger than this many bytes are
+# refused. 0 lifts the limit.
+upload_max_bytes = int(os.environ.get("PDF_PARSER_UPLOAD_MAX_BYTES", 256 * 1024 * 1024))
+
+# Number of worker processes used to extract pages in parallel. 1 keeps the
+# whole document in the calling process.
+page_workers = int(os.environ.get("PDF_PARSER_PAGE_WORKERS", 1))
+
+# Contiguous pages handed to a worker at a time. Each worker opens the document
+# once per range, so larger ranges amortise the open, smaller ones balance load.
+pages_per_task = int(os.environ.get("PDF_PARSER_PAGES_PER_TASK", 8))
+# Page ranges queued per worker process at a time. Further ranges are only
+# submitted as earlier ones complete, so an abandoned extraction stops early.
+tasks_per_worker = max(int(os.environ.get("PDF_PARSER_TASKS_PER_WORKER", 2)), 1)
+
+# Worker processes shared by all documents of a batch extraction
+batch_workers = int(os.environ.get("PDF_PARSER_BATCH_WORKERS", os.cpu_count() or 1))
+
+# Tesseract engines kept loaded per process, and the OpenMP threads each may use.
+# Pages are already parallel across workers, so one thread per engine avoids
+# oversubscribing the cores.
+ocr_workers = int(os.environ.get("PDF_PARSER_OCR_WORKERS", 1))
+ocr_omp_threads = int(os.environ.get("PDF_PARSER_OCR_OMP_THREADS", 1))
+
+# How paragraph blocks are found on digital pages. "render" closes the rendered
+# stripped page, "geometry" closes a mask rasterized from the character boxes.
+block_detector = os.environ.get("PDF_PARSER_BLOCK_DETECTOR", "render")
+# Glyph ink masks the "geometry" detector keeps per process, one per character,
+# font size and scale. Long-lived workers see many sizes, so the cache is bounded.
+glyph_cache_size = int(os.environ.get("PDF_PARSER_GLYPH_CACHE_SIZE", 4096))
+
+# Extractions the API runs at once, and how many more may wait for a slot before
+# requests are turned away with 503. "thread" runs them in threads of the API
+# process, "process" in a pool of dispatch_workers processes. Streamed
+# extractions always run in threads of the API process.
+dispatch_workers = int(os.environ.get("PDF_PARSER_DISPATCH_WORKERS", 1))
+dispatch_queue_size = int(os.environ.get("PDF_PARSER_DISPATCH_QUEUE_SIZE", 4))
+dispatch_executor = os.environ.get("PDF_PARSER_DISPATCH_EXECUTOR", "thread")
+# Retry-After seconds sent with a 503 until extraction times have been measured
+dispatch_retry_after = int(os.environ.get("PDF_PARSER_DISPATCH_RETRY_AFTER", 5))
+
+# Background jobs keep their uploads and the SQLite job store here, so queued and
+# interrupted jobs survive a restart. job_workers jobs run at once, each in its
+# own process, on top of the dispatch_workers extractions.
+job_folder = Path(os.environ.get("PDF_PARSER_JOB_FOLDER", "jobs/"))
+job_workers = int(os.environ.get("PDF_PARSER_JOB_WORKERS", 1))
+
+# Extraction results are cached here by pdf hash, up to this many compressed
+# bytes. 0 disables the cache.
+result_cache_folder = Path(os.environ.get("PDF_PARSER_RESULT_CACHE_FOLDER", "cache/"))
+result_cache_max_bytes = int(os.environ.get("PDF_PARSER_RESULT_CACHE_MAX_BYTES", 512 * 1024 * 1024))
@@ -0,0 +1,204 @@
+import asyncio
+import math
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .config import dispatch_executor, dispatch_queue_size, dispatch_retry_after, dispatch_workers
+
+
+class DispatcherBusy(Exception):
+    """ Raised when the admission queue is full """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Extraction queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Admission:
+    """ Place of one admitted extraction, released once whatever ends it """
+
+    def __init__(self, dispatcher):
+        self.__dispatcher = dispatcher
+        self.__lock = threading.Lock()
+        self.started = False
+        self.released = False
+
+    def start(self):
+        with self.__lock:
+            self.started = True
+
+    def release(self, failed=False):
+        with self.__lock:
+            if self.released:
+                return
+            self.released = True
+        self.__dispatcher._finish(self, failed)
+
+
+class ExtractionDispatcher:
+    """ Runs extractions off the event loop with bounded concurrency. At most
+        `workers` extractions run at once and at most `queue_size` more wait for
+        a slot; anything beyond is rejected with DispatcherBusy, so callers can
+        answer 503 instead of piling up work.
+
+        With the "thread" executor the extraction runs in the dispatcher's own
+        threads. With "process" it runs in a process pool of `workers` processes
+        and the dispatcher threads only wait on it, which keeps the slot
+        accounting in this process. The executor only applies to run(): streamed
+        extractions (stream()) always run in threads of this process, and get
+        process isolation from their own page or batch worker pools.
+    """
+
+    def __init__(self, workers=dispatch_workers, queue_size=dispatch_queue_size,
+                 executor=dispatch_executor, retry_after=dispatch_retry_after):
+        """
+        Args:
+            workers (int): Extractions running at once
+            queue_size (int): Extractions allowed to wait for a slot
+            executor (str): "thread" or "process"
+            retry_after (int): Retry-After seconds before any duration is known
+        """
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unknown dispatch executor {executor}")
+        self.workers = max(int(workers), 1)
+        self.queue_size = max(int(queue_size), 0)
+        self.executor = executor
+        self.retry_after = retry_after
+        self.__slots = threading.Semaphore(self.workers)
+        self.__lock = threading.Lock()
+        # Every admitted call holds a thread, waiting ones block on a slot
+        self.__threads = ThreadPoolExecutor(max_workers=self.workers + self.queue_size,
+                                            thread_name_prefix="extraction")
+        self.__processes = None
+        if executor == "process":
+            # The pool grows from the dispatcher threads while the event loop and
+            # other requests run, so its processes must not be forked from them
+            self.__processes = ProcessPoolExecutor(max_workers=self.workers,
+                                                   mp_context=multiprocessing.get_context("spawn"))
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.mean_duration = None
+
+    def admit(self):
+        """ Takes a place in the queue
+        Returns:
+            Admission: To be released when the extraction ends
+        Raises:
+            DispatcherBusy: If every running slot and queue place is taken
+        """
+        with self.__lock:
+            if self.queued + self.in_flight >= self.workers + self.queue_size:
+                self.rejected += 1
+                raise DispatcherBusy(self.__estimate_wait())
+            self.queued += 1
+        return Admission(self)
+
+    def __estimate_wait(self):
+        if self.mean_duration is None:
+            return self.retry_after
+        # Waiting extractions drain `workers` at a time
+        rounds = (self.queued + self.in_flight) / self.workers
+        return max(1, math.ceil(self.mean_duration * rounds))
+
+    def __start(self, admission):
+        self.__slots.acquire()
+        with self.__lock:
+            self.queued -= 1
+            self.in_flight += 1
+        admission.start()
+        return time.monotonic()
+
+    def __record_duration(self, duration):
+        with self.__lock:
+            # Exponential moving average of the recent extractions
+            self.mean_duration = duration if self.mean_duration is None else (
+                0.8 * self.mean_duration + 0.2 * duration)
+
+    def _finish(self, admission, failed):
+        with self.__lock:
+            if admission.started:
+                self.in_flight -= 1
+            else:
+                self.queued -= 1
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+        if admission.started:
+            self.__slots.release()
+
+    def __run(self, admission, fn, args):
+        started_at = self.__start(admission)
+        failed = True
+        try:
+            if self.__processes is not None:
+                result = self.__processes.submit(fn, *args).result()
+            else:
+                result = fn(*args)
+            failed = False
+            return result
+        finally:
+            self.__record_duration(time.monotonic() - started_at)
+            admission.release(failed)
+
+    async def run(self, fn, *args, admission=None):
+        """ Admits fn(*args) and awaits its result without blocking the loop.
+            fn has to be picklable with the "process" executor.
+        Args:
+            admission (Admission): Place already taken with admit(), if any
+        Raises:
+            DispatcherBusy: If the queue is full
+        """
+        if admission is None:
+            admission = self.admit()
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.__threads, self.__run, admission, fn, args)
+        except RuntimeError:
+            # The thread pool is shut down, the call never ran
+            admission.release(failed=True)
+            raise
+
+    def stream(self, admission, gen_fn, *args):
+        """ Generator over gen_fn(*args) that waits for a running slot first. It
+            is meant to be iterated from worker threads, like starlette does with
+            synchronous response bodies. Every step may run in a different
+            thread, and a stream that is given up is closed wherever the
+            generator is dropped, so gen_fn must neither rely on its thread nor
+            block when closed. It runs in this process whatever the executor.
+        Args:
+            admission (Admission): Place taken with admit() before responding
+        """
+        started_at = self.__start(admission)
+        failed = True
+        try:
+            yield from gen_fn(*args)
+            failed = False
+        finally:
+            self.__record_duration(time.monotonic() - started_at)
+            admission.release(failed)
+
+    def stats(self):
+        """ Queue and slot counters, plus the running average extraction time """
+        with self.__lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "executor": self.executor,
+                "queued": self.queued,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "mean_duration": self.mean_duration,
+            }
+
+    def shutdown(self):
+        self.__threads.shutdown(wait=False)
+        if self.__processes is not None:
+            self.__processes.shutdown(wait=False)
@@ -0,0 +1,115 @@
+import fitz
+import numpy as np
+
+from .pdf_process import page_to_image, get_scanned_page_as_df
+
+# TextPage flags of every view, as page.getText("dict"), page.getTextPage() and
+# page.getText() use them in the installed PyMuPDF, so the views hold the same
+# text as reading the page directly. The dict view leaves out the image payloads,
+# which none of its readers use.
+VIEW_FLAGS = {
+    "dict": getattr(fitz, "TEXTFLAGS_DICT", fitz.TEXT_PRESERVE_WHITESPACE) & ~fitz.TEXT_PRESERVE_IMAGES,
+    "rawdict": 0,
+    "text": getattr(fitz, "TEXTFLAGS_TEXT", fitz.TEXT_PRESERVE_WHITESPACE),
+}
+
+
+class DocumentSession:
+    """ Per-document state shared by PageProcessor and TextExtractor.
+        Owns the open document and a scratch document for temporary pages, and
+        builds the TextPages of every page once, from which the dict, rawdict
+        and plain text views are served until the page is released. Views
+        with the same flags share a TextPage. OCR results of
+        scanned pages are kept the same way, so each page is OCRed once.
+    """
+
+    def __init__(self, pdf_fpath=None):
+        self.doc = fitz.open(pdf_fpath) if pdf_fpath is not None else None
+        self.__scratch_doc = None
+        self.__textpages = {}
+        self.__views = {}
+        self.__ocr_results = {}
+        self.__buffers = {}
+
+    @property
+    def scratch_doc(self):
+        """ Empty document for pages that are created and deleted again,
+            so the document being read is never mutated.
+        """
+        if self.__scratch_doc is None:
+            self.__scratch_doc = fitz.open()
+        return self.__scratch_doc
+
+    def get_buffer(self, name, shape, dtype=np.uint8):
+        """ Scratch array reused across pages as long as the shape is unchanged """
+        buffer = self.__buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self.__buffers[name] = buffer
+        return buffer
+
+    def get_page_image_buffer(self, page, scale):
+        """ BGR buffer with the shape of the page rendered at scale """
+        irect = (page.rect * fitz.Matrix(scale, scale)).irect
+        return self.get_buffer("page_image", (irect.height, irect.width, 3))
+
+    def get_textpage(self, page, flags):
+        key = (page.number, flags)
+        if key not in self.__textpages:
+            self.__textpages[key] = page.getTextPage(flags=flags)
+        return self.__textpages[key]
+
+    def __get_view(self, page, option):
+        key = (page.number, option)
+        if key not in self.__views:
+            textpage = self.get_textpage(page, VIEW_FLAGS[option])
+            if option == "dict":
+                self.__views[key] = textpage.extractDICT()
+            elif option == "rawdict":
+                self.__views[key] = textpage.extractRAWDICT()
+            else:
+                self.__views[key] = textpage.extractText()
+        return self.__views[key]
+
+    def get_dict(self, page):
+        return self.__get_view(page, "dict")
+
+    def get_rawdict(self, page):
+        return self.__get_view(page, "rawdict")
+
+    def get_text(self, page):
+        return self.__get_view(page, "text")
+
+    def get_scanned_page_df(self, page, scale, img=None, dpi=None):
+        """ OCR word DataFrame of a scanned page, keyed by page and render scale.
+        Args:
+            page (fitz.Page): Page to OCR
+            scale (int): Render scale of the page image
+            img (np.array): Page already rendered at scale, to avoid rendering it again
+            dpi (int): DPI of img
+        Returns:
+            pd.DataFrame: A copy of the stored result, free for the caller to modify
+        """
+        key = (page.number, scale)
+        if key not in self.__ocr_results:
+            if img is None:
+                img, dpi = page_to_image(page, scale, out=self.get_page_image_buffer(page, scale))
+            self.__ocr_results[key] = get_scanned_page_as_df(img, dpi, scale)
+        return self.__ocr_results[key].copy()
+
+    def release(self, page):
+        """ Drops the cached TextPages, views and OCR results of a finished page """
+        for cache in (self.__textpages, self.__views, self.__ocr_results):
+            for key in [key for key in cache if key[0] == page.number]:
+                del cache[key]
+
+    def close(self):
+        self.__textpages.clear()
+        self.__views.clear()
+        self.__ocr_results.clear()
+        self.__buffers.clear()
+        if self.__scratch_doc is not None:
+            self.__scratch_doc.close()
+            self.__scratch_doc = None
+        if self.doc is not None:
+            self.doc.close()
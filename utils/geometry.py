@@ -0,0 +1,241 @@
+from collections import defaultdict
+from itertools import product
+
+import numpy as np
+
+# Columns holding the box of a row in the page DataFrames
+BOX_COLUMNS = ["x1", "y1", "x2", "y2"]
+# Box of a block after normalize_block_width, grown while merging
+NORM_BOX_COLUMNS = ["norm_x1", "norm_y1", "norm_x2", "norm_y2"]
+
+
+def rects_to_array(rects):
+    """ (n, 4) float array of x0, y0, x1, y1 from an iterable of fitz.Rect or boxes """
+    if isinstance(rects, np.ndarray):
+        return rects.astype(np.float64).reshape(-1, 4)
+    return np.array([tuple(rect) for rect in rects], dtype=np.float64).reshape(-1, 4)
+
+
+def get_boxes(df, columns=BOX_COLUMNS):
+    """ Boxes of the rows of df as a (n, 4) float array """
+    return df[columns].to_numpy(dtype=np.float64).reshape(-1, 4)
+
+
+def is_valid(boxes):
+    """ Neither empty nor infinite in fitz terms """
+    return (boxes[..., 0] < boxes[..., 2]) & (boxes[..., 1] < boxes[..., 3])
+
+
+def is_empty(boxes):
+    return (boxes[..., 0] == boxes[..., 2]) | (boxes[..., 1] == boxes[..., 3])
+
+
+def is_infinite(boxes):
+    return (boxes[..., 0] > boxes[..., 2]) | (boxes[..., 1] > boxes[..., 3])
+
+
+def normalize(boxes):
+    boxes = boxes.reshape(-1, 4)
+    return np.column_stack((np.minimum(boxes[:, 0], boxes[:, 2]), np.minimum(boxes[:, 1], boxes[:, 3]),
+                            np.maximum(boxes[:, 0], boxes[:, 2]), np.maximum(boxes[:, 1], boxes[:, 3])))
+
+
+def intersects(boxes, box):
+    """ Mask of the boxes for which fitz.Rect(box).intersects(b) is True. The
+        overlap is computed on float32 values, as MuPDF does.
+    """
+    x0, y0, x1, y1 = box
+    if not (x0 < x1 and y0 < y1):
+        return np.zeros(len(boxes), dtype=bool)
+    x0, y0, x1, y1 = np.float32(x0), np.float32(y0), np.float32(x1), np.float32(y1)
+    boxes32 = boxes.astype(np.float32)
+    return (
+        is_valid(boxes)
+        & (np.maximum(boxes32[:, 0], x0) < np.minimum(boxes32[:, 2], x1))
+        & (np.maximum(boxes32[:, 1], y0) < np.minimum(boxes32[:, 3], y1))
+    )
+
+
+def contained_in(boxes, rect):
+    """ Mask of the boxes b for which `fitz.Rect(b) in rect` is True """
+    x0, y0, x1, y1 = normalize(np.asarray(tuple(rect), dtype=np.float64))[0]
+    if x0 == x1 or y0 == y1:
+        return np.zeros(len(boxes), dtype=bool)
+    norm = normalize(boxes)
+    # Empty boxes are in every non-empty rect
+    return is_empty(boxes) | (
+        (x0 <= norm[:, 0]) & (y0 <= norm[:, 1]) & (norm[:, 2] <= x1) & (norm[:, 3] <= y1)
+    )
+
+
+def union(box, boxes):
+    """ box grown by every box in boxes, as chained fitz.Rect.includeRect calls:
+        float32 values, empty boxes are skipped and infinite ones win.
+    """
+    boxes = boxes.reshape(-1, 4).astype(np.float32)
+    if len(boxes) == 0:
+        return np.array(box, dtype=np.float64)
+    box = np.array(box, dtype=np.float32)
+    if is_valid(box) and is_valid(boxes).all():
+        box = np.concatenate((np.minimum(box[:2], boxes[:, :2].min(axis=0, initial=np.inf)),
+                              np.maximum(box[2:], boxes[:, 2:].max(axis=0, initial=-np.inf))))
+        return box.astype(np.float64)
+    for other in boxes:
+        if is_empty(other) or (is_infinite(box) and not is_empty(box)):
+            continue
+        elif is_empty(box) or is_infinite(other):
+            box = other.copy()
+        else:
+            box = np.concatenate((np.minimum(box[:2], other[:2]), np.maximum(box[2:], other[2:])))
+    return box.astype(np.float64)
+
+
+def widths(boxes):
+    return np.abs(boxes[:, 2] - boxes[:, 0])
+
+
+def heights(boxes):
+    return np.abs(boxes[:, 3] - boxes[:, 1])
+
+
+def areas(boxes):
+    """ Areas of the boxes as fitz.Rect.getArea, 0 for empty ones """
+    return np.where(is_empty(boxes), 0.0, widths(boxes) * heights(boxes))
+
+
+def centroids(boxes):
+    """ x and y centroid of every box """
+    return (boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2
+
+
+class RectIndex:
+    """ Uniform grid over the rectangles of a page, answering the queries the
+        layout stages used to run with `series.apply(rect.intersects)` against
+        every row. Each rectangle is registered in the grid cells it covers, so a
+        query only tests the rectangles sharing a cell with it. Results are
+        positions into the indexed sequence, in ascending order, and follow
+        fitz.Rect semantics exactly.
+    """
+
+    def __init__(self, rects, cell_size=None):
+        """
+        Args:
+            rects (iterable): (n, 4) box array, or fitz.Rect / (x0, y0, x1, y1) items
+            cell_size (float): Edge of a grid cell in points, by default twice the
+                               median extent of the rectangles
+        """
+        self.coords = rects_to_array(rects)
+        valid = is_valid(self.coords)
+        self.__empty = is_empty(self.coords)
+        if cell_size is None:
+            extents = np.maximum(self.coords[valid, 2] - self.coords[valid, 0],
+                                 self.coords[valid, 3] - self.coords[valid, 1])
+            cell_size = 2 * np.median(extents) if extents.size else 1
+        self.cell_size = max(float(cell_size), 1.0)
+        if (~self.__empty).any():
+            cells = np.floor(normalize(self.coords[~self.__empty]) / self.cell_size).astype(np.int64)
+            self.__bounds = (cells[:, 0].min(), cells[:, 1].min(), cells[:, 2].max(), cells[:, 3].max())
+        else:
+            self.__bounds = (0, 0, 0, 0)
+        self.__cells = defaultdict(list)
+        for i in np.flatnonzero(~self.__empty):
+            self.__register(i)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __cells_of(self, x0, y0, x1, y1):
+        min_x, min_y, max_x, max_y = self.__bounds
+        ix0, iy0 = max(int(np.floor(x0 / self.cell_size)), min_x), max(int(np.floor(y0 / self.cell_size)), min_y)
+        ix1, iy1 = min(int(np.floor(x1 / self.cell_size)), max_x), min(int(np.floor(y1 / self.cell_size)), max_y)
+        return product(range(ix0, ix1 + 1), range(iy0, iy1 + 1))
+
+    def __register(self, i):
+        # Inverted rectangles are registered by their normalized extent for contained()
+        for cell in self.__cells_of(*normalize(self.coords[i])[0]):
+            ids = self.__cells[cell]
+            if not ids or ids[-1] != i:
+                ids.append(i)
+
+    def __candidates(self, x0, y0, x1, y1):
+        ids = [self.__cells[cell] for cell in self.__cells_of(x0, y0, x1, y1) if cell in self.__cells]
+        if not ids:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(ids).astype(np.int64))
+
+    def update(self, i, rect):
+        """ Replaces rectangle i, e.g. after it was grown in place with includeRect.
+            Only growing rectangles are supported, stale cells are filtered by the
+            exact test of every query.
+        """
+        self.coords[i] = tuple(rect)
+        self.__empty[i] = is_empty(self.coords[i])
+        if not self.__empty[i]:
+            self.__register(i)
+
+    def intersecting(self, rect):
+        """ Positions of the rectangles r for which rect.intersects(r) is True """
+        x0, y0, x1, y1 = tuple(rect)
+        if not (x0 < x1 and y0 < y1):
+            return np.empty(0, dtype=np.int64)
+        ids = self.__candidates(x0, y0, x1, y1)
+        return ids[intersects(self.coords[ids], (x0, y0, x1, y1))]
+
+    def contained(self, rect):
+        """ Positions of the rectangles r for which `r in rect` is True """
+        x0, y0, x1, y1 = tuple(rect)
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        if x0 == x1 or y0 == y1:
+            return np.empty(0, dtype=np.int64)
+        # Empty rectangles are in every non-empty one, and in no grid cell
+        ids = np.union1d(self.__candidates(x0, y0, x1, y1), np.flatnonzero(self.__empty))
+        return ids[contained_in(self.coords[ids], (x0, y0, x1, y1))]
+
+
+def overlap_components(boxes, mask=None):
+    """ Clusters of boxes connected by overlaps, found with union-find over the
+        intersecting pairs reported by a RectIndex.
+    Args:
+        boxes (np.array): (n, 4) boxes
+        mask (np.array): Boxes that take part, the others stay alone
+    Returns:
+        np.array: Cluster id of every box. Ids follow the position of the first
+                  box of each cluster, so the labelling is deterministic.
+    """
+    n = len(boxes)
+    parent = np.arange(n)
+
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    ids = np.flatnonzero(mask) if mask is not None else np.arange(n)
+    index = RectIndex(boxes[ids])
+    for pos, i in enumerate(ids):
+        for j in ids[index.intersecting(boxes[i])]:
+            if j > i:
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    # The smaller position stays the root
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+    roots = np.array([find(i) for i in range(n)], dtype=np.int64)
+    # Roots are the first member of their cluster, rank them by position
+    return np.unique(roots, return_inverse=True)[1]
+
+
+def union_by_component(boxes, components):
+    """ Bounding box of every cluster from overlap_components, in cluster order """
+    n_components = components.max() + 1 if len(components) else 0
+    merged = np.empty((n_components, 4), dtype=np.float64)
+    merged[:, :2] = np.inf
+    merged[:, 2:] = -np.inf
+    np.minimum.at(merged[:, 0], components, boxes[:, 0])
+    np.minimum.at(merged[:, 1], components, boxes[:, 1])
+    np.maximum.at(merged[:, 2], components, boxes[:, 2])
+    np.maximum.at(merged[:, 3], components, boxes[:, 3])
+    return merged
@@ -0,0 +1,311 @@
+import logging
+import multiprocessing
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from .pdf_parse import iter_pdf_extraction
+from .pc_relation import RELATION_COLUMNS
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+JOB_COLUMNS = ["job_id", "pdf_name", "pdf_path", "pages", "first_pages", "status", "page_count",
+               "pages_done", "block_count", "error", "created_at", "updated_at"]
+
+
+def process_token(pid):
+    """ Boot id and start time of a process, which tell it apart from a later
+        process that reuses its pid
+    Returns:
+        str: None where /proc is not available
+    """
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            boot_id = f.read().strip()
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # Fields after the command name, which may hold spaces. starttime is field 22.
+    start_time = stat.rsplit(")", 1)[1].split()[19]
+    return f"{boot_id}:{start_time}"
+
+
+def is_process_alive(pid, token=None):
+    """
+    Args:
+        pid (int): Process id
+        token (str): process_token of the process when it was recorded, if known
+    Returns:
+        bool: True if the process still runs and is not a later one with the same pid
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return token is None or process_token(pid) == token
+
+
+class JobStore:
+    """ Jobs and their extracted blocks in a local SQLite database. Every call
+        opens its own connection, so the store can be shared between threads and
+        between the processes of one host. A running job belongs to the process
+        that claimed it until that process dies. Owners are recorded with their
+        process_token, so a pid reused after a crash does not keep a job.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        with self.__connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    pdf_name TEXT NOT NULL,
+                    pdf_path TEXT NOT NULL,
+                    pages TEXT,
+                    first_pages INTEGER,
+                    status TEXT NOT NULL,
+                    page_count INTEGER,
+                    pages_done INTEGER NOT NULL DEFAULT 0,
+                    block_count INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    owner_pid INTEGER,
+                    owner_token TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS blocks (
+                    job_id TEXT NOT NULL,
+                    block_id INTEGER NOT NULL,
+                    parent_id INTEGER NOT NULL,
+                    depth INTEGER NOT NULL,
+                    label TEXT,
+                    text TEXT,
+                    page_no INTEGER,
+                    PRIMARY KEY (job_id, block_id)
+                )""")
+            # Databases created before page selection and owner tokens lack their columns
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, column_type in (("pages", "TEXT"), ("first_pages", "INTEGER"), ("owner_token", "TEXT")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+
+    def __connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def create_job(self, pdf_name, pdf_path, pages=None, first_pages=None):
+        """
+        Args:
+            pages (str): Page selection to extract, all pages when None
+            first_pages (int): Only pages among the first first_pages
+        Returns:
+            str: Id of the new queued job
+        """
+        job_id = str(uuid4())
+        now = time.time()
+        with self.__connect() as conn:
+            conn.execute("INSERT INTO jobs (job_id, pdf_name, pdf_path, pages, first_pages, status, created_at, "
+                         "updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (job_id, pdf_name, str(pdf_path), pages, first_pages, QUEUED, now, now))
+        return job_id
+
+    def get_job(self, job_id):
+        """
+        Returns:
+            dict: Row of the job with JOB_COLUMNS, None if it does not exist
+        """
+        with self.__connect() as conn:
+            row = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE job_id = ?",
+                               (job_id,)).fetchone()
+        return dict(zip(JOB_COLUMNS, row)) if row is not None else None
+
+    def claim_job(self, job_id):
+        """ Marks the job running in this process, unless it is finished or
+            running in another live process. The extraction state is not kept
+            between pages, so a job left running by a dead process starts over:
+            the blocks of the interrupted run are dropped.
+        Returns:
+            bool: True if the job was claimed
+        """
+        pid, token = os.getpid(), process_token(os.getpid())
+        with self.__connect() as conn:
+            row = conn.execute("SELECT status, owner_pid, owner_token FROM jobs WHERE job_id = ?",
+                               (job_id,)).fetchone()
+            if row is None:
+                return False
+            status, owner_pid, owner_token = row
+            if status in (DONE, FAILED) or (status == RUNNING and (owner_pid, owner_token) != (pid, token)
+                                            and is_process_alive(owner_pid, owner_token)):
+                return False
+            # Only claimed if no other process changed the job since it was read
+            claimed = conn.execute("UPDATE jobs SET status = ?, owner_pid = ?, owner_token = ?, pages_done = 0, "
+                                   "block_count = 0, error = NULL, updated_at = ? WHERE job_id = ? AND status = ? "
+                                   "AND owner_pid IS ? AND owner_token IS ?",
+                                   (RUNNING, pid, token, time.time(), job_id, status, owner_pid,
+                                    owner_token)).rowcount == 1
+            if claimed:
+                conn.execute("DELETE FROM blocks WHERE job_id = ?", (job_id,))
+        return claimed
+
+    def add_page(self, job_id, pages_done, page_count, blocks):
+        """ Stores the blocks finalized with a page and the page progress in one
+            transaction.
+        Args:
+            pages_done (int): Pages processed so far
+            page_count (int): Count of the pages the job extracts
+            blocks (pd.DataFrame): Blocks with RELATION_COLUMNS
+        """
+        rows = [(job_id, int(block_id), int(parent_id), int(depth), label, text, int(page))
+                for block_id, parent_id, depth, label, text, page
+                in blocks[RELATION_COLUMNS].itertuples(index=False)]
+        with self.__connect() as conn:
+            conn.executemany("INSERT INTO blocks (job_id, block_id, parent_id, depth, label, text, page_no) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.execute("UPDATE jobs SET pages_done = ?, page_count = ?, block_count = block_count + ?, "
+                         "updated_at = ? WHERE job_id = ?",
+                         (pages_done, page_count, len(rows), time.time(), job_id))
+
+    def finish_job(self, job_id, error=None, owner_pid=None):
+        """
+        Args:
+            error (str): Message of a failed job, None if it is done
+            owner_pid (int): Only finish the job while it runs in this process
+        Returns:
+            bool: True if the job was finished
+        """
+        query = "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE job_id = ?"
+        params = (FAILED if error is not None else DONE, error, time.time(), job_id)
+        if owner_pid is not None:
+            query += " AND status = ? AND owner_pid = ?"
+            params += (RUNNING, owner_pid)
+        with self.__connect() as conn:
+            return conn.execute(query, params).rowcount == 1
+
+    def get_blocks(self, job_id, offset=0, limit=1000):
+        """
+        Returns:
+            list: Blocks of the job in block id order, as dicts with RELATION_COLUMNS
+        """
+        with self.__connect() as conn:
+            rows = conn.execute(f"SELECT {', '.join(RELATION_COLUMNS)} FROM blocks WHERE job_id = ? "
+                                "ORDER BY block_id LIMIT ? OFFSET ?", (job_id, limit, offset)).fetchall()
+        return [dict(zip(RELATION_COLUMNS, row)) for row in rows]
+
+    def unfinished_jobs(self):
+        """ Ids of the queued and running jobs, oldest first """
+        with self.__connect() as conn:
+            rows = conn.execute("SELECT job_id FROM jobs WHERE status IN (?, ?) ORDER BY created_at",
+                                (QUEUED, RUNNING)).fetchall()
+        return [row[0] for row in rows]
+
+
+def stop_job_process(signum, frame):
+    sys.exit(128 + signum)
+
+
+def run_job(db_path, job_id):
+    """ Job process entry point. Claims the job and writes the blocks of every
+        page to the store as they complete. The pdf is removed once the job is
+        done or failed.
+    Args:
+        db_path (str): Path to the SQLite database of the JobStore
+        job_id (str): Id of a queued or interrupted job
+    """
+    signal.signal(signal.SIGTERM, stop_job_process)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    store = JobStore(db_path)
+    job = store.get_job(job_id)
+    if job is None or not store.claim_job(job_id):
+        return
+    try:
+        page_blocks = iter_pdf_extraction(job["pdf_path"], job["pdf_name"], pages=job["pages"],
+                                          first_pages=job["first_pages"])
+        for pages_done, page_count, blocks in page_blocks:
+            store.add_page(job_id, pages_done, page_count, blocks)
+        store.finish_job(job_id)
+    except Exception as e:
+        logging.error(f"> error in job {job_id} for {job['pdf_name']}: {e}")
+        store.finish_job(job_id, error=str(e))
+    if os.path.exists(job["pdf_path"]):
+        os.remove(job["pdf_path"])
+
+
+class JobRunner:
+    """ Runs the jobs of a JobStore, at most `workers` at a time, each in a
+        process of its own. Jobs do not take dispatcher slots, so the server
+        runs up to dispatch_workers extractions plus `workers` jobs at once.
+        Each job streams its pages into the store as they complete, so
+        progress and the blocks so far can be read while it runs.
+    """
+
+    def __init__(self, store, workers=1):
+        self.store = store
+        # Each thread waits on the process of one job
+        self.__executor = ThreadPoolExecutor(max_workers=max(int(workers), 1), thread_name_prefix="job")
+        self.__lock = threading.Lock()
+        self.__submitted = set()
+        self.__processes = {}
+        self.__stopping = threading.Event()
+
+    def submit(self, job_id):
+        with self.__lock:
+            if job_id in self.__submitted:
+                return
+            self.__submitted.add(job_id)
+        self.__executor.submit(self.__run, job_id)
+
+    def restart_unfinished(self):
+        """ Resubmits the jobs a previous process left queued or running. Running
+            ones start over from their first page.
+        Returns:
+            list: Ids of the resubmitted jobs
+        """
+        job_ids = self.store.unfinished_jobs()
+        for job_id in job_ids:
+            self.submit(job_id)
+        return job_ids
+
+    def __run(self, job_id):
+        try:
+            # Spawned, as a forked child would inherit the SQLite locks of the other threads
+            process = multiprocessing.get_context("spawn").Process(target=run_job, args=(self.store.db_path, job_id),
+                                                                   name=f"job-{job_id}")
+            with self.__lock:
+                if self.__stopping.is_set():
+                    return
+                process.start()
+                self.__processes[job_id] = process
+            process.join()
+            if process.exitcode != 0 and not self.__stopping.is_set():
+                # The job process crashed or was killed while it owned the job
+                error = f"Job process exited with code {process.exitcode}"
+                if self.store.finish_job(job_id, error=error, owner_pid=process.pid):
+                    logging.error(f"> error in job {job_id}: {error}")
+                    job = self.store.get_job(job_id)
+                    if os.path.exists(job["pdf_path"]):
+                        os.remove(job["pdf_path"])
+        except Exception as e:
+            logging.error(f"> error in running job {job_id}: {e}")
+        finally:
+            with self.__lock:
+                self.__submitted.discard(job_id)
+                self.__processes.pop(job_id, None)
+
+    def shutdown(self):
+        """ Stops the running job processes and drops the queued jobs. Stopped
+            jobs stay running in the store and start over with the next process.
+        """
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+        with self.__lock:
+            self.__stopping.set()
+            for process in self.__processes.values():
+                process.terminate()
@@ -0,0 +1,198 @@
+import logging
+import os
+import subprocess
+import threading
+from io import BytesIO
+from queue import Queue, Empty
+
+import cv2
+import numpy as np
+from lxml import etree
+
+from .config import ocr_workers, ocr_omp_threads
+
+# Must be set before libtesseract is loaded, and is inherited by tesseract subprocesses
+os.environ.setdefault("OMP_THREAD_LIMIT", str(ocr_omp_threads))
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+from pytesseract import pytesseract
+
+OCR_LANG = "eng"
+OCR_OEM = 1  # LSTM only
+OCR_PSM = 1  # Automatic page segmentation with OSD
+
+HOCR_COLUMNS = ["x1", "y1", "x2", "y2", "conf", "size", "block_num", "line_num", "span_num"]
+
+
+class OCREnginePool:
+    """ Pool of long-lived Tesseract engines fed with in-memory page images.
+        With tesserocr installed (requirements-ocr.txt), every engine is a
+        loaded TessBaseAPI that is reused across pages, so the eng model is
+        loaded once per engine. Without it, each call runs the tesseract binary
+        on an image piped through stdin, with at most `size` processes running
+        at a time, and the model is loaded for every page.
+
+        Both paths give Tesseract the resolution of the page image. The config
+        string before this pool put --dpi after a bare argument, which tesseract
+        reads as config file names, so the resolution was never applied and
+        Tesseract guessed it from the text height. OCR output of scanned pages
+        can differ from those versions for that reason.
+    """
+
+    def __init__(self, size=ocr_workers, lang=OCR_LANG):
+        self.size = max(1, size)
+        self.lang = lang
+        self.__engines = Queue()
+        # Held while an engine or tesseract process is in use, so at most size
+        # engines are ever created and a failed creation frees its slot again
+        self.__slots = threading.BoundedSemaphore(self.size)
+        if tesserocr is None:
+            logging.warning("> tesserocr is not installed, OCR runs the tesseract binary for every page")
+
+    def __create_engine(self):
+        return tesserocr.PyTessBaseAPI(lang=self.lang, oem=tesserocr.OEM.LSTM_ONLY,
+                                       psm=tesserocr.PSM.AUTO_OSD)
+
+    def __api_to_hocr(self, img, dpi):
+        with self.__slots:
+            try:
+                engine = self.__engines.get_nowait()
+            except Empty:
+                engine = self.__create_engine()
+            try:
+                height, width = img.shape[:2]
+                channels = 1 if img.ndim == 2 else img.shape[2]
+                if channels >= 3:
+                    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB if channels == 3 else cv2.COLOR_BGRA2RGBA)
+                engine.SetImageBytes(img.tobytes(), width, height, channels, width * channels)
+                engine.SetSourceResolution(dpi)
+                return engine.GetHOCRText(0).encode("utf-8")
+            finally:
+                engine.Clear()
+                self.__engines.put(engine)
+
+    def __cli_to_hocr(self, img, dpi):
+        # BMP is decoded by leptonica without external image libraries
+        _, buf = cv2.imencode(".bmp", img)
+        command = [pytesseract.tesseract_cmd, "stdin", "stdout", "-l", self.lang,
+                   "--oem", str(OCR_OEM), "--psm", str(OCR_PSM), "--dpi", str(dpi), "hocr"]
+        with self.__slots:
+            proc = subprocess.run(command, input=buf.tobytes(), stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise RuntimeError(f"tesseract failed: {proc.stderr.decode('utf-8', 'replace')}")
+        return proc.stdout
+
+    def image_to_hocr(self, img, dpi):
+        """ Runs OCR on a page image.
+        Args:
+            img (np.array): BGR or grayscale page image
+            dpi (int): Resolution of the image
+        Returns:
+            bytes: hOCR output of the page
+        """
+        if tesserocr is not None:
+            return self.__api_to_hocr(img, dpi)
+        return self.__cli_to_hocr(img, dpi)
+
+    def close(self):
+        while True:
+            try:
+                self.__engines.get_nowait().End()
+            except Empty:
+                break
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_ocr_pool():
+    """ Process wide engine pool, created on first use """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = OCREnginePool()
+        return _pool
+
+
+def parse_hocr(hocr, scale=1):
+    """ Streams hOCR output into columnar word arrays without building a tree.
+        Only words inside ocr_carea blocks are read. Lines are the direct span
+        children of a paragraph, numbered within it, and words are numbered within
+        their line. Words that are a single space are skipped but still counted.
+    Args:
+        hocr (bytes): hOCR document or fragment
+        scale (int): Scale of the OCRed image, the bboxes are divided by it
+    Returns:
+        dict: "text" list plus numpy arrays for HOCR_COLUMNS. x_wconf goes to
+              "conf", "size" is x_fsize if present, else the scaled word height.
+    """
+    max_words = hocr.count(b"ocrx_word")
+    columns = {col: np.empty(max_words, dtype=np.float64) for col in HOCR_COLUMNS[:6]}
+    columns.update({col: np.empty(max_words, dtype=np.int64) for col in HOCR_COLUMNS[6:]})
+    texts = []
+    x1, y1, x2, y2 = columns["x1"], columns["y1"], columns["x2"], columns["y2"]
+    conf, size = columns["conf"], columns["size"]
+    block_nums, line_nums, span_nums = columns["block_num"], columns["line_num"], columns["span_num"]
+
+    n = 0
+    block_num, line_num, word_num = -1, -1, -1
+    in_block, par, line = False, None, None
+    for event, elem in etree.iterparse(BytesIO(hocr), events=("start", "end"), recover=True):
+        if elem.tag.rsplit("}", 1)[-1] not in ("div", "p", "span"):
+            continue
+        css_class = elem.get("class")
+        if event == "start":
+            if css_class == "ocr_carea":
+                in_block = True
+                block_num += 1
+            elif css_class == "ocr_par" and in_block:
+                par = elem
+                line_num = -1
+            elif par is not None and line is None and elem.getparent() is par:
+                line = elem
+                line_num += 1
+                word_num = -1
+            continue
+
+        if css_class == "ocrx_word" and line is not None:
+            word_num += 1
+            text = "".join(elem.itertext())
+            if text != " " and n < max_words:
+                word_conf, word_size = np.nan, None
+                for prop in elem.get("title", "").split(";"):
+                    prop = prop.split()
+                    if not prop:
+                        continue
+                    if prop[0] == "bbox":
+                        x1[n], y1[n] = int(prop[1]) / scale, int(prop[2]) / scale
+                        x2[n], y2[n] = int(prop[3]) / scale, int(prop[4]) / scale
+                    elif prop[0] == "x_wconf":
+                        word_conf = int(prop[1])
+                    elif prop[0] == "x_fsize":
+                        word_size = int(prop[1])
+                conf[n] = word_conf
+                size[n] = y2[n] - y1[n] if word_size is None else word_size
+                block_nums[n], line_nums[n], span_nums[n] = block_num, line_num, word_num
+                texts.append(text)
+                n += 1
+        elif elem is line:
+            line = None
+        elif elem is par:
+            par = None
+        elif css_class == "ocr_carea":
+            in_block = False
+        else:
+            continue
+        # Finished subtrees are no longer needed
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+    result = {col: arr[:n] for col, arr in columns.items()}
+    result["text"] = texts
+    return result
@@ -3,62 +3,37 @@ import numpy as np
 import pandas as pd
 import fitz
 from .text_extract import TextExtractor
-from .pdf_process import page_to_df, check_overlap_area, page_to_image, get_scanned_page_as_df
+from .doc_session import DocumentSession
+from .pdf_process import page_to_df, check_overlap_area
+from .geometry import (BOX_COLUMNS, NORM_BOX_COLUMNS, RectIndex, centroids, get_boxes, overlap_components,
+                       union, widths)
 import logging
 
 
 class PageProcessor:
-    def __init__(self, is_scanned=False):
+    def __init__(self, is_scanned=False, session=None):
         # self.page = page
         self.is_scanned = is_scanned
-        self.txt_extractor = TextExtractor(is_scanned)
-        self.group_no = 0
-
-    def __get_rect_width(self, rect):
-        return rect.width
-
-    def __get_centroid_coord(self, coord1, coord2):
-        return (coord1 + coord2) / 2
-
-    def __create_coord_groups_helper(self, diff, max_diff):
-        """
-        Helper function to vectorize __create_coord_groups function
-        """
-        if diff > max_diff:
-            self.group_no += 1
-        return self.group_no
+        self.session = session if session is not None else DocumentSession()
+        self.txt_extractor = TextExtractor(is_scanned, self.session)
 
     def __create_coord_groups(self, col, max_diff):
         """
-        Function to group the data by coordinates hence creating either column numbers or line numbers
+        Function to group the data by coordinates hence creating either column numbers or line numbers.
+        A new group starts wherever the gap to the previous sorted value exceeds max_diff.
         """
-        col = col.copy()
-        # prev_item = -1
-        self.group_no = 0
-        ret_col = pd.Series()
-        col.sort_values(ascending=True, inplace=True)
-        new_col = col.copy()
-        new_col = new_col.shift(1)
-        new_col = col - new_col
-        ret_col = new_col.apply(
-            lambda diff: self.__create_coord_groups_helper(diff, max_diff))
-        return ret_col
+        col = col.sort_values(ascending=True)
+        return (col.diff() > max_diff).cumsum()
 
     def __adjust_df_format(self, df):
         """ Arrange dataframe column into format required for processing
         Required Columns: ["sx1", "x1", "y1", "x2", "y2",
                             "text", "size", "style", "color",
-                            "font", "block_num", "pdf_rect", "cv_rect",
-                            "label"]
+                            "font", "block_num", "label"]
         Args:
             df (pd.DataFrame): Dataframe whose format needs to be changed.
         """
-        df["sx1"] = df["cv_rect"].apply(lambda rect: rect.x0)
-        df["x1"] = df["cv_rect"].apply(lambda rect: rect.x0)
-        df["x2"] = df["cv_rect"].apply(lambda rect: rect.x1)
-        df["y1"] = df["cv_rect"].apply(lambda rect: rect.y0)
-        df["y2"] = df["cv_rect"].apply(lambda rect: rect.y1)
-        df["pdf_rect"] = df["cv_rect"]
+        df["sx1"] = df["x1"]
         df["size"] = None
         df["style"] = None
         df["color"] = None
@@ -88,9 +63,43 @@ class PageProcessor:
             logging.error(f"> error in removing border elements for {self.file_name}, {page.number}")
             return data_df
 
+    def __repeated_sort_order(self, values, times):
+        """ Positions of values after sorting them `times` times in a row with
+            the default, unstable quicksort. Equal values are permuted by every
+            sort, always in the same way, so the permutation of the repeated
+            sorts is raised to a power on its cycles instead of sorting again.
+        """
+        order = np.argsort(values, kind="quicksort")
+        perm = np.argsort(values[order], kind="quicksort")
+        steps = times - 1
+        if steps <= 0:
+            return order
+        final = np.empty_like(perm)
+        seen = np.zeros(len(perm), dtype=bool)
+        for start in np.flatnonzero(perm != np.arange(len(perm))):
+            if seen[start]:
+                continue
+            cycle = [start]
+            seen[start] = True
+            nxt = perm[start]
+            while nxt != start:
+                cycle.append(nxt)
+                seen[nxt] = True
+                nxt = perm[nxt]
+            cycle = np.array(cycle)
+            final[cycle] = np.roll(cycle, -(steps % len(cycle)))
+        fixed = ~seen
+        final[fixed] = np.flatnonzero(fixed)
+        return order[final]
+
     def add_pagebreak(self, data_df):
         """ This function is used to create pagebreaks in cases where the
             page contains both single column and multi-column data.
+            Blocks overlapping any other block along the y axis are flagged in
+            "intersection" by counting, over the sorted y1 and y2 values, the
+            blocks starting before each block ends minus those ending before it
+            starts. A sweep down the page in y1 order then starts a new segment
+            whenever that flag changes.
         Args:
             data_df (pd.DataFrame): Merged dataframe with both text and table data
         Returns:
@@ -98,37 +107,37 @@ class PageProcessor:
                           which divides the page into parts (pagebreaks).
         """
         try:
-            for index, row in data_df.iterrows():
-                if row["label"] == "table_image" or row["label"] == "table_html":
-                    continue
-                y1 = row["y1"]
-                y2 = row["y2"]
-                # CHECKING FOR INTERSECTIONS ALONG Y AXIS
-                newdf = data_df[
-                    data_df.apply(lambda x: (
-                            x["y1"] <= y2 and x["y2"] >= y1), axis=1)
-                ]
-                if len(newdf.index) > 1:
-                    data_df.loc[index, "intersection"] = 1
-                cur = 0
-                segment = 0
-                data_df.sort_values(by=["y1"], ascending=[True], inplace=True)
-                for index1, row1 in data_df.iterrows():
-                    if row1["label"] == "table_image" or row1["label"] == "table_html":
-                        data_df.loc[index1, "multicolumn"] = segment
-                        continue
-                    if row1["intersection"] != cur:
-                        segment += 1
-                        cur = row1["intersection"]
-                        data_df.loc[index1, "multicolumn"] = segment
-                    else:
-                        data_df.loc[index1, "multicolumn"] = segment
+            is_table = data_df["label"].isin(["table_image", "table_html"]).to_numpy()
+            n_text = int((~is_table).sum())
+            if n_text == 0:
+                return data_df
+            y1 = data_df["y1"].to_numpy(dtype=np.float64)
+            y2 = data_df["y2"].to_numpy(dtype=np.float64)
+            # CHECKING FOR INTERSECTIONS ALONG Y AXIS
+            if (y1 <= y2).all():
+                count = (np.searchsorted(np.sort(y1), y2, side="right")
+                         - np.searchsorted(np.sort(y2), y1, side="left"))
+            else:
+                count = ((y1[None, :] <= y2[:, None]) & (y2[None, :] >= y1[:, None])).sum(axis=1)
+            intersection = data_df["intersection"].to_numpy().copy()
+            intersection[~is_table & (count > 1)] = 1
+            data_df["intersection"] = intersection
+
+            # The blocks used to be sorted by y1 once per text block
+            data_df = data_df.take(self.__repeated_sort_order(y1, n_text))
+            is_table = data_df["label"].isin(["table_image", "table_html"]).to_numpy()
+            flags = data_df["intersection"].to_numpy()[~is_table]
+            changes = flags != np.concatenate(([0], flags[:-1]))
+            segment = np.zeros(len(data_df), dtype=np.int64)
+            segment[~is_table] = np.cumsum(changes)
+            # Tables take the segment of the text block above them
+            data_df["multicolumn"] = np.maximum.accumulate(segment)
             # self.data_df=df
             return data_df
         except Exception as e:
             logging.error(f"> error in adding pagebreaks for {self.file_name}, {self.page_num}")
 
-            data_df.loc[index1, "multicolumn"] = 1
+            data_df["multicolumn"] = 1
             return data_df
 
     def normalize_block_width(self, part_df):
@@ -141,30 +150,38 @@ class PageProcessor:
         try:
             part_df["col_no"] = self.__create_coord_groups(part_df["x1"], 50)
             part_df["quant_y"] = self.__create_coord_groups(part_df["y1"], 10)
-            part_df["cv_rect_width"] = part_df["cv_rect"].apply(
-                self.__get_rect_width)
+            part_df["cv_rect_width"] = widths(get_boxes(part_df))
             part_df.sort_values(by="col_no", ascending=True, inplace=True)
-            part_df["norm_rect"] = np.nan
-            part_df["norm_rect"] = part_df["norm_rect"].astype("object")
-            for index, x in part_df["col_no"].iteritems():
-                max_width = part_df[
-                    (part_df["col_no"] == x)
-                    & (part_df["label"] != "figure")
-                    & (part_df["label"] != "table")
-                    ]["cv_rect_width"].mean()
-                x1, y1, x2, y2 = part_df.loc[index]["cv_rect"]
-                if not np.isnan(max_width):
-                    x2 = part_df.at[index, "x1"] + max_width
-                part_df.at[index, "norm_rect"] = fitz.Rect(x1, y1, x2, y2)
+            is_block = (part_df["label"] != "figure") & (part_df["label"] != "table")
+            # Mean width of the blocks of every column, NaN if it only has figures and tables
+            col_width = part_df[is_block].groupby("col_no")["cv_rect_width"].agg(lambda width: width.mean())
+            max_width = part_df["col_no"].map(col_width).to_numpy(dtype=np.float64)
+            has_width = ~np.isnan(max_width)
+            norm_boxes = get_boxes(part_df)
+            norm_boxes[has_width, 2] = part_df["x1"].to_numpy(dtype=np.float64)[has_width] + max_width[has_width]
+            for col, values in zip(NORM_BOX_COLUMNS, norm_boxes.T):
+                part_df[col] = values
             return part_df
         except Exception as e:
             logging.error(f"> error in block normalisation for {self.file_name}, {self.page_num}")
 
             return part_df
 
-    def merge_normalized_rect(self, part_df, page_df):
+    def merge_normalized_rect(self, part_df, page_df, span_index=None):
+        """ Merges the clusters of overlapping normalized blocks of the same style
+            into one block each, with the text of every span under the merged box.
+            Tables are never merged.
+        Args:
+            part_df (pd.DataFrame): Part of the page after normalize_block_width
+            page_df (pd.DataFrame): Spans of the page
+            span_index (RectIndex): Index over the spans of page_df, built if not given
+        Returns:
+            pd.DataFrame: part_df with every merged cluster replaced by one block
+        """
         try:
-            new_data = {}
+            if span_index is None:
+                span_index = RectIndex(get_boxes(page_df))
+            new_data = []
             if self.is_scanned:
                 unique_styles = part_df.groupby(["size"])
             else:
@@ -173,36 +190,30 @@ class PageProcessor:
             styles_dfs = [unique_styles.get_group(
                 x) for x in unique_styles.groups]
             for groupby_styles_df in styles_dfs:
-                for index, row in groupby_styles_df.iterrows():
-                    if row["label"] == "table" or row["label"] == "table_image" or row["label"] == "table_html":
+                is_table = groupby_styles_df["label"].isin(["table", "table_image", "table_html"]).to_numpy()
+                norm_boxes = get_boxes(groupby_styles_df, NORM_BOX_COLUMNS)
+                components = overlap_components(norm_boxes, ~is_table)
+                # Members of every cluster of overlapping blocks, in block order
+                order = np.argsort(components, kind="stable")
+                clusters = np.split(order, np.flatnonzero(np.diff(components[order])) + 1)
+                for members in clusters:
+                    if len(members) < 2:
                         continue
-                    # temp_df = groupby_styles_df[groupby_styles_df["norm_rect"].apply(
-                    #     lambda rect: check_overlap_area(list(row["norm_rect"]), rect, 0.8))]
-                    temp_df = groupby_styles_df[(
-                                                    groupby_styles_df["norm_rect"].apply(
-                                                        row["norm_rect"].intersects)) &
-                                                (groupby_styles_df["label"] != "table") &
-                                                (groupby_styles_df["label"] != "table_image") &
-                                                (groupby_styles_df["label"] != "table_html")
-                                                ]
-                    if len(temp_df) > 1:
-                        new_row = row.copy()
-                        new_row["x1"] = temp_df["x1"].min()
-                        new_row["y1"] = temp_df["y1"].min()
-                        new_row["x2"] = temp_df["x2"].max()
-                        new_row["y2"] = temp_df["y2"].max()
-                        for i, row1 in temp_df.iterrows():
-                            new_row["norm_rect"].includeRect(row1["norm_rect"])
-                            part_df.at[i, "to_delete"] = 1
-                        temp_df = page_df[
-                            page_df["rect"].apply(
-                                new_row["norm_rect"].intersects)
-                        ].copy()
-                        text = " ".join(temp_df["text"])
-                        new_row["text"] = text
-                        new_row["to_delete"] = 0
-                        new_data[new_row["norm_rect"]] = new_row.to_list()
-            t_df = pd.DataFrame(data=list(new_data.values()),
+                    temp_df = groupby_styles_df.iloc[members]
+                    new_row = temp_df.iloc[0].copy()
+                    new_row["x1"] = temp_df["x1"].min()
+                    new_row["y1"] = temp_df["y1"].min()
+                    new_row["x2"] = temp_df["x2"].max()
+                    new_row["y2"] = temp_df["y2"].max()
+                    norm_box = union(norm_boxes[members[0]], norm_boxes[members])
+                    new_row[NORM_BOX_COLUMNS] = norm_box
+                    part_df.loc[temp_df.index, "to_delete"] = 1
+                    temp_df = page_df.iloc[span_index.intersecting(norm_box)].copy()
+                    text = " ".join(temp_df["text"])
+                    new_row["text"] = text
+                    new_row["to_delete"] = 0
+                    new_data.append(new_row.to_list())
+            t_df = pd.DataFrame(data=new_data,
                                 columns=part_df.columns)
             part_df = part_df.append(t_df)
             part_df.reset_index(drop=True, inplace=True)
@@ -214,13 +225,9 @@ class PageProcessor:
             logging.error(f"> error in merging normalised boxes for {self.file_name}, {self.page_num}")
 
     def sort_in_reading_order(self, part_df):
-        part_df["centroid_x"] = part_df["pdf_rect"].apply(
-            lambda rect: self.__get_centroid_coord(rect.x0, rect.x1)
-        )
+        # Centroids are those of the blocks as detected, merged blocks keep
+        # the centroid of their first member (see extract_data_from_page)
         part_df["col_no"] = self.__create_coord_groups(part_df["x1"], 100)
-        part_df["centroid_y"] = part_df["pdf_rect"].apply(
-            lambda rect: self.__get_centroid_coord(rect.y0, rect.y1)
-        )
         part_df.sort_values(
             by=["col_no", "centroid_y", "x1"],
             ascending=[True, True, True],
@@ -257,26 +264,26 @@ class PageProcessor:
             logging.info(f"> completed text extraction for {self.file_name}, {page.number}")
             data_df = text_df
             if self.is_scanned:
-                scale = 4
-                img, dpi = page_to_image(page, scale)
-                page_df = get_scanned_page_as_df(img, dpi, scale)
+                # Already OCRed during block detection, served from the session
+                page_df = self.session.get_scanned_page_df(page, 4)
             else:
-                page_df = page_to_df(page)
+                page_df = page_to_df(page, self.session.get_dict(page))
             data_df["page_num"] = page.number
             data_df["intersection"] = 0
             data_df["multicolumn"] = 0
-            data_df["x1"] = data_df["cv_rect"].apply(lambda rect: rect.x0)
-            data_df["x2"] = data_df["cv_rect"].apply(lambda rect: rect.x1)
-            data_df["y1"] = data_df["cv_rect"].apply(lambda rect: rect.y0)
-            data_df["y2"] = data_df["cv_rect"].apply(lambda rect: rect.y1)
+            boxes = get_boxes(data_df)
+            for col, values in zip(BOX_COLUMNS, boxes.T):
+                data_df[col] = values
+            data_df["centroid_x"], data_df["centroid_y"] = centroids(boxes)
             data_df = self.remove_border_elements(page, data_df)
             data_df = self.add_pagebreak(data_df)
+            span_index = RectIndex(get_boxes(page_df))
             grouped = data_df.groupby("multicolumn")
             dfs = [grouped.get_group(x) for x in grouped.groups]
             data_df = data_df.iloc[0:0]
             for part_df in dfs:
                 part_df = self.normalize_block_width(part_df)
-                part_df = self.merge_normalized_rect(part_df, page_df)
+                part_df = self.merge_normalized_rect(part_df, page_df, span_index)
                 part_df = self.sort_in_reading_order(part_df)
                 if data_df.empty:
                     data_df = part_df.copy()
@@ -1,13 +1,25 @@
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
 import logging
+import math
+
+import numpy as np
 
 args = {"normal": 0, "italic": 2, "bold": 3}
 style2int = defaultdict(lambda: 1, **args)
 
 
 class depthCalculator:
+    """ Open title levels, outermost first. A title closes the levels from the
+        first one with a smaller font size, or with the same style, size and case,
+        and opens its own. Open sizes never increase towards the top, so that
+        level is found by bisecting level_keys, the negated sizes.
+    """
+
     def __init__(self):
         self.stack = []
+        # Titles without a size never match, they take the key of the level below
+        self.level_keys = []
         self.parent_holder = {}
         self.depth = 0
 
@@ -24,19 +36,26 @@ class depthCalculator:
             return -1
         return self.parent_holder[self.depth - 1]
 
+    def __closed_level(self, style, size, is_upper):
+        if size != size:
+            return len(self.stack)
+        # Levels of the same size come right before the first smaller one
+        same = bisect_left(self.level_keys, -size)
+        smaller = bisect_right(self.level_keys, -size, lo=same)
+        for ind in range(same, smaller):
+            if self.stack[ind] == [style, size, is_upper]:
+                return ind
+        return smaller
+
     def add_title(self, style, size, is_upper, parent_id, pdf_name):
         try:
-            index = -1
-            for ind, item in enumerate(self.stack):
-                if item[1] < size:
-                    index = ind
-                    break
-                elif item == [style, size, is_upper]:
-                    index = ind
-                    break
-            if index != -1:
-                self.stack = self.stack[:index]
+            index = self.__closed_level(style, size, is_upper)
+            del self.stack[index:], self.level_keys[index:]
             self.stack.append([style, size, is_upper])
+            if size != size:
+                self.level_keys.append(self.level_keys[-1] if self.level_keys else -math.inf)
+            else:
+                self.level_keys.append(-size)
             self.__update_depth()
             self.__update_parent_id(parent_id)
             return self.get_title_parent(), self.depth
@@ -49,9 +68,84 @@ class depthCalculator:
         return self.parent_holder[self.depth], self.depth + 1
 
 
+def clean_unicode(texts):
+    """ Resolves escape sequences in the texts, as unicode-escape decoding the
+        ASCII backslash form of every text, with "\\N" removed first. All texts
+        go through one encode/decode on a NUL-joined string. Falls back to one
+        round trip per text when a text could interact with the separator.
+    Raises:
+        UnicodeDecodeError: If any text holds an invalid escape sequence
+    """
+    escaped = [text.replace("\\N", "").encode("ascii", "backslashreplace").decode("ascii") for text in texts]
+    # A trailing odd backslash is an error per text, but would escape the separator
+    if not any("\0" in text or (len(text) - len(text.rstrip("\\"))) % 2 for text in escaped):
+        cleaned = bytes("\0".join(escaped), "ascii").decode("unicode-escape").split("\0")
+        if len(cleaned) == len(escaped):
+            return cleaned
+    return [bytes(text, "ascii").decode("unicode-escape") for text in escaped]
+
+
+class HierarchyBuilder:
+    """ Assigns block ids, parents and depths to blocks in reading order. The
+        open title levels are kept between calls, so the blocks of a document
+        can be added page by page as they arrive.
+    """
+
+    def __init__(self, pdf_name=""):
+        self.pdf_name = pdf_name
+        self.depth_calc = depthCalculator()
+        self.next_block_id = 0
+        # Blocks with other labels repeat the parent and depth of the block before
+        self.parent_depth = (-1, -1)
+        self.table_parent_depth = (-1, -1)
+
+    def add_blocks(self, labels, sizes, istyles, texts):
+        """
+        Args:
+            labels (np.array): Block labels
+            sizes (np.array): Font sizes
+            istyles (np.array): Styles mapped through style2int
+            texts (np.array): Block texts, titles in upper case rank apart
+        Returns:
+            np.array: Block ids, continuing from the previous call
+            np.array: Parent block ids
+            np.array: Depths
+        """
+        n = len(labels)
+        block_ids = np.arange(self.next_block_id, self.next_block_id + n, dtype=np.int64)
+        parent_ids = np.empty(n, dtype=np.int64)
+        depths = np.empty(n, dtype=np.int64)
+        parent_id, depth = self.parent_depth
+        for i, label in enumerate(labels):
+            if label == "table_image":
+                parent_id, depth = self.table_parent_depth
+            elif label == "text" or label == "table":
+                parent_id, depth = self.depth_calc.get_parent_and_depth()
+                self.table_parent_depth = (parent_id, depth)
+            elif label == "title":
+                parent_id, depth = self.depth_calc.add_title(
+                    istyles[i], sizes[i], texts[i].isupper(), block_ids[i], self.pdf_name)
+            parent_ids[i] = parent_id
+            depths[i] = depth
+        self.parent_depth = (parent_id, depth)
+        self.next_block_id += n
+        return block_ids, parent_ids, depths
+
+
+RELATION_COLUMNS = ["block_id", "parent_id", "depth", "label", "text", "page_no"]
+
+
 class PCRelationGen:
-    def __init__(self):
-        pass
+    """ Builds the parent-child relations of one document. Titles seen so far
+        and the open title levels are kept between add_blocks calls.
+    """
+
+    def __init__(self, pdf_name=""):
+        self.__reset(pdf_name)
+
+    def __reset(self, pdf_name):
+        self.seen_titles = defaultdict(list)
+        self.builder = HierarchyBuilder(pdf_name)
 
     def __in_border(self, row):
         """Check if a block lies in the border of the page
@@ -71,18 +165,29 @@ class PCRelationGen:
         return text.replace("(continued)", "").strip()
 
     def remove_duplicates(self, data_df, pdf_name):
+        """ Drops titles repeated at the same place, like running headers. A title
+            is a duplicate when an earlier title has the same cleaned text and lies
+            within 2 points of it along x and y. Earlier titles are indexed by text
+            and 2 point cells, so every title only checks the 3x3 cells around it.
+            The index is kept between calls, so titles repeated from earlier pages
+            of the same document are dropped too.
+        """
         try:
-            title_df = data_df[data_df["label"] == "title"].copy()
+            title_df = data_df[data_df["label"] == "title"]
             data_df["to_delete"] = False
-            for title_ind, title in title_df.iterrows():
-                for next_title_ind, next_title in title_df.iterrows():
-                    if next_title_ind <= title_ind:
-                        continue
-                    cur_text = self.__clean_text(next_title["text"])
-                    prev_text = self.__clean_text(title["text"])
-                    if (cur_text == prev_text and abs(next_title["x1"] - title["x1"]) <= 2 and abs(
-                            next_title["y1"] - title["y1"]) <= 2):
-                        data_df.at[next_title_ind, "to_delete"] = True
+            seen = self.seen_titles
+            duplicates = []
+            for title_ind, text, x1, y1 in zip(title_df.index, title_df["text"], title_df["x1"], title_df["y1"]):
+                if math.isnan(x1) or math.isnan(y1):
+                    continue
+                text = self.__clean_text(text)
+                cell_x, cell_y = math.floor(x1 / 2), math.floor(y1 / 2)
+                if any(abs(x1 - prev_x1) <= 2 and abs(y1 - prev_y1) <= 2
+                       for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                       for prev_x1, prev_y1 in seen.get((text, cell_x + dx, cell_y + dy), ())):
+                    duplicates.append(title_ind)
+                seen[(text, cell_x, cell_y)].append((x1, y1))
+            data_df.loc[duplicates, "to_delete"] = True
             data_df.drop(data_df[data_df["to_delete"] == True].index, inplace=True)
             data_df.reset_index(drop=True, inplace=True)
             return data_df
@@ -90,48 +195,35 @@ class PCRelationGen:
             logging.error(f"Cannot remove duplicate headers for {pdf_name}")
             return data_df
 
-    def generate_relationship(self, data_df, pdf_name):
+    def add_blocks(self, data_df, pdf_name):
+        """ Relations of the next blocks of the document, continuing from the
+            blocks of the previous calls.
+        Args:
+            data_df (pd.DataFrame): Blocks in reading order
+            pdf_name (str): Name of the pdf, for logging
+        Returns:
+            pd.DataFrame: Blocks with RELATION_COLUMNS, duplicate titles dropped
+        """
         try:
             try:
-                data_df["text"] = data_df["text"].apply(lambda text: bytes(text.replace("\\N", "").encode(
-                    "ascii", "backslashreplace").decode("ascii"), "ascii").decode('unicode-escape'))
+                data_df["text"] = clean_unicode(data_df["text"].tolist())
             except Exception as e:
                 logging.error(f"Cannot remove unicode characters for {pdf_name}")
             data_df = self.remove_duplicates(data_df, pdf_name)
             data_df["istyle"] = data_df["style"].apply(lambda x: style2int[x])
-
-            data_df["block_id"] = range(len(data_df))
-            data_df["parent_id"] = -1
-            data_df["depth"] = -1
             data_df.reset_index(drop=True, inplace=True)
-            dc = depthCalculator()
-            parent_id = -1
-            depth = -1
-            prev_table_parent_depth = [-1, -1]
-            for index, row in data_df.iterrows():
-                if row["label"] == "table_image":
-                    parent_id, depth = prev_table_parent_depth
-                    # continue
-                elif row["label"] == "text" or row["label"] == "table":
-                    parent_id, depth = dc.get_parent_and_depth()
-                    prev_table_parent_depth = [parent_id, depth]
-                elif row["label"] == "title":
-                    parent_id, depth = dc.add_title(
-                        row["istyle"], row["size"],
-                        row["text"].isupper(), row["block_id"], pdf_name)
-                data_df.at[index, "parent_id"] = parent_id
-                data_df.at[index, "depth"] = depth
-            data_df.reset_index(inplace=True, drop=True)
-            df = data_df[[
-                "block_id",
-                "parent_id",
-                "depth",
-                "label",
-                "text",
-                "page_no",
-            ]]
+
+            data_df["block_id"], data_df["parent_id"], data_df["depth"] = self.builder.add_blocks(
+                data_df["label"].to_numpy(), data_df["size"].to_numpy(),
+                data_df["istyle"].to_numpy(), data_df["text"].to_numpy())
+            df = data_df[RELATION_COLUMNS]
 
         except Exception as e:
             logging.error(f"Error in generating parent-child relationships for {pdf_name}")
 
         return df
+
+    def generate_relationship(self, data_df, pdf_name):
+        """ Relations of all the blocks of a document, starting afresh """
+        self.__reset(pdf_name)
+        return self.add_blocks(data_df, pdf_name)
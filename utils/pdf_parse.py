@@ -1,109 +1,488 @@
+import multiprocessing
 import warnings
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
 
-import fitz  # PyMuPDF
+import numpy as np
 import pandas as pd
 import logging
 
-from .pdf_process import check_drm_and_language, check_scanned, check_dpi
+from .config import batch_workers, page_workers, pages_per_task, tasks_per_worker
+from .pdf_process import prescan_document
 from .page_process import PageProcessor
-from .pc_relation import PCRelationGen
+from .doc_session import DocumentSession
+from .pc_relation import PCRelationGen, RELATION_COLUMNS
 
 warnings.filterwarnings("ignore")
 
 
-def get_pdf_extraction(pdf_fpath, pdf_fname):
-    doc = fitz.open(pdf_fpath)
-    page_details = check_drm_and_language(doc)
-    page_details, is_scanned = check_scanned(doc, page_details)
-    is_dpi_valid, faulty_page_nos = check_dpi(doc, page_details)
+PAGE_DATA_COLUMNS = ['sx1', 'x1', 'y1', 'x2', 'y2', 'text', 'size', 'style', 'color', 'font',
+                     'block_num', 'label', 'page_num', 'intersection',
+                     'multicolumn', 'col_no', 'quant_y', 'cv_rect_width', 'norm_x1', 'norm_y1',
+                     'norm_x2', 'norm_y2', 'to_delete', 'centroid_x', 'centroid_y']
 
-    if is_dpi_valid == False:
-        logging.info(f"The pdf DPI is less than 250 for pages {faulty_page_nos} of {pdf_fname}")
 
-    logging.info(f"Processing PDF...")
-    page_proc = PageProcessor(is_scanned=is_scanned)
-    pdf_data = pd.DataFrame()
-    pc_relation_gen = PCRelationGen()
-
-    for page in doc:
-        if page_details[page.number]["drm_status"] == False:
-            page_data = page_proc.extract_data_from_page(pdf_fpath, page,
-                                                         page_details[page.number]["is_scanned"])
-
-        if page_details[page.number]["drm_status"] == True or page_data is None:
-            logging.info(f"> {page.number} is DRM Protected")
-            page_data_columns = ['sx1', 'x1', 'y1', 'x2', 'y2', 'text', 'size', 'style', 'color', 'font',
-                                 'block_num', 'pdf_rect', 'cv_rect', 'label', 'page_num', 'intersection',
-                                 'multicolumn', 'col_no', 'quant_y', 'cv_rect_width', 'norm_rect',
-                                 'to_delete', 'centroid_x', 'centroid_y']
-            drm_protected_data = [0, 0, 0, 0, 0, "Page is DRM Protected", 0, "None", 0, "None", 0, [], [], "None",
-                                  0,
-                                  0, 0, 0, 0, [], [], 0, 0, 0]
-
-            page_data = pd.DataFrame(data=[drm_protected_data], columns=page_data_columns)
-
-        page_data["page_no"] = page.number + 1
-        pdf_data = pdf_data.append(page_data)
-
-    # Create Parent - Child relationships
-    logging.info("Creating parent-child relations...")
-    if pdf_data.empty:
-        raise ValueError("No data extracted from pdfs")
+def get_drm_protected_page_data():
+    drm_protected_data = [0, 0, 0, 0, 0, "Page is DRM Protected", 0, "None", 0, "None", 0, "None",
+                          0,
+                          0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+    return pd.DataFrame(data=[drm_protected_data], columns=PAGE_DATA_COLUMNS)
+
+
+def get_page_data(page_proc, pdf_fpath, page, page_details):
+    """ Runs the page processor on a single page, falling back to the DRM
+        placeholder row when the page is protected or could not be processed.
+    """
+    page_data = None
+    if page_details[page.number]["drm_status"] == False:
+        page_data = page_proc.extract_data_from_page(pdf_fpath, page,
+                                                     page_details[page.number]["is_scanned"])
+
+    if page_details[page.number]["drm_status"] == True or page_data is None:
+        logging.info(f"> {page.number} is DRM Protected")
+        page_data = get_drm_protected_page_data()
+
+    page_proc.session.release(page)
+    page_data["page_no"] = page.number + 1
+    return page_data
+
+
+def extract_page_range(pdf_fpath, page_nos, page_details, is_scanned):
+    """ Worker entry point for parallel extraction. Opens the document once and
+        processes the given pages in order.
+    Args:
+        pdf_fpath (str): Path to the pdf
+        page_nos (list): Zero based page numbers to process
+        page_details (dict): Page-wise status from the document checks
+        is_scanned (bool): Document level scanned status
+    Returns:
+        list: One DataFrame per page, in the order of page_nos
+    """
+    session = DocumentSession(pdf_fpath)
+    page_proc = PageProcessor(is_scanned=is_scanned, session=session)
+    page_datas = [get_page_data(page_proc, pdf_fpath, session.doc[page_no], page_details)
+                  for page_no in page_nos]
+    session.close()
+    return page_datas
+
+
+class PageSelectionError(ValueError):
+    """ Page selection that is malformed or selects no page of the pdf """
+
+
+def parse_page_ranges(spec):
+    """ Parses a page selection like "1-3,7,10-". A range without an end runs
+        to the last page, one without a start begins at the first.
+    Args:
+        spec (str): Comma separated 1-based page numbers and ranges
+    Returns:
+        list: (first, last) of every range, last is None when open
+    Raises:
+        PageSelectionError: If the selection is malformed
+    """
+    page_ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, dash, last = (item.strip() for item in part.partition("-"))
+        try:
+            first = int(first) if first else 1
+            last = (int(last) if last else None) if dash else first
+        except ValueError:
+            raise PageSelectionError(f"Invalid page range {part!r}")
+        if first < 1 or (last is not None and last < first):
+            raise PageSelectionError(f"Invalid page range {part!r}")
+        page_ranges.append((first, last))
+    if not page_ranges:
+        raise PageSelectionError("No pages selected")
+    return page_ranges
 
-    pdf_data.reset_index(drop=True, inplace=True)
-    pdf_data["merge_next"] = False
+
+def select_pages(page_count, pages=None, first_pages=None):
+    """ Zero based numbers of the pages to extract, in page order
+    Args:
+        page_count (int): Page count of the document
+        pages (str or list): Selection for parse_page_ranges, or 1-based page
+                             numbers. All pages when None.
+        first_pages (int): Only pages among the first first_pages
+    Returns:
+        list: Zero based page numbers
+    Raises:
+        PageSelectionError: If the selection is malformed, names a page past the
+                            end of the document or leaves no page to extract
+    """
+    if pages is None:
+        page_nos = list(range(page_count))
+    else:
+        if isinstance(pages, str):
+            page_ranges = parse_page_ranges(pages)
+        else:
+            page_ranges = [(int(page_no), int(page_no)) for page_no in pages]
+        # Open ranges run to the last page, every page named has to exist
+        outside = sorted({page_no for first, last in page_ranges for page_no in (first, last)
+                          if page_no is not None and not 1 <= page_no <= page_count})
+        if outside:
+            named = f"Pages {', '.join(map(str, outside))} are" if len(outside) > 1 else f"Page {outside[0]} is"
+            raise PageSelectionError(f"{named} outside the {page_count} pages of the pdf")
+        page_nos = sorted({page_no - 1 for first, last in page_ranges
+                           for page_no in range(first, (last or page_count) + 1)})
+    if first_pages is not None:
+        if first_pages < 1:
+            raise PageSelectionError("first_pages has to be at least 1")
+        page_nos = [page_no for page_no in page_nos if page_no < first_pages]
+    if not page_nos and (pages is not None or first_pages is not None):
+        raise PageSelectionError(f"No page of the selection is among the first {first_pages} pages")
+    return page_nos
+
+
+def select_pdf_pages(pdf_fpath, pages=None, first_pages=None):
+    """ select_pages for the pdf at pdf_fpath, to check a selection before
+        extracting it
+    """
+    session = DocumentSession(pdf_fpath)
+    try:
+        return select_pages(session.doc.pageCount, pages, first_pages)
+    finally:
+        session.close()
+
+
+def iter_page_data(session, pdf_fpath, page_details, is_scanned, workers=1, page_nos=None):
+    """ Yields the extracted DataFrame of every page in page order. With more than
+        one worker, contiguous page ranges are sharded across a process pool, at
+        most tasks_per_worker ranges per worker at a time. Closing the generator
+        early cancels the ranges not started yet and does not wait for the
+        running ones.
+    Args:
+        page_nos (list): Zero based numbers of the pages to extract, all pages by default
+    """
+    doc = session.doc
+    if page_nos is None:
+        page_nos = list(range(doc.pageCount))
+    if workers <= 1 or len(page_nos) <= 1:
+        page_proc = PageProcessor(is_scanned=is_scanned, session=session)
+        for page_no in page_nos:
+            yield get_page_data(page_proc, pdf_fpath, doc[page_no], page_details)
+        return
+
+    page_ranges = [page_nos[i:i + pages_per_task] for i in range(0, len(page_nos), pages_per_task)]
+    workers = min(workers, len(page_ranges))
+    # Workers only need the pdf path, so they start from a fresh interpreter rather
+    # than a fork of the dispatcher thread with the locks its siblings hold
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    page_ranges = iter(page_ranges)
+    futures = deque()
+
+    def submit(count):
+        for page_range in islice(page_ranges, count):
+            futures.append(executor.submit(extract_page_range, pdf_fpath, page_range, page_details, is_scanned))
+
+    try:
+        submit(workers * tasks_per_worker)
+        while futures:
+            # Futures are awaited in submission order, so pages come back in document order
+            page_datas = futures.popleft().result()
+            submit(1)
+            yield from page_datas
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def prepare_page_data(pdf_data):
+    """ Strips the block texts, flags the blocks whose sentence stays open
+        (merge_next), turns long watermarks into text and drops the others.
+        Every row is handled on its own, so pages can be prepared one at a time.
+    Args:
+        pdf_data (pd.DataFrame): Page data from the page processor
+    Returns:
+        pd.DataFrame: Blocks with merge_next and text_len, on a fresh index
+    """
+    pdf_data = pdf_data.reset_index(drop=True)
     pdf_data["text"] = pdf_data["text"].apply(lambda txt: txt.strip())
-    merge_next_index = ~((pdf_data["text"].str.endswith(".")) |
-                         (pdf_data["text"].str.endswith(":")) |
-                         (pdf_data["text"].str.endswith(";")) |
-                         (pdf_data["text"].str.endswith("?")) |
-                         (pdf_data["text"].str.endswith("”")) |
-                         (pdf_data["text"].str.endswith("\"")))
-    pdf_data.at[merge_next_index, "merge_next"] = True
+    pdf_data["merge_next"] = ~((pdf_data["text"].str.endswith(".")) |
+                               (pdf_data["text"].str.endswith(":")) |
+                               (pdf_data["text"].str.endswith(";")) |
+                               (pdf_data["text"].str.endswith("?")) |
+                               (pdf_data["text"].str.endswith("”")) |
+                               (pdf_data["text"].str.endswith("\"")))
     pdf_data["text_len"] = pdf_data["text"].apply(len)
-    wm_df = pdf_data.at[pdf_data[(pdf_data["label"] == "watermark") &
-                                 (pdf_data["text_len"] >= 50)].index, "label"] = "text"
-    pdf_data.at[pdf_data["label"] == "title", "merge_next"] = False
+    pdf_data.loc[(pdf_data["label"] == "watermark") & (pdf_data["text_len"] >= 50), "label"] = "text"
+    pdf_data.loc[pdf_data["label"] == "title", "merge_next"] = False
     wm_indices = pdf_data["label"] == "watermark"
-    pdf_data = pdf_data[~(wm_indices)].copy()
-    pdf_data["to_delete"] = False
-    prev_row = pd.Series()
-    prev_ind = -1
-    for ind, row in pdf_data.iterrows():
-        if row["label"] == "title":
-            prev_row = pd.Series()
-            prev_ind = -1
-            continue
-        if not prev_row.empty:
-            if prev_row["merge_next"] == True and len(row["text"]) > 0:
-                if row["text"][0].islower() and row["text"][0].isalnum():
-                    text = pdf_data.loc[prev_ind]["text"]
-                    pdf_data.at[ind, "to_delete"] = True
-                    pdf_data.at[prev_ind, "text"] = text + " " + row["text"]
-                    if prev_row["page_no"] == row["page_no"]:
-                        x1 = min(row["x1"], prev_row["x1"])
-                        y1 = min(row["y1"], prev_row["y1"])
-                        x2 = max(row["x2"], prev_row["x2"])
-                        y2 = max(row["y2"], prev_row["y2"])
-                        pdf_data.at[prev_ind, "x1"] = x1
-                        pdf_data.at[prev_ind, "y1"] = y1
-                        pdf_data.at[prev_ind, "x2"] = x2
-                        pdf_data.at[prev_ind, "y2"] = y2
-                    if not row["merge_next"]:
-                        prev_row = row
-                        prev_ind = ind
-                else:
-                    prev_row = row
-                    prev_ind = ind
-            else:
-                prev_row = row
-                prev_ind = ind
+    return pdf_data[~(wm_indices)].reset_index(drop=True)
+
+
+def find_continuations(pdf_data):
+    """ Mask of the blocks that continue the paragraph of the block before them.
+        A block continues when that one does not end a sentence (merge_next) and
+        the block is not a title and starts with a lowercase letter or digit.
+    """
+    first_char = pdf_data["text"].str[:1]
+    can_follow = ((pdf_data["label"] != "title") & first_char.str.islower() &
+                  first_char.str.isalnum()).to_numpy(dtype=bool)
+    follows_open = np.zeros(len(pdf_data), dtype=bool)
+    follows_open[1:] = pdf_data["merge_next"].to_numpy(dtype=bool)[:-1]
+    return can_follow & follows_open
+
+
+def merge_continued_paragraphs(pdf_data):
+    """ Joins paragraphs that continue in the following blocks (see
+        find_continuations). Every run of continuations is joined into the
+        block heading it, whose box grows over the continuations on its own page.
+    Args:
+        pdf_data (pd.DataFrame): Blocks of the document in reading order
+    Returns:
+        pd.DataFrame: Heads of the runs with the joined text
+    """
+    is_continuation = find_continuations(pdf_data)
+    run = np.cumsum(~is_continuation) - 1
+    heads = pdf_data[~is_continuation].copy()
+
+    if is_continuation.any():
+        heads["text"] = pdf_data["text"].groupby(run).agg(" ".join).to_numpy()
+        page_no = pdf_data["page_no"].to_numpy()
+        same_page = page_no == page_no[~is_continuation][run]
+        on_page = pdf_data[same_page].groupby(run[same_page])
+        heads["x1"] = on_page["x1"].min().to_numpy()
+        heads["y1"] = on_page["y1"].min().to_numpy()
+        heads["x2"] = on_page["x2"].max().to_numpy()
+        heads["y2"] = on_page["y2"].max().to_numpy()
+    heads.reset_index(drop=True, inplace=True)
+    return heads
+
+
+def split_open_paragraph(pdf_data):
+    """ Splits off the last paragraph when its last block is still open, as the
+        blocks of the next page may continue it.
+    Args:
+        pdf_data (pd.DataFrame): Prepared blocks in reading order
+    Returns:
+        pd.DataFrame: Blocks whose paragraphs are complete
+        pd.DataFrame: Blocks of the open paragraph, None if there is none
+    """
+    if pdf_data.empty or not pdf_data["merge_next"].iat[-1]:
+        return pdf_data, None
+    start = np.flatnonzero(~find_continuations(pdf_data))[-1]
+    return pdf_data.iloc[:start], pdf_data.iloc[start:]
+
+
+def iter_document_blocks(page_datas, page_nos, pdf_fname):
+    """ Finalizes the blocks of a document from its page data, page by page.
+        Paragraphs still open at the end of a page are held back until the
+        next page, parents and depths of the blocks given out never change
+        afterwards. Paragraphs only continue onto the directly following
+        page, so a gap in page_nos closes them.
+    Args:
+        page_datas (iterable): Page DataFrames in the order of page_nos
+        page_nos (list): Zero based numbers of the extracted pages, ascending
+        pdf_fname (str): Name of the pdf, for logging
+    Yields:
+        int: Pages processed so far, the 1-based page number when all pages
+             are extracted
+        int: Count of the extracted pages
+        pd.DataFrame: Blocks finalized with this page, with the columns of
+                      get_pdf_extraction. Can be empty.
+    Raises:
+        ValueError: After the last page, if nothing was extracted
+    """
+    pc_relation_gen = PCRelationGen(pdf_fname)
+    page_count = len(page_nos)
+    extracted, open_data = 0, None
+    for pages_done, page_data in enumerate(page_datas, start=1):
+        extracted += len(page_data)
+        pdf_data = prepare_page_data(page_data)
+        if open_data is not None:
+            pdf_data = pd.concat([open_data, pdf_data], ignore_index=True)
+        if pages_done < page_count and page_nos[pages_done] == page_nos[pages_done - 1] + 1:
+            pdf_data, open_data = split_open_paragraph(pdf_data)
         else:
-            prev_row = row
-            prev_ind = ind
-    pdf_data.drop(pdf_data[pdf_data["to_delete"] == True].index, inplace=True)
-    pdf_data.reset_index(drop=True, inplace=True)
+            open_data = None
+        if pdf_data.empty:
+            yield pages_done, page_count, pd.DataFrame(columns=RELATION_COLUMNS)
+            continue
+        pdf_data = merge_continued_paragraphs(pdf_data)
+        yield pages_done, page_count, pc_relation_gen.add_blocks(pdf_data, pdf_fname)
+
+    if extracted == 0:
+        raise ValueError("No data extracted from pdfs")
+
+
+def prescan_pdf(session, pdf_fname, page_nos=None):
+    """ Document checks of an open pdf, logging pages of too low resolution
+    Args:
+        page_nos (list): Zero based numbers of the pages to check, all pages by default
+    Returns:
+        dict: Page-wise status, see prescan_document
+        bool: Document level scanned status
+    """
+    page_details, is_scanned, is_dpi_valid, faulty_page_nos = prescan_document(session.doc, page_nos)
+
+    if is_dpi_valid == False:
+        logging.info(f"The pdf DPI is less than 250 for pages {faulty_page_nos} of {pdf_fname}")
+    return page_details, is_scanned
+
+
+def iter_pdf_extraction(pdf_fpath, pdf_fname, workers=None, pages=None, first_pages=None):
+    """ Extracts a pdf page by page, finalizing blocks as soon as the pages
+        they depend on are done (see iter_document_blocks). With pages or
+        first_pages only the selected pages are checked and extracted, and the
+        hierarchy is built within them.
+    Args:
+        pdf_fpath (str): Path to the pdf
+        pdf_fname (str): Name of the pdf, for logging
+        workers (int): Page worker processes, by default page_workers
+        pages (str or list): Pages to extract, see select_pages
+        first_pages (int): Only pages among the first first_pages
+    Yields:
+        int: Pages processed so far, the 1-based page number when all pages
+             are extracted
+        int: Count of the extracted pages
+        pd.DataFrame: Blocks finalized with this page. Can be empty.
+    Raises:
+        PageSelectionError: Before the first page, if the selection is invalid
+                            for the pdf, see select_pages
+        ValueError: After the last page, if nothing was extracted
+    """
+    if workers is None:
+        workers = page_workers
+    session = DocumentSession(pdf_fpath)
+    try:
+        page_nos = select_pages(session.doc.pageCount, pages, first_pages)
+        page_details, is_scanned = prescan_pdf(session, pdf_fname, page_nos)
+
+        logging.info(f"Processing PDF...")
+        page_datas = iter_page_data(session, pdf_fpath, page_details, is_scanned, workers, page_nos)
+        yield from iter_document_blocks(page_datas, page_nos, pdf_fname)
+    finally:
+        session.close()
+
+
+def iter_batch_extraction(pdf_files, workers=None, pages=None, first_pages=None):
+    """ Extracts many pdfs with one process pool. Every document is split into
+        ranges of pages_per_task pages and the ranges are queued round robin
+        across documents, so small documents complete early instead of waiting
+        behind large ones. A document that fails, or that the page selection
+        does not fit, does not affect the others.
+    Args:
+        pdf_files (list): (pdf_fpath, pdf_fname) of every document
+        workers (int): Worker processes, by default batch_workers
+        pages (str or list): Pages to extract of every document, see select_pages
+        first_pages (int): Only pages among the first first_pages
+    Yields:
+        int: Position of the document in pdf_files, in completion order
+        pd.DataFrame: Blocks of the document as from get_pdf_extraction, None on error
+        str: Error message, None on success
+    """
+    if workers is None:
+        workers = batch_workers
+
+    def finish(index):
+        pdf_fname = pdf_files[index][1]
+        page_datas = [page_data for page_range in docs[index]["results"] for page_data in page_range]
+        try:
+            page_blocks = [blocks for _, _, blocks in
+                           iter_document_blocks(page_datas, docs[index]["page_nos"], pdf_fname)]
+            return index, pd.concat(page_blocks, ignore_index=True), None
+        except Exception as e:
+            logging.error(f"> error in extracting {pdf_fname}: {e}")
+            return index, None, str(e)
+
+    docs = {}
+    for index, (pdf_fpath, pdf_fname) in enumerate(pdf_files):
+        try:
+            session = DocumentSession(pdf_fpath)
+            try:
+                page_nos = select_pages(session.doc.pageCount, pages, first_pages)
+                page_details, is_scanned = prescan_pdf(session, pdf_fname, page_nos)
+            finally:
+                session.close()
+        except Exception as e:
+            logging.error(f"> error in opening {pdf_fname}: {e}")
+            yield index, None, str(e)
+            continue
+        page_ranges = [page_nos[i:i + pages_per_task] for i in range(0, len(page_nos), pages_per_task)]
+        docs[index] = {"page_details": page_details, "is_scanned": is_scanned, "page_nos": page_nos,
+                       "page_ranges": page_ranges, "results": [None] * len(page_ranges),
+                       "pending": len(page_ranges)}
+        if not page_ranges:
+            yield finish(index)
+
+    if workers <= 1:
+        for index, doc in docs.items():
+            if not doc["pending"]:
+                continue
+            try:
+                doc["results"] = [extract_page_range(pdf_files[index][0], page_nos, doc["page_details"],
+                                                     doc["is_scanned"]) for page_nos in doc["page_ranges"]]
+            except Exception as e:
+                logging.error(f"> error in extracting {pdf_files[index][1]}: {e}")
+                yield index, None, str(e)
+                continue
+            yield finish(index)
+        return
+
+    # Ranges are queued round robin across documents
+    rounds = max((len(doc["page_ranges"]) for doc in docs.values()), default=0)
+    tasks = deque((index, range_no) for range_no in range(rounds) for index, doc in docs.items()
+                  if range_no < len(doc["page_ranges"]))
+    # Batches run in threads of the API server, where a forked worker could copy
+    # a lock that another thread holds at that moment and block on it forever
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    futures = {}
+    failed = set()
+
+    def submit():
+        while tasks and len(futures) < workers * tasks_per_worker:
+            index, range_no = tasks.popleft()
+            if index in failed:
+                continue
+            doc = docs[index]
+            future = executor.submit(extract_page_range, pdf_files[index][0], doc["page_ranges"][range_no],
+                                     doc["page_details"], doc["is_scanned"])
+            futures[future] = (index, range_no)
+
+    try:
+        submit()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            done = [(future, futures.pop(future)) for future in done]
+            submit()
+            for future, (index, range_no) in done:
+                if index in failed:
+                    continue
+                doc = docs[index]
+                try:
+                    doc["results"][range_no] = future.result()
+                except Exception as e:
+                    logging.error(f"> error in extracting {pdf_files[index][1]}: {e}")
+                    failed.add(index)
+                    for other, (other_index, _) in futures.items():
+                        if other_index == index:
+                            other.cancel()
+                    yield index, None, str(e)
+                    continue
+                doc["pending"] -= 1
+                if doc["pending"] == 0:
+                    yield finish(index)
+                    # Page data of finished documents is no longer needed
+                    doc["results"] = None
+    finally:
+        # A closed generator (client gone) drops the queued ranges without waiting for running ones
+        executor.shutdown(wait=False, cancel_futures=True)
 
-    df = pc_relation_gen.generate_relationship(pdf_data, pdf_fname)
 
-    return df
+def get_pdf_extraction(pdf_fpath, pdf_fname, workers=None, pages=None, first_pages=None):
+    """ Extracts a pdf into blocks with parent-child relationships
+    Args:
+        pdf_fpath (str): Path to the pdf
+        pdf_fname (str): Name of the pdf, for logging
+        workers (int): Page worker processes, by default page_workers
+        pages (str or list): Pages to extract, see select_pages
+        first_pages (int): Only pages among the first first_pages
+    Returns:
+        pd.DataFrame: Blocks with block_id, parent_id, depth, label, text and page_no
+    """
+    page_blocks = [blocks for _, _, blocks in
+                   iter_pdf_extraction(pdf_fpath, pdf_fname, workers, pages, first_pages)]
+    return pd.concat(page_blocks, ignore_index=True)
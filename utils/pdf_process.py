@@ -1,91 +1,135 @@
-import os
-from uuid import uuid4
+import re
+from functools import lru_cache
+
 import cv2
 import fitz
 import numpy as np
 import pandas as pd
-from bs4 import BeautifulSoup
-from pytesseract import image_to_pdf_or_hocr
 
-from .config import temp_folder
+from .config import glyph_cache_size
+from .ocr import get_ocr_pool, parse_hocr
+from .geometry import contained_in, get_boxes
+
+
+def get_ascii_ratio(text):
+    """ Fraction of ASCII characters in text, counted on the UTF-32 code points
+        in one vectorized pass.
+    """
+    if not text:
+        return 0.0
+    code_points = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    return np.count_nonzero(code_points < 128) / code_points.size
+
+
+COLORSPACE_COMPONENTS = {"DeviceGray": 1, "CalGray": 1, "Separation": 1, "DeviceRGB": 3, "CalRGB": 3,
+                         "Lab": 3, "DeviceCMYK": 4}
+PDF_TOKEN = re.compile(r"/[^\s/\[\]<>(){}%]+|\d+ \d+ R|\[|\]")
 
 
-def check_drm_and_language(doc, ):
-    """ Get page-wise status of DRM protection.
+def get_colorspace_components(doc, tokens):
+    """ Color components of a PDF colorspace, from the tokens of its object
     Args:
-        doc (fitz.Document): PDF Document object
+        doc (fitz.Document): Document holding the colorspace
+        tokens (list): PDF_TOKEN matches starting at the colorspace
     Returns:
-        dict: Format- {page_no : True/False}
-              True = DRM Protected
-              False = Not DRM Protected
+        int: Components of the colorspace, None if it cannot be told
     """
-    page_details = {}
-    english_pages = 0
-    for page in doc:
-        ascii_count = 0
-        total_count = 0
-        text = page.get_text("text")
-        total_count = len(text)
-        page_details[page.number] = {}
-        if total_count != 0:
-            for c in text:
-                if c.isascii():
-                    ascii_count += 1
-            percentage_ascii = ascii_count / total_count
-            if percentage_ascii > 0.2:
-                page_details[page.number]["drm_status"] = False
-            else:
-                page_details[page.number]["drm_status"] = True
-        else:
-            page_details[page.number]["drm_status"] = False
+    if not tokens:
+        return None
+    if tokens[0].endswith(" R"):
+        return get_colorspace_components(doc, PDF_TOKEN.findall(doc.xref_object(int(tokens[0].split()[0]))))
+    if tokens[0] != "[":
+        return COLORSPACE_COMPONENTS.get(tokens[0][1:])
+    family = tokens[1][1:] if len(tokens) > 1 else None
+    if family == "ICCBased" and len(tokens) > 2 and tokens[2].endswith(" R"):
+        kind, value = doc.xref_get_key(int(tokens[2].split()[0]), "N")
+        return int(value) if kind == "int" else None
+    if family == "Indexed":
+        # Indexed images decode to their base colorspace
+        return get_colorspace_components(doc, tokens[2:])
+    if family == "DeviceN" and len(tokens) > 2 and tokens[2] == "[":
+        return tokens.index("]", 2) - 3 if "]" in tokens[2:] else None
+    return COLORSPACE_COMPONENTS.get(family)
 
-    return page_details
 
+def get_image_components(doc, xref):
+    """ Color components of an image XObject, read from its colorspace without
+        decoding the image
+    Returns:
+        int: None for images without a /ColorSpace, like JPX or image masks
+    """
+    kind, value = doc.xref_get_key(xref, "ColorSpace")
+    if kind in ("name", "array", "xref"):
+        return get_colorspace_components(doc, PDF_TOKEN.findall(value))
+    return None
 
-def check_scanned(doc, page_details):
-    scanned_count, digital_count = 0, 0
-    for page in doc:
-        text = page.getText()
-        if len(text) > 100:
-            page_details[page.number]["is_scanned"] = False
-            digital_count += 1
-        else:
-            page_details[page.number]["is_scanned"] = True
-            page_details[page.number]["drm_status"] = False
-            scanned_count += 1
-    if scanned_count >= digital_count:
-        return page_details, True
-    return page_details, False
+
+def get_page_dpi(page, images):
+    """ Resolution of a page, read from the metadata of its first image instead
+        of decoding it. CMYK images, told by their four color components
+        whatever the colorspace is called (DeviceCMYK, ICCBased, Indexed...),
+        and image-less pages are measured at the 2x render used before, again
+        without rendering.
+    """
+    if len(images) >= 1 and get_image_components(page.parent, images[0][0]) != 4:
+        width = images[0][2]
+    else:
+        width = (page.rect * fitz.Matrix(2, 2)).irect[2]
+    return int(72 * width / page.rect[2])
 
 
-def check_dpi(doc, page_details):
+def prescan_document(doc, page_nos=None):
+    """ Single pass over the document replacing the separate DRM/language,
+        scanned and DPI checks.
+    Args:
+        doc (fitz.Document): PDF Document object
+        page_nos (list): Zero based numbers of the pages to check, all pages
+                         by default. The document level results then only
+                         cover these pages.
+    Returns:
+        dict: Page-wise profile. Format- {page_no : {"drm_status": bool,
+              "is_scanned": bool, "text_len": int, "ascii_ratio": float,
+              "dpi": int or None}}. DPI is only measured for scanned pages.
+        bool: True if at least half of the pages are scanned
+        bool: True if more than half of the scanned pages are 250 DPI or more
+        list: 1-based page numbers of scanned pages below 250 DPI
+    """
+    page_details = {}
+    scanned_count, digital_count = 0, 0
     gt_250 = 0
     faulty_page_nos = []
-    scanned_pages = 0
-    for page in doc:
-        if page_details[page.number]["is_scanned"]:
-            img = page.getImageList()
-            if len(img) >= 1:
-                pix = fitz.Pixmap(doc, img[0][0])
-                if pix.colorspace.name == "DeviceCMYK":
-                    pix = page.getPixmap(matrix=fitz.Matrix(2, 2))
-            else:
-                pix = page.getPixmap(matrix=fitz.Matrix(2, 2))
-            rect = pix.irect
-            prect = page.rect
-            dpi = int(72 * rect[2] / prect[2])
-            scanned_pages += 1
+    pages = doc if page_nos is None else (doc[page_no] for page_no in page_nos)
+    for page in pages:
+        text = page.getText()
+        text_len = len(text)
+        ascii_ratio = get_ascii_ratio(text)
+        is_scanned = text_len <= 100
+        # Less than 20% ascii text is treated as DRM protected, scanned pages never are
+        drm_status = text_len != 0 and ascii_ratio <= 0.2 and not is_scanned
+        dpi = None
+        if is_scanned:
+            scanned_count += 1
+            dpi = get_page_dpi(page, page.getImageList())
             if dpi >= 250:
                 gt_250 += 1
             else:
                 faulty_page_nos.append(page.number + 1)
-    if scanned_pages != 0:
-        dpi_pass_percentage = gt_250 / scanned_pages
+        else:
+            digital_count += 1
+        page_details[page.number] = {
+            "drm_status": drm_status,
+            "is_scanned": is_scanned,
+            "text_len": text_len,
+            "ascii_ratio": ascii_ratio,
+            "dpi": dpi,
+        }
+
+    if scanned_count != 0:
+        dpi_pass_percentage = gt_250 / scanned_count
     else:
         dpi_pass_percentage = 100
-    if dpi_pass_percentage > 50:
-        return True, faulty_page_nos
-    return False, faulty_page_nos
+    is_dpi_valid = dpi_pass_percentage > 50
+    return page_details, scanned_count >= digital_count, is_dpi_valid, faulty_page_nos
 
 
 def flags_decomposer(flags):
@@ -108,8 +152,13 @@ def flags_decomposer(flags):
     return l
 
 
-def page_to_df(page):
-    blocks = page.getText("dict")["blocks"]
+def page_to_df(page, page_dict=None):
+    """ Span level DataFrame of a digital page. page_dict is the page's
+        "dict" text extraction, when the caller already holds it.
+    """
+    if page_dict is None:
+        page_dict = page.getText("dict")
+    blocks = page_dict["blocks"]
     data, block_data = [], []
     for block_num, block in enumerate(blocks):
         bbox = np.array(block["bbox"]).astype("int")
@@ -125,8 +174,7 @@ def page_to_df(page):
                     int(span["flags"]))
                 color = fitz.sRGB_to_pdf(span["color"])
                 font = span["font"]
-                rect = fitz.Rect(bbox)
-                if rect not in page.rect or text == " ":
+                if text == " ":
                     continue
                 data.append(
                     (
@@ -142,7 +190,6 @@ def page_to_df(page):
                         block_num,
                         line_num,
                         span_num,
-                        rect,
                     )
                 )
     df = pd.DataFrame(
@@ -159,10 +206,11 @@ def page_to_df(page):
             "block_num",
             "line_num",
             "span_num",
-            "rect",
         ],
         data=data,
     )
+    # Spans outside the page are dropped
+    df = df[contained_in(get_boxes(df), page.rect)].reset_index(drop=True)
     return df
 
 
@@ -172,90 +220,92 @@ def check_overlap_area(bbox, rect, threshold):
     )
 
 
-def page_to_image(page, scale=1):
-    pixmap = page.getPixmap(matrix=fitz.Matrix(scale, scale))
-    # pixmap.writeImage("temp.png")
-    nparr = np.fromstring(pixmap.getPNGData(), np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
-    # img = cv2.imread("temp.png")
+def pixmap_to_array(pixmap):
+    """ Numpy view over the pixel samples of a pixmap, shape (h, w, n) """
+    return np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.h, pixmap.w, pixmap.n)
+
+
+@lru_cache(maxsize=glyph_cache_size)
+def get_glyph_ink(char, size, scale, fontname="helv"):
+    """ Pixels inked by a character written with insert_text at an integer point
+        and rendered at an integer scale. Every such placement has the same
+        sub-pixel phase, so the pixels can be stamped anywhere on a page mask.
+        Measured once per character, size and scale, and kept for the
+        glyph_cache_size most recently used ones.
+    Returns:
+        np.array: Row offsets of the inked pixels relative to the insertion point
+        np.array: Column offsets of the inked pixels
+    """
+    origin = fitz.Point(2 * size + 2, 2 * size + 2)
+    doc = fitz.open()
+    page = doc.newPage(width=5 * size + 4, height=4 * size + 4)
+    page.insertText(origin, char, fontsize=size, fontname=fontname)
+    pixmap = page.getPixmap(matrix=fitz.Matrix(scale, scale), colorspace=fitz.csGRAY, alpha=False)
+    ys, xs = np.nonzero(pixmap_to_array(pixmap)[:, :, 0] < 255)
+    doc.close()
+    return ys - int(origin.y * scale), xs - int(origin.x * scale)
+
+
+def page_to_image(page, scale=1, gray=False, out=None):
+    """ Renders a page straight into a numpy array, without a PNG round trip.
+    Args:
+        page (fitz.Page): Page to render
+        scale (int): Zoom factor of the render
+        gray (bool): Render in grayscale and return a (h, w) view of the samples
+        out (np.array): Preallocated (h, w, 3) buffer for the BGR image, reused
+                        across pages of the same size
+    Returns:
+        np.array: BGR image, or grayscale read-only view if gray is set
+        int: DPI of the render
+    """
+    pixmap = page.getPixmap(matrix=fitz.Matrix(scale, scale),
+                            colorspace=fitz.csGRAY if gray else fitz.csRGB, alpha=False)
+    samples = pixmap_to_array(pixmap)
+    if gray:
+        img = samples[:, :, 0]
+    elif out is not None and out.shape == samples.shape:
+        img = cv2.cvtColor(samples, cv2.COLOR_RGB2BGR, dst=out)
+    else:
+        img = cv2.cvtColor(samples, cv2.COLOR_RGB2BGR)
     x_dpi = int(72 * pixmap.irect[2] / page.rect[2])
     y_dpi = int(72 * pixmap.irect[3] / page.rect[3])
     dpi = min(x_dpi, y_dpi)
     return img, dpi
 
 
-def get_scanned_page_as_df(img, dpi, scale):
-    # img, dpi = self.get_page_as_image(page_num, scale)
-    temp_file = os.path.join(temp_folder, f"{uuid4()}.png")
-    cv2.imwrite(temp_file, img)
-    ocr_config = f"--oem 1 --psm 1 hocr_font_info=1 --dpi {dpi}"
-    hocr = image_to_pdf_or_hocr(
-        temp_file, lang="eng", config=ocr_config, extension="hocr"
-    )
-
-    soup = BeautifulSoup(hocr, features="lxml")
-    data = []
-    for block_num, block in enumerate(soup.find_all("div", {"class": "ocr_carea"})):
-        for par_num, par in enumerate(block.find_all("p", {"class": "ocr_par"})):
-            lines = par.find_all("span", recursive=False)
-            for line_num, line in enumerate(lines):
-                words = line.find_all("span")
-                for word_num, word in enumerate(words):
-                    text = word.string
-                    if text in [" "]:
-                        continue
-                    txt = text
-                    details = word["title"].split(";")
-                    for prop in details:
-                        prop = [d for d in prop.split(" ") if d]
-                        if prop[0] == "bbox":
-                            x1 = int(prop[1]) / scale
-                            y1 = int(prop[2]) / scale
-                            x2 = int(prop[3]) / scale
-                            y2 = int(prop[4]) / scale
-                            size = y2 - y1
-                        elif prop[0] == "x_wconf":
-                            conf = int(prop[1])
-                        elif prop[0] == "x_fsize":
-                            size = int(prop[1])
-                    block_num = block_num
-                    par_num = par_num
-                    line_num = line_num
-                    word_num = word_num
-                    data.append(
-                        (
-                            x1,
-                            y1,
-                            x2,
-                            y2,
-                            txt,
-                            size,
-                            "normal",
-                            np.nan,
-                            np.nan,
-                            block_num,
-                            line_num,
-                            word_num,
-                            fitz.Rect([x1, y1, x2, y2]),
-                        )
-                    )
+def get_scanned_page_as_df(img, dpi, scale, min_conf=None):
+    """ OCRs a page image into a word level DataFrame.
+    Args:
+        img (np.array): Page image rendered at scale
+        dpi (int): Resolution of img
+        scale (int): Render scale, OCR coordinates are divided by it
+        min_conf (int): If given, words with a lower x_wconf are dropped
+    Returns:
+        pd.DataFrame: Same columns as page_to_df, plus the word confidence in "conf"
+    """
+    hocr = get_ocr_pool().image_to_hocr(img, dpi)
+    words = parse_hocr(hocr, scale)
+    if min_conf is not None:
+        keep = words["conf"] >= min_conf
+        words = {col: (np.asarray(values, dtype=object)[keep].tolist() if col == "text" else values[keep])
+                 for col, values in words.items()}
+    n = len(words["text"])
     df = pd.DataFrame(
-        columns=[
-            "x1",
-            "y1",
-            "x2",
-            "y2",
-            "text",
-            "size",
-            "style",
-            "color",
-            "font",
-            "block_num",
-            "line_num",
-            "span_num",
-            "rect",
-        ],
-        data=data,
+        {
+            "x1": words["x1"],
+            "y1": words["y1"],
+            "x2": words["x2"],
+            "y2": words["y2"],
+            "text": words["text"],
+            "size": words["size"],
+            "style": "normal",
+            "color": np.full(n, np.nan),
+            "font": np.full(n, np.nan),
+            "block_num": words["block_num"],
+            "line_num": words["line_num"],
+            "span_num": words["span_num"],
+            "conf": words["conf"],
+        }
     )
     return df
 
@@ -0,0 +1,147 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from uuid import uuid4
+
+from .config import block_detector
+
+# Bump when a change alters the extraction output, so older cached results miss
+EXTRACTOR_VERSION = 2
+
+
+def cache_key(pdf_hash, **settings):
+    """ Key of an extraction result: the hash of the pdf bytes, the extractor
+        version and every setting that changes the output.
+    Args:
+        pdf_hash (str): Hex digest of the pdf bytes
+        settings: Further output-changing arguments of the extraction
+    Returns:
+        str: Hex digest used as the entry name
+    """
+    key = {"pdf": pdf_hash, "version": EXTRACTOR_VERSION, "block_detector": block_detector, **settings}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """ Gzipped extraction results on disk, one file per key, evicted least
+        recently used first once they take more than max_bytes. Entries are kept
+        as the response body bytes, so a hit is served without parsing or
+        opening the pdf.
+    """
+
+    def __init__(self, folder, max_bytes):
+        """
+        Args:
+            folder (str): Directory of the entries, created if needed
+            max_bytes (int): Compressed size the entries may take, 0 disables the cache
+        """
+        self.folder = str(folder)
+        self.max_bytes = int(max_bytes)
+        self.__lock = threading.Lock()
+        # key -> compressed size, least recently used first
+        self.__entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        if self.max_bytes <= 0:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        # Entries left by earlier processes, ordered by their last use
+        entries = []
+        for fname in os.listdir(self.folder):
+            if fname.endswith(".json.gz"):
+                stat = os.stat(os.path.join(self.folder, fname))
+                entries.append((stat.st_mtime, fname[:-len(".json.gz")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.__entries[key] = size
+            self.total_bytes += size
+        self.__evict()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def __path(self, key):
+        return os.path.join(self.folder, f"{key}.json.gz")
+
+    def get(self, key, pdf_size=0):
+        """
+        Args:
+            key (str): Key from cache_key
+            pdf_size (int): Bytes of the pdf, counted as saved on a hit
+        Returns:
+            bytes: Gzipped response body, None on a miss
+        """
+        if not self.enabled:
+            return None
+        try:
+            with open(self.__path(key), "rb") as file:
+                body = file.read()
+            os.utime(self.__path(key))
+        except FileNotFoundError:
+            # Never stored, or evicted by another process sharing the folder
+            with self.__lock:
+                self.misses += 1
+                if key in self.__entries:
+                    self.total_bytes -= self.__entries.pop(key)
+            return None
+        with self.__lock:
+            self.hits += 1
+            self.bytes_saved += pdf_size
+            if key not in self.__entries:
+                self.total_bytes += len(body)
+            self.__entries[key] = len(body)
+            self.__entries.move_to_end(key)
+        return body
+
+    def put(self, key, body):
+        """ Stores an uncompressed response body under key
+        Returns:
+            bytes: The gzipped body
+        """
+        compressed = gzip.compress(body, compresslevel=6)
+        if not self.enabled or len(compressed) > self.max_bytes:
+            return compressed
+        # Written aside and renamed, so readers never see a partial entry
+        temp_path = os.path.join(self.folder, f".{uuid4()}.tmp")
+        try:
+            with open(temp_path, "wb") as file:
+                file.write(compressed)
+            os.replace(temp_path, self.__path(key))
+        except OSError as e:
+            logging.error(f"> Cannot store cached result {key}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return compressed
+        with self.__lock:
+            self.total_bytes += len(compressed) - self.__entries.get(key, 0)
+            self.__entries[key] = len(compressed)
+            self.__entries.move_to_end(key)
+            self.__evict()
+        return compressed
+
+    def __evict(self):
+        while self.total_bytes > self.max_bytes and self.__entries:
+            key, size = self.__entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.__path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self.__entries),
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytes_saved": self.bytes_saved,
+            }
@@ -1,17 +1,29 @@
 import os
+from collections import defaultdict
 from uuid import uuid4
 from pathlib import Path
 import cv2
 import fitz
 import numpy as np
 import pandas as pd
-from .pdf_process import get_scanned_page_as_df, page_to_image, page_to_df, create_page
+from .pdf_process import page_to_image, page_to_df, create_page, get_glyph_ink
+from .doc_session import DocumentSession
+from .geometry import BOX_COLUMNS, RectIndex, get_boxes, overlap_components, union, union_by_component
+from .config import block_detector
 import logging
 
+# Geometry block detector: mask pixels per point of median font size, closing
+# radius in points, and the median font size above which that radius grows
+GEOMETRY_PX_PER_SIZE = 48
+GEOMETRY_GAP = 3.5
+GEOMETRY_BASE_SIZE = 12
+
 
 class TextExtractor:
-    def __init__(self, is_scanned):
+    def __init__(self, is_scanned, session=None, block_detector=block_detector):
         self.path = ""
+        self.session = session if session is not None else DocumentSession()
+        self.block_detector = block_detector
         self.doc = None
         self.is_scanned = is_scanned
         self.data_df = pd.DataFrame()
@@ -52,7 +64,7 @@ class TextExtractor:
         Generates a dataframe of PDF page containing data to the level of each letter
         """
         try:
-            blocks = page.getTextPage().extractRAWDICT()["blocks"]
+            blocks = self.session.get_rawdict(page)["blocks"]
             data = []
             for block_num, block in enumerate(blocks):
                 if "image" in block.keys():
@@ -68,9 +80,6 @@ class TextExtractor:
                             )
                             color = span["color"]
                             font = span["font"]
-                            rect = fitz.Rect(x1, y1, x2, y2)
-                            # if rect not in page.rect or text == " ":
-                            #     continue
                             data.append(
                                 (
                                     x1,
@@ -85,7 +94,6 @@ class TextExtractor:
                                     block_num,
                                     line_num,
                                     span_num,
-                                    rect,
                                 )
                             )
             df = pd.DataFrame(
@@ -102,7 +110,6 @@ class TextExtractor:
                     "block_num",
                     "line_num",
                     "span_num",
-                    "rect",
                 ],
                 data=data,
             )
@@ -134,6 +141,7 @@ class TextExtractor:
     def get_stripped_page(self, page):
         """
         Strips the PDF page of all the Lines and Figures preserving only copyable the text.
+        Returns the stripped page rendered in grayscale at scale 4.
         """
 
         try:
@@ -147,20 +155,83 @@ class TextExtractor:
                 lambda row: self.__print_on_page(temp_page, fonts, row),
                 axis=1,
             )
-            img, _ = page_to_image(self.doc[self.doc.pageCount - 1], 4)
+            img, _ = page_to_image(self.doc[self.doc.pageCount - 1], 4, gray=True)
             # page_num = page.number
             self.doc.deletePage(self.doc.pageCount - 1)
         except Exception as e:
             logging.error(
                 "> error in extracting stripped page for {self.file_name}, {self.page_num}.\nReturning original page image by default.")
 
-            img, _ = page_to_image(page, 4)
+            img, _ = page_to_image(page, 4, gray=True)
         return img
 
+    def get_char_origins(self, page):
+        """ Where get_stripped_page writes every character: in helv, at the
+            bottom-left corner of its bbox, with the integer span font size.
+        Returns:
+            dict: {(char, size): [(x, y), ...]}
+        """
+        origins = defaultdict(list)
+        for block in self.session.get_rawdict(page)["blocks"]:
+            if "image" in block.keys():
+                continue
+            for line in block["lines"]:
+                for span in line["spans"]:
+                    size = int(span["size"])
+                    for char in span["chars"]:
+                        origins[(char["c"], size)].append((int(char["bbox"][0]), int(char["bbox"][3])))
+        return origins
+
+    def get_char_mask(self, page):
+        """ Geometry-only alternative to closing the rendered stripped page.
+            Characters are stamped straight into a binary mask at the origin of
+            their bounding boxes from cached glyph pixels, then closed with a single
+            square kernel. The page is neither re-typeset nor rendered, and the
+            PDF is not modified. The mask resolution follows the median font size
+            (4 px per point up to 12pt text, coarser above). The closed gap is the
+            render detector's 3.5pt up to 12pt text and grows with the median
+            font size above, so pages of body text up to 12pt give the same
+            blocks as the render detector.
+        Returns:
+            np.array: Closed binary mask of the text
+            int: Pixels per PDF point of the mask
+        """
+        origins = self.get_char_origins(page)
+        counts = [(size, len(points)) for (_, size), points in origins.items()]
+        if counts:
+            sizes, weights = np.array(counts).T
+            median_size = max(np.repeat(sizes, weights)[weights.sum() // 2], 1)
+        else:
+            median_size = GEOMETRY_BASE_SIZE
+        scale = int(min(4, max(1, GEOMETRY_PX_PER_SIZE // median_size)))
+        irect = (page.rect * fitz.Matrix(scale, scale)).irect
+        height, width = irect.height, irect.width
+
+        mask = self.session.get_buffer("char_mask", (height, width))
+        mask[:] = 0
+        for (char, size), points in origins.items():
+            dy, dx = get_glyph_ink(char, size, scale)
+            if len(dy) == 0:
+                continue
+            points = np.array(points, dtype=np.int64) * scale
+            ys = (points[:, 1, None] + dy).ravel()
+            xs = (points[:, 0, None] + dx).ravel()
+            inside = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
+            mask[ys[inside], xs[inside]] = 255
+
+        # 7 iterations of a 5x5 kernel equal one (2 * 14 + 1) square kernel
+        gap = GEOMETRY_GAP * max(1, median_size / GEOMETRY_BASE_SIZE)
+        radius = max(1, int(round(gap * scale)))
+        kernel = np.ones((2 * radius + 1, 2 * radius + 1), np.uint8)
+        closed = self.session.get_buffer("closed_mask", (height, width))
+        cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, dst=closed)
+        return closed, scale
+
     def get_blocks_bbox_by_cv(self, page):
         """ Generates bounding boxes of text blocks using OpenCV.
         It first generates stripped page, i.e., removes everything (lines, images, objects,etc.)
-        from the page except the text.
+        from the page except the text. With the "geometry" block detector, digital pages
+        are closed on a mask stamped from the character boxes instead (get_char_mask).
         Args:
             page (fitz.Page): Document page object is directly passed.
         Returns:
@@ -174,30 +245,37 @@ class TextExtractor:
                 "x2",
                 "y2",
                 "block_num",
-                "rect",
                 "label",
             ]
             block_num = 0
             if self.is_scanned:
                 scale = 4
-                img, dpi = page_to_image(page, scale)
-                self.page_df = get_scanned_page_as_df(img, dpi, scale)
+                img, dpi = page_to_image(page, scale, out=self.session.get_page_image_buffer(page, scale))
+                self.page_df = self.session.get_scanned_page_df(page, scale, img, dpi)
+                gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY,
+                                        dst=self.session.get_buffer("gray", img.shape[:2]))
             else:
-                scale = 4
-                img = self.get_stripped_page(page)
-                self.page_df = page_to_df(page)
+                self.page_df = page_to_df(page, self.session.get_dict(page))
                 self.page_df["style"] = self.page_df["style"].apply(
                     lambda item: "bold"
                     if "bold" in item
                     else ("italic" if "italic" in item else "normal")
                 )
-            gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            kernel = np.ones((5, 5), np.uint8)
-            gray_img = 255 - gray_img
-            img_dilation = cv2.morphologyEx(
-                gray_img, cv2.MORPH_CLOSE, kernel, iterations=7)
-            _, img_dilation = cv2.threshold(
-                img_dilation, 0, 255, cv2.THRESH_BINARY)
+                if self.block_detector == "geometry":
+                    img_dilation, scale = self.get_char_mask(page)
+                else:
+                    scale = 4
+                    gray_img = self.get_stripped_page(page)
+            if self.is_scanned or self.block_detector != "geometry":
+                kernel = np.ones((5, 5), np.uint8)
+                inverted = cv2.bitwise_not(gray_img, dst=self.session.get_buffer("inverted", gray_img.shape))
+                img_dilation = self.session.get_buffer("closed", gray_img.shape)
+                cv2.morphologyEx(
+                    inverted, cv2.MORPH_CLOSE, kernel, dst=img_dilation, iterations=7)
+                cv2.threshold(
+                    img_dilation, 0, 255, cv2.THRESH_BINARY, dst=img_dilation)
+            # Spans of the page, queried for every block from here on
+            self.span_index = RectIndex(get_boxes(self.page_df))
             # Generate Contours
             contours, _ = cv2.findContours(
                 img_dilation, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE
@@ -211,17 +289,10 @@ class TextExtractor:
                 w /= scale
                 h /= scale
                 if w > 2 and h > 2:
-                    rect = fitz.Rect(
-                        [x, y, (x + w), (y + h)]
-                    )  # All the coordinates are divided by 4 because the image was scaled 4 times while reading
-                    block_df = self.page_df[
-                        self.page_df["rect"].apply(rect.intersects)
-                    ].copy()
+                    # All the coordinates are divided by 4 because the image was scaled 4 times while reading
                     label = "text"
-                    if block_df.empty:
+                    if self.span_index.intersecting((x, y, x + w, y + h)).size == 0:
                         label = "figure"
-                    img = cv2.rectangle(
-                        img, (int(x), int(y)), (int(x + w), int(y + h)), (255, 0, 0), 2)
                     blocks_data.append(
                         [
                             x,
@@ -229,13 +300,11 @@ class TextExtractor:
                             (x + w),
                             (y + h),
                             block_num,
-                            rect,
                             label,
                         ]
                     )
                 block_num += 1
             blocks_df = pd.DataFrame(data=blocks_data, columns=blocks_columns)
-            # cv2.imwrite("check.png", img)
             if blocks_df.empty:
                 raise ValueError(f"No text blocks detected.")
             return blocks_df
@@ -247,42 +316,24 @@ class TextExtractor:
 
             return pd.DataFrame()
 
-    # def __merging_bboxes(self, index, row):
     def merge_overlapping_bbox(self, blocks_df):
+        """ Merges every cluster of overlapping blocks, chains included, into one
+            block spanning the cluster. The block takes the label and block_num
+            of the first block of its cluster and the clusters keep the order of
+            their first block.
+        Args:
+            blocks_df (pd.DataFrame): Blocks from get_blocks_bbox_by_cv
+        Returns:
+            pd.DataFrame: One row per cluster of overlapping blocks
+        """
         try:
-            blocks_columns = [
-                "x1",
-                "y1",
-                "x2",
-                "y2",
-                "block_num",
-                "rect",
-                "label",
-            ]
-            blocks_df["to_delete"] = 0
-            new_block_data = {}
-            for index, row in blocks_df.iterrows():
-                if row["to_delete"] == 0:
-                    temp_df = blocks_df[blocks_df["rect"].apply(
-                        row["rect"].intersects)]
-                    if len(temp_df) > 1:
-                        new_row = row.copy()
-                        blocks_df.at[index, "to_delete"] = 1
-                        new_row["label"] = temp_df["label"].values[0]
-                        new_row["x1"] = new_row["rect"].x0
-                        new_row["y1"] = new_row["rect"].y0
-                        new_row["x2"] = new_row["rect"].x1
-                        new_row["y2"] = new_row["rect"].y1
-                        new_block_data[new_row["rect"]] = new_row.to_list()
-            t_df = pd.DataFrame(
-                data=list(new_block_data.values()), columns=blocks_columns + ["to_delete"]
-            )
-            blocks_df = blocks_df.append(t_df)
-            blocks_df.reset_index(drop=True, inplace=True)
-            blocks_df.drop(
-                blocks_df[blocks_df["to_delete"] == 1].index, inplace=True)
-            blocks_df.reset_index(drop=True, inplace=True)
-            return blocks_df
+            boxes = get_boxes(blocks_df)
+            components = overlap_components(boxes)
+            first_pos = np.unique(components, return_index=True)[1]
+            merged_df = blocks_df.iloc[first_pos].reset_index(drop=True)
+            for col, values in zip(BOX_COLUMNS, union_by_component(boxes, components).T):
+                merged_df[col] = values
+            return merged_df
         except Exception as e:
             logging.error(f"> error in merging bboxes for {self.file_name}, {self.page_num}")
             return pd.DataFrame()
@@ -301,21 +352,21 @@ class TextExtractor:
                 "color",
                 "font",
                 "block_num",
-                "pdf_rect",
-                "cv_rect",
                 "label",
             ]
-            block_data = {}
+            block_data = []
             block_num = 0
             blocks_df = self.get_blocks_bbox_by_cv(page)
             blocks_df = self.merge_overlapping_bbox(blocks_df)
             self.page_df["is_used"] = False
-            for _, out_row in blocks_df.iterrows():
-                rect = out_row["rect"]
-                temp_df = self.page_df[(self.page_df["rect"].apply(rect.intersects)) &
-                                       ~(self.page_df["is_used"])].copy()
-                self.page_df.at[(self.page_df["rect"].apply(
-                    rect.intersects)), "is_used"] = True
+            is_used = np.zeros(len(self.page_df), dtype=bool)
+            # Position in block_data of every reachable block box
+            block_keys = {}
+            block_boxes = get_boxes(blocks_df.reindex(columns=BOX_COLUMNS))
+            for rect, (_, out_row) in zip(block_boxes, blocks_df.iterrows()):
+                span_ids = self.span_index.intersecting(rect)
+                temp_df = self.page_df.iloc[span_ids[~is_used[span_ids]]].copy()
+                is_used[span_ids] = True
                 temp_df["label"] = out_row["label"]
                 temp_df["text"] = temp_df["text"].apply(str)
                 temp_df.reset_index(inplace=True)
@@ -370,34 +421,39 @@ class TextExtractor:
                             font = first_row["font"]
                             style = first_row["style"]
                             color = first_row["color"]
-                            pdf_rect = fitz.Rect([x1, y1, x2, y2])
-                            if pdf_rect not in block_data.keys():
-                                block_data[pdf_rect] = [
-                                    sx1,
-                                    x1,
-                                    y1,
-                                    x2,
-                                    y2,
-                                    text,
-                                    size,
-                                    style,
-                                    color,
-                                    font,
-                                    block_num,
-                                    pdf_rect,
-                                    pdf_rect,
-                                    label,
-                                ]
+                            box = (x1, y1, x2, y2)
+                            if box not in block_keys:
+                                block_keys[box] = len(block_data)
+                                block_data.append(
+                                    [
+                                        sx1,
+                                        x1,
+                                        y1,
+                                        x2,
+                                        y2,
+                                        text,
+                                        size,
+                                        style,
+                                        color,
+                                        font,
+                                        block_num,
+                                        label,
+                                    ]
+                                )
                                 block_num += 1
                             else:
-                                block_data[pdf_rect][12].includeRect(
-                                    rect
-                                )  # If text block is repeated, merge them.
+                                # If text block is repeated, merge them. The grown box
+                                # no longer matches its key and is not merged into again.
+                                block = block_data[block_keys[box]]
+                                block[1:5] = union(block[1:5], rect)
+                                if tuple(block[1:5]) != box:
+                                    del block_keys[box]
                         except Exception as e:
                             logging.error("> error in generating page dataframe")
+            self.page_df["is_used"] = is_used
 
             data_df = pd.DataFrame(
-                data=list(block_data.values()), columns=new_blocks_columns
+                data=block_data, columns=new_blocks_columns
             )
             return data_df
         except Exception as e:
@@ -410,8 +466,10 @@ class TextExtractor:
             self.is_scanned = is_scanned
             self.file_name = Path(path).name
             self.page_num = page.number
+            # Do not carry a previous page's blocks over if this page fails
+            self.data_df = pd.DataFrame()
             logging.info(f"> begin text extraction for {self.file_name}, {page.number}")
-            self.doc = fitz.open(path)
+            self.doc = self.session.scratch_doc
             data_df = self.get_page_blocks_with_text(page)
             data_df.reset_index(drop=True, inplace=True)
             self.data_df = data_df
@@ -0,0 +1,146 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import zipfile
+
+from .config import temp_folder, upload_chunk_size, upload_max_bytes
+
+
+class UploadTooLarge(ValueError):
+    """ Raised when an upload holds more than max_bytes """
+
+    def __init__(self, max_bytes):
+        super().__init__(f"Upload is larger than the limit of {max_bytes} bytes")
+        self.max_bytes = max_bytes
+
+
+def create_scratch_dir():
+    """ Private directory under temp_folder for the files of one request. Only
+        that request removes it, so concurrent requests never touch each other's
+        files.
+    """
+    os.makedirs(temp_folder, exist_ok=True)
+    return tempfile.mkdtemp(prefix="request-", dir=temp_folder)
+
+
+def remove_scratch_dir(scratch_dir):
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def save_upload(fileobj, fpath, chunk_size=upload_chunk_size, max_bytes=upload_max_bytes):
+    """ Copies an uploaded file to fpath one chunk at a time, so large uploads
+        never sit in memory as a whole.
+    Args:
+        fileobj (file): Binary file object of the upload
+        fpath (str): Destination path
+        chunk_size (int): Bytes read per chunk
+        max_bytes (int): Largest upload accepted, 0 for any size
+    Returns:
+        int: Bytes written
+    Raises:
+        UploadTooLarge: If the upload holds more than max_bytes, nothing is left at fpath
+    """
+    fileobj.seek(0)
+    size = 0
+    with open(fpath, "wb") as file:
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if max_bytes and size > max_bytes:
+                break
+            file.write(chunk)
+    if max_bytes and size > max_bytes:
+        os.remove(fpath)
+        raise UploadTooLarge(max_bytes)
+    return size
+
+
+def hash_upload(fileobj, chunk_size=upload_chunk_size, max_bytes=upload_max_bytes):
+    """ SHA-256 of an uploaded file, read one chunk at a time
+    Returns:
+        str: Hex digest
+        int: Bytes read
+    Raises:
+        UploadTooLarge: If the upload holds more than max_bytes
+    """
+    fileobj.seek(0)
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_bytes and size > max_bytes:
+            raise UploadTooLarge(max_bytes)
+        digest.update(chunk)
+    return digest.hexdigest(), size
+
+
+def is_safe_member_path(filename):
+    """ Whether a zip member path stays below the folder it is extracted to,
+        i.e. it is relative, without a drive and without ".." parts
+    """
+    path = filename.replace("\\", "/")
+    return not (path.startswith("/") or path[1:2] == ":" or ".." in path.split("/"))
+
+
+def save_batch_uploads(uploads, scratch_dir, max_bytes=upload_max_bytes):
+    """ Saves the files of a batch upload into scratch_dir. Zip archives are
+        expanded into the pdfs they hold, other members are skipped. Files that
+        are neither pdf nor zip, unreadable archives, pdfs over upload_max_bytes
+        and pdf members whose path is absolute or climbs out with ".." are
+        reported instead of failing the batch.
+    Args:
+        uploads (list): (filename, file object) of every uploaded file
+        scratch_dir (str): Request scratch directory
+        max_bytes (int): Largest pdf or zip archive accepted, 0 for any size
+    Returns:
+        list: (pdf_fname, pdf_fpath, error) of every document, pdf_fpath is None
+              when error is set
+    """
+    documents = []
+
+    def add_pdf(pdf_fname, fileobj):
+        pdf_fpath = os.path.join(scratch_dir, f"{len(documents)}.pdf")
+        try:
+            save_upload(fileobj, pdf_fpath, max_bytes=max_bytes)
+        except UploadTooLarge as e:
+            documents.append((pdf_fname, None, str(e)))
+            return
+        documents.append((pdf_fname, pdf_fpath, None))
+
+    for filename, fileobj in uploads:
+        name = os.path.basename(filename or "")
+        if name.lower().endswith(".pdf"):
+            add_pdf(name[:-4], fileobj)
+        elif name.lower().endswith(".zip"):
+            # Spooled uploads cannot be read as archives in place
+            zip_fpath = os.path.join(scratch_dir, f"upload-{len(documents)}.zip")
+            try:
+                save_upload(fileobj, zip_fpath, max_bytes=max_bytes)
+            except UploadTooLarge as e:
+                documents.append((name, None, str(e)))
+                continue
+            try:
+                with zipfile.ZipFile(zip_fpath) as archive:
+                    for member in archive.infolist():
+                        # Members are saved under generated names, never their own paths
+                        member_name = os.path.basename(member.filename)
+                        if member.is_dir() or not member_name.lower().endswith(".pdf"):
+                            continue
+                        if not is_safe_member_path(member.filename):
+                            documents.append((member.filename, None, "Unsafe path in zip archive"))
+                            continue
+                        with archive.open(member) as member_file:
+                            add_pdf(member_name[:-4], member_file)
+            except zipfile.BadZipFile as e:
+                documents.append((name, None, f"Cannot read zip archive: {e}"))
+            finally:
+                os.remove(zip_fpath)
+        else:
+            documents.append((name, None, "Incorrect file uploaded"))
+    return documents